@@ -1,13 +1,16 @@
 import numba
 import datetime
+from collections import deque
 
 IVT_SIZE = 256 # векторы
 
 class VideoController:
-    def __init__(self):
+    def __init__(self, scrollback_lines=0):
         self.width = 80
         self.height = 25
         self.vram = [0x20] * (self.width * self.height * 2)
+        self.top_row = 0 # кольцевой буфер строк
+        self.scrollback = deque(maxlen=scrollback_lines) if scrollback_lines else None
         self.cursor_x = 0
         self.cursor_y = 0
         self.attr = 0x07
@@ -17,6 +20,7 @@ class VideoController:
 
     def clear_screen(self):
         self.vram = [0x20, 0x07] * (self.width * self.height)
+        self.top_row = 0
         self.cursor_x = 0
         self.cursor_y = 0
 
@@ -29,13 +33,21 @@ class VideoController:
         }
         self.framebuffer = []
 
+    def row_offset(self, y):
+        return ((y + self.top_row) % self.height) * self.width * 2
+
     def new_line(self):
         self.cursor_y += 1
         self.cursor_x = 0
 
         if self.cursor_y >= self.height:
-            self.vram = self.vram[self.width*2:]
-            self.vram += [0x20, self.attr] * self.width
+            # вместо копирования всего экрана сдвигаем начало кольца
+            start = self.top_row * self.width * 2
+            end = start + self.width * 2
+            if self.scrollback is not None:
+                self.scrollback.append(self.vram[start:end])
+            self.vram[start:end] = [0x20, self.attr] * self.width
+            self.top_row = (self.top_row + 1) % self.height
             self.cursor_y = self.height - 1
 
     def put_char(self, char, attr=None):
@@ -49,7 +61,7 @@ class VideoController:
             self.cursor_x = 0
             return
 
-        pos = (self.cursor_y * self.width + self.cursor_x) * 2
+        pos = self.row_offset(self.cursor_y) + self.cursor_x * 2
         self.vram[pos] = ord(char)
         self.vram[pos+1] = attr
         self.cursor_x += 1
@@ -477,8 +489,9 @@ class PetyshCore16:
     def show_video_output(self):
         for y in range(self.vc.height):
             line = ''
+            base = self.vc.row_offset(y)
             for x in range(self.vc.width):
-                pos = (y * self.vc.width + x) * 2
+                pos = base + x * 2
                 line += chr(self.vc.vram[pos])
             print(line)
 
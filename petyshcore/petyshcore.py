@@ -1,14 +1,572 @@
 import os
+import re
+import copy
 import datetime
 import math
 import base64
 import sys
 import time
+import json
+import queue
+import struct
+import threading
+import weakref
+import zlib
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from collections import OrderedDict, deque, Counter
+try:
+    import numpy as np
+    from numba import njit
+except ImportError: # движок numba необязателен
+    np = None
+    njit = None
 
 IVT_SIZE = 256 # векторы
+HEAP_START = 0x1000 # куча DOS в параграфах: над первым 64К сегментом
+HEAP_END = 0xA000 # и до видеопамяти (640К)
+MCB_SIGNATURE = 0x4D
+PSP_SIZE = 0x100 # .COM грузится в PSP:0100
+COM_PARAGRAPHS = 0x1000 # .COM получает целый 64К сегмент
+DOS_FILE_NOT_FOUND = 0x02 # коды ошибок INT 21h (AX при CF=1)
+DOS_NOT_ENOUGH_MEMORY = 0x08
+
+# виртуальное время: такт ЦП = инструкция, частота как у PC/XT
+PIT_HZ = 1193182
+CPU_HZ = PIT_HZ * 4
+PIT_CYCLES = CPU_HZ // PIT_HZ # тактов ЦП на тик таймера
+VBLANK_CYCLES = CPU_HZ // 60
+TICKS_PER_DAY = 0x1800B0
+IRQ_BASE = 0x08 # IRQ0 -> INT 08h
+NEVER = float('inf')
+# простой гостя: хост спит до клавиши или до ближайшего события
+IDLE_POLLS = 4 # пустых INT 16h/01 подряд - гость ждёт клавишу
+IDLE_POLL_WINDOW = 256 # тактов между опросами, чтобы считаться тесным циклом
+IDLE_SPINS = 16 # повторов блока с тем же состоянием - холостой цикл
+IDLE_MAX_WAIT = 0.1 # сек, потолок одного сна хоста
+SHADOW_STACK_DEPTH = 256
+BREAKPOINT_OPCODE = 0xCC # ловушка на месте опкода, как INT3
+WATCH_PAGE_SHIFT = 8 # страницы по 256 байт для флагов наблюдения
+WATCH_READ = 0x01
+WATCH_WRITE = 0x02
+CHECKPOINT_INTERVAL = 100000 # инструкций между контрольными точками
+CHECKPOINT_PAGE_SHIFT = 12 # страницы по 4К для дельт памяти
+
+# что входит в контрольную точку, кроме памяти
+CPU_STATE = ('registers', 'interrupt_enabled', 'direction_flag', 'rep_prefix', 'timer_ticks', 'ivt',
+             'empty_polls', 'last_poll', 'dos_processes')
+SCHEDULER_STATE = ('events', 'cycles', 'sequence', 'cancelled')
+PIC_STATE = ('pending', 'mask', 'in_service', 'read_isr', 'init_words', 'need_icw4', 'vector_base')
+PIT_STATE = ('reload', 'latch', 'read_latch', 'started', 'event')
+KEYBOARD_STATE = ('keys', 'scancodes', 'data', 'full', 'script')
+VIDEO_STATE = ('vram', 'cursor_x', 'cursor_y', 'top_row', 'attr', 'video_mode', 'width', 'height')
+
+# таблица опкодов: мнемоника, операнды и обработчик op_*; по ней считается длина инструкции,
+# работают дизассемблер и execute
+# reg - байт регистра, imm8/port/rel8/flag - байт, addr/imm16 - 2 байта старшим вперёд,
+# word - 2 байта младшим вперёд, остальное - фиксированный операнд без байтов
+REG_NAMES = ('AX', 'BX', 'CX', 'DX')
+OPERAND_SIZES = {'reg': 1, 'imm8': 1, 'port': 1, 'rel8': 1, 'flag': 1, 'addr': 2, 'imm16': 2, 'word': 2}
+OPCODES = {
+    0x01: ('MOV', ('reg', 'imm16'), 'mov'), 0x02: ('ADD', ('reg', 'reg'), 'add'), 0x03: ('JMP', ('addr',), 'jmp'),
+    0x04: ('SUB', ('reg', 'reg'), 'sub'), 0x05: ('AND', ('reg', 'reg'), 'and'), 0x06: ('SHL', ('reg', 'imm8'), 'shl'),
+    0x07: ('OR', ('reg', 'reg'), 'or'), 0x08: ('XOR', ('reg', 'reg'), 'xor'), 0x09: ('NOT', ('reg',), 'not'),
+    0x0A: ('CMP', ('reg', 'reg'), 'cmp'), 0x0B: ('JE', ('addr',), 'je'), 0x0C: ('CALL', ('addr',), 'call'),
+    0x0D: ('RET', (), 'ret'), 0x0E: ('INC', ('reg',), 'inc'), 0x0F: ('DEC', ('reg',), 'dec'),
+    0x10: ('MUL', ('reg',), 'mul'), 0x11: ('DIV', ('reg',), 'div'), 0x12: ('LOOP', ('reg', 'rel8'), 'loop'),
+    0x13: ('CLI', ('flag',), 'interrupt_flag'), 0x14: ('JNE', ('addr',), 'jne'), 0x15: ('JG', ('addr',), 'jg'),
+    0x16: ('PUSH', ('SS',), 'push'), 0x17: ('TEST', ('reg', 'reg'), 'test'),
+    0x1B: ('JMP SHORT', ('rel8',), 'jmp_short'), 0x1C: ('JC', ('addr',), 'jc'), 0x1D: ('JNC', ('addr',), 'jnc'),
+    0x1E: ('MOV', ('[BX]', 'AX'), 'store'), 0x1F: ('MOV', ('AX', '[BX]'), 'load'),
+    0x20: ('ADC', ('reg', 'reg'), 'adc'), 0x21: ('SBB', ('reg', 'reg'), 'sbb'), 0x22: ('CLC', (), 'clc'),
+    0x23: ('STC', (), 'stc'), 0x24: ('LODSB', (), 'lodsb'), 0x25: ('STOSB', (), 'stosb'),
+    0x26: ('PUSHA', (), 'pusha'), 0x27: ('POPA', (), 'popa'),
+    0x28: ('ROL', ('reg', 'imm8'), 'rol'), 0x29: ('ROR', ('reg', 'imm8'), 'ror'),
+    0x50: ('PUSH', ('AX',), 'push'), 0x51: ('PUSH', ('CX',), 'push'), 0x52: ('PUSH', ('DX',), 'push'),
+    0x53: ('PUSH', ('BX',), 'push'), 0x54: ('PUSH', ('SP',), 'push'), 0x55: ('PUSH', ('BP',), 'push'),
+    0x56: ('PUSH', ('SI',), 'push'), 0x57: ('PUSH', ('DI',), 'push'),
+    0x58: ('POP', ('AX',), 'pop'), 0x59: ('POP', ('CX',), 'pop'), 0x5A: ('POP', ('DX',), 'pop'),
+    0x5B: ('POP', ('BX',), 'pop'), 0x5C: ('POP', ('SP',), 'pop'), 0x5D: ('POP', ('BP',), 'pop'),
+    0x5E: ('POP', ('SI',), 'pop'), 0x5F: ('POP', ('DI',), 'pop'),
+    0x70: ('GFX', ('imm8',), 'gfx'), 0x71: ('VECTOR_OP', ('imm8',), 'vector'), 0x8D: ('LEA', ('reg', 'imm16'), 'mov'),
+    0x9C: ('PUSHF', (), 'pushf'), 0x9D: ('POPF', (), 'popf'),
+    0xA4: ('MOVSB', (), 'movsb'), 0xA6: ('CMPSB', (), 'cmpsb'), 0xAE: ('SCASB', (), 'scasb'),
+    0xB8: ('MOV', ('AX', 'word'), 'mov'), 0xCC: ('INT3', (), 'int3'), 0xCD: ('INT', ('imm8',), 'int'),
+    0xE4: ('IN', ('AL', 'port'), 'in'), 0xE6: ('OUT', ('port', 'AL'), 'out'),
+    0xEC: ('IN', ('AL', 'DX'), 'in'), 0xEE: ('OUT', ('DX', 'AL'), 'out'), 0xF3: ('REP', (), 'rep'),
+    0xFC: ('CLD', (), 'cld'), 0xFD: ('STD', (), 'std'), 0xFF: ('HLT', (), 'hlt'),
+}
+OPCODE_TABLE = [OPCODES.get(opcode) for opcode in range(256)]
+INSTRUCTION_LENGTH = bytes(1 + sum(OPERAND_SIZES.get(kind, 0) for kind in entry[1]) if entry else 1
+                           for entry in OPCODE_TABLE)
+# после них поток управления уходит из линейной последовательности
+BLOCK_END_OPCODES = frozenset((0x03, 0x0B, 0x0C, 0x0D, 0x12, 0x14, 0x15, 0x1B, 0x1C, 0x1D, 0xCC, 0xCD, 0xFF))
+MAX_BLOCK_INSTRUCTIONS = 64
+
+def decode_instruction(memory, address, patches=None):
+    """(длина, текст, опкод) одной инструкции; patches - исходные байты под ловушками"""
+    opcode = memory[address]
+    if patches and address in patches:
+        opcode = patches[address]
+    entry = OPCODE_TABLE[opcode]
+    length = INSTRUCTION_LENGTH[opcode]
+    if entry is None or address + length > len(memory):
+        return 1, f"DB 0x{opcode:02X}", opcode
+    mnemonic, operands, _ = entry
+    parts = []
+    pos = address + 1
+    for kind in operands:
+        if kind == 'reg':
+            code = memory[pos]
+            parts.append(REG_NAMES[code] if code < 4 else f"R{code}")
+        elif kind == 'imm8' or kind == 'port':
+            parts.append(f"0x{memory[pos]:02X}")
+        elif kind == 'rel8':
+            # IP += offset - 2 после выборки всей инструкции
+            parts.append(f"0x{(address + length + memory[pos] - 2) & 0xFFFF:04X}")
+        elif kind == 'flag':
+            mnemonic = 'STI' if memory[pos] == 0x01 else 'CLI'
+        elif kind == 'addr' or kind == 'imm16':
+            parts.append(f"0x{(memory[pos] << 8) | memory[pos+1]:04X}")
+        elif kind == 'word':
+            parts.append(f"0x{memory[pos] | (memory[pos+1] << 8):04X}")
+        else:
+            parts.append(kind)
+        pos += OPERAND_SIZES.get(kind, 0)
+    return length, f"{mnemonic} {', '.join(parts)}" if parts else mnemonic, opcode
+
+class Disassembler:
+    """Линейная развёртка по таблице опкодов, результат кэшируется по базовым блокам"""
+    def __init__(self, memory, patches=None):
+        self.memory = memory
+        self.patches = patches if patches is not None else {}
+        self.blocks = {} # начало -> (байты блока, [(адрес, длина, текст)])
+
+    def block(self, start):
+        memory = self.memory
+        cached = self.blocks.get(start)
+        if cached is not None:
+            raw, lines = cached
+            # кэш сам себя проверяет: код мог быть перезаписан
+            if memory[start:start+len(raw)] == raw:
+                return lines
+        lines = []
+        address = start
+        limit = len(memory)
+        patches = self.patches
+        while address < limit:
+            length, text, opcode = decode_instruction(memory, address, patches)
+            lines.append((address, length, text))
+            address += length
+            if opcode in BLOCK_END_OPCODES or len(lines) >= MAX_BLOCK_INSTRUCTIONS:
+                break
+        self.blocks[start] = (bytes(memory[start:address]), lines)
+        return lines
+
+    def sweep(self, start, end=None):
+        """Ленивый генератор (адрес, длина, текст) по диапазону"""
+        end = len(self.memory) if end is None else min(end, len(self.memory))
+        address = start
+        while address < end:
+            for line in self.block(address):
+                if line[0] >= end:
+                    return
+                yield line
+            address = line[0] + line[1]
+
+def copy_fields(obj, names):
+    return {name: copy.copy(getattr(obj, name)) for name in names}
+
+def restore_fields(obj, fields):
+    for name, value in fields.items():
+        setattr(obj, name, copy.copy(value))
+
+# листинг NASM: номер строки, смещение, байты, исходник
+LISTING_LINE = re.compile(r'\s*\d+ (?:([0-9A-F]{8}) (\S+))?\s*(.*)')
+# map-файл NASM, раздел Symbols: Real, Virtual, Name
+MAP_LINE = re.compile(r'\s*([0-9A-Fa-f]+)\s+([0-9A-Fa-f]+)\s+(\S+)\s*$')
+LABEL = re.compile(r'([A-Za-z_.?][\w.?$@]*)(?::|\s+(?:db|dw|dd|dq|times|resb|resw)\b)')
+ORG = re.compile(r'\[?\s*org\s+(\w+)', re.IGNORECASE)
+KEY_BUFFER_SIZE = 64
+
+# раскладка US, скан-коды set 1: (первый код ряда, без Shift, с Shift)
+SCANCODE_ROWS = (
+    (0x02, '1234567890-=', '!@#$%^&*()_+'),
+    (0x10, 'qwertyuiop[]', 'QWERTYUIOP{}'),
+    (0x1E, "asdfghjkl;'`", 'ASDFGHJKL:"~'),
+    (0x2B, '\\zxcvbnm,./', '|ZXCVBNM<>?'),
+)
+SHIFT_MAKE = 0x2A
+# ESC-последовательности терминала -> скан-код расширенной клавиши (префикс 0xE0)
+ANSI_KEYS = {
+    '\x1b[A': 0x48, '\x1b[B': 0x50, '\x1b[C': 0x4D, '\x1b[D': 0x4B,
+    '\x1b[H': 0x47, '\x1b[F': 0x4F,
+}
+
+def build_scancode_table():
+    """символ -> (скан-код, Shift, ASCII для BIOS)"""
+    table = {
+        ' ': (0x39, False, 0x20), '\r': (0x1C, False, 0x0D), '\n': (0x1C, False, 0x0D),
+        '\t': (0x0F, False, 0x09), '\x08': (0x0E, False, 0x08), '\x7f': (0x0E, False, 0x08),
+        '\x1b': (0x01, False, 0x1B),
+    }
+    for first, plain, shifted in SCANCODE_ROWS:
+        for i, (low, high) in enumerate(zip(plain, shifted)):
+            table[low] = (first + i, False, ord(low))
+            table[high] = (first + i, True, ord(high))
+    for code in range(1, 27): # Ctrl+буква
+        table.setdefault(chr(code), (table[chr(code + 0x60)][0], False, code))
+    return table
+
+ASCII_SCANCODES = build_scancode_table()
+
+# именованные сегменты и их номера для быстрого пути read_memory/write_memory
+SEGMENT_NAMES = ('CODE', 'DATA', 'STACK', 'VIDEO')
+SEG_CODE, SEG_DATA, SEG_STACK, SEG_VIDEO = range(len(SEGMENT_NAMES))
+SEGMENT_IDS = {name: seg_id for seg_id, name in enumerate(SEGMENT_NAMES)}
+SEGMENT_REGISTERS = {'CS': SEG_CODE, 'DS': SEG_DATA, 'SS': SEG_STACK}
+SEGMENT_OF_ID = {seg_id: reg for reg, seg_id in SEGMENT_REGISTERS.items()}
+
+# дескриптор: limit 0-15, base 0-15, base 16-23, access, flags|limit 16-19, base 24-31
+DESCRIPTOR = struct.Struct('<HHBBBB')
+
+def make_descriptor(base, limit, access, flags=0x00):
+    return (limit & 0xFFFF, base & 0xFFFF, (base >> 16) & 0xFF, access,
+            (flags & 0xF0) | ((limit >> 16) & 0x0F), (base >> 24) & 0xFF)
+
+def decode_descriptor(raw):
+    limit_low, base_low, base_mid, access, flags, base_high = raw
+    limit = limit_low | ((flags & 0x0F) << 16)
+    if flags & 0x80: # гранулярность 4К
+        limit = (limit << 12) | 0xFFF
+    return (base_low | (base_mid << 16) | (base_high << 24), limit, access)
+GLYPH_CACHE_SIZE = 2048 # глифов в атласе
+
+# Базовый 8x16 шрифт: код символа -> 16 строк по 8 пикселей
+BASIC_FONT_GLYPHS = {
+    # Пробел (0x20)
+    0x20: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # ! (0x21)
+    0x21: (0x00, 0x00, 0x18, 0x3C, 0x3C, 0x3C, 0x18, 0x18, 0x18, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00),
+    # " (0x22)
+    0x22: (0x00, 0x66, 0x66, 0x66, 0x24, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # # (0x23)
+    0x23: (0x00, 0x00, 0x6C, 0x6C, 0xFE, 0x6C, 0x6C, 0x6C, 0xFE, 0x6C, 0x6C, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # $ (0x24)
+    0x24: (0x18, 0x18, 0x7C, 0xC6, 0xC2, 0xC0, 0x7C, 0x06, 0x06, 0x86, 0xC6, 0x7C, 0x18, 0x18, 0x00, 0x00),
+    # % (0x25)
+    0x25: (0x00, 0x00, 0x00, 0x00, 0xC2, 0xC6, 0x0C, 0x18, 0x30, 0x60, 0xC6, 0x86, 0x00, 0x00, 0x00, 0x00),
+    # & (0x26)
+    0x26: (0x00, 0x00, 0x38, 0x6C, 0x6C, 0x38, 0x76, 0xDC, 0xCC, 0xCC, 0xCC, 0x76, 0x00, 0x00, 0x00, 0x00),
+    # ' (0x27)
+    0x27: (0x00, 0x30, 0x30, 0x30, 0x60, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # ( (0x28)
+    0x28: (0x00, 0x00, 0x0C, 0x18, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x18, 0x0C, 0x00, 0x00, 0x00, 0x00),
+    # ) (0x29)
+    0x29: (0x00, 0x00, 0x30, 0x18, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x18, 0x30, 0x00, 0x00, 0x00, 0x00),
+    # * (0x2A)
+    0x2A: (0x00, 0x00, 0x00, 0x00, 0x00, 0x66, 0x3C, 0xFF, 0x3C, 0x66, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # + (0x2B)
+    0x2B: (0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x7E, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # , (0x2C)
+    0x2C: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x18, 0x30, 0x00, 0x00, 0x00),
+    # - (0x2D)
+    0x2D: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # . (0x2E)
+    0x2E: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00),
+    # / (0x2F)
+    0x2F: (0x00, 0x00, 0x00, 0x00, 0x02, 0x06, 0x0C, 0x18, 0x30, 0x60, 0xC0, 0x80, 0x00, 0x00, 0x00, 0x00),
+    # 0 (0x30)
+    0x30: (0x00, 0x00, 0x7C, 0xC6, 0xC6, 0xCE, 0xDE, 0xF6, 0xE6, 0xC6, 0xC6, 0x7C, 0x00, 0x00, 0x00, 0x00),
+    # 1 (0x31)
+    0x31: (0x00, 0x00, 0x18, 0x38, 0x78, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x7E, 0x00, 0x00, 0x00, 0x00),
+    # 2 (0x32)
+    0x32: (0x00, 0x00, 0x7C, 0xC6, 0x06, 0x0C, 0x18, 0x30, 0x60, 0xC0, 0xC6, 0xFE, 0x00, 0x00, 0x00, 0x00),
+    # 3 (0x33)
+    0x33: (0x00, 0x00, 0x7C, 0xC6, 0x06, 0x06, 0x3C, 0x06, 0x06, 0x06, 0xC6, 0x7C, 0x00, 0x00, 0x00, 0x00),
+    # 4 (0x34)
+    0x34: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00),
+    # 5 (0x35)
+    0x35: (0x00, 0x00, 0x7E, 0x60, 0x60, 0x7C, 0x06, 0x06, 0x06, 0x06, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # 6 (0x36)
+    0x36: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x7C, 0x60, 0x60, 0x60, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # 7 (0x37)
+    0x37: (0x00, 0x00, 0x7E, 0x06, 0x06, 0x0C, 0x0C, 0x18, 0x18, 0x30, 0x30, 0x30, 0x00, 0x00, 0x00, 0x00),
+    # 8 (0x38)
+    0x38: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # 9 (0x39)
+    0x39: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x3E, 0x06, 0x06, 0x06, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # : (0x3A)
+    0x3A: (0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # ; (0x3B)
+    0x3B: (0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x18, 0x18, 0x30, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # < (0x3C)
+    0x3C: (0x00, 0x00, 0x00, 0x06, 0x0C, 0x18, 0x30, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x00, 0x00, 0x00, 0x00),
+    # = (0x3D)
+    0x3D: (0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # > (0x3E)
+    0x3E: (0x00, 0x00, 0x00, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x0C, 0x18, 0x30, 0x60, 0x00, 0x00, 0x00, 0x00),
+    # ? (0x3F)
+    0x3F: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x0C, 0x18, 0x18, 0x18, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00),
+    # @ (0x40)
+    0x40: (0x00, 0x00, 0x3C, 0x42, 0x99, 0xA5, 0xA5, 0xA5, 0xA5, 0x9E, 0x40, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # A (0x41)
+    0x41: (0x00, 0x00, 0x18, 0x3C, 0x66, 0x66, 0x7E, 0x66, 0x66, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00),
+    # B (0x42)
+    0x42: (0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x00, 0x00, 0x00, 0x00),
+    # C (0x43)
+    0x43: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x60, 0x60, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # D (0x44)
+    0x44: (0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x00, 0x00, 0x00, 0x00),
+    # E (0x45)
+    0x45: (0x00, 0x00, 0x7E, 0x60, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00),
+    # F (0x46)
+    0x46: (0x00, 0x00, 0x7E, 0x60, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x60, 0x00, 0x00, 0x00, 0x00),
+    # G (0x47)
+    0x47: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x6E, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # H (0x48)
+    0x48: (0x00, 0x00, 0x66, 0x66, 0x66, 0x66, 0x7E, 0x66, 0x66, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00),
+    # I (0x49)
+    0x49: (0x00, 0x00, 0x3C, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # J (0x4A)
+    0x4A: (0x00, 0x00, 0x1E, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x6C, 0x6C, 0x38, 0x00, 0x00, 0x00, 0x00),
+    # K (0x4B)
+    0x4B: (0x00, 0x00, 0x66, 0x66, 0x6C, 0x6C, 0x78, 0x78, 0x6C, 0x6C, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00),
+    # L (0x4C)
+    0x4C: (0x00, 0x00, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00),
+    # M (0x4D)
+    0x4D: (0x00, 0x00, 0x63, 0x77, 0x7F, 0x6B, 0x6B, 0x6B, 0x63, 0x63, 0x63, 0x63, 0x00, 0x00, 0x00, 0x00),
+    # N (0x4E)
+    0x4E: (0x00, 0x00, 0x66, 0x66, 0x76, 0x76, 0x7E, 0x6E, 0x6E, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00),
+    # O (0x4F)
+    0x4F: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # P (0x50)
+    0x50: (0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x00, 0x00, 0x00, 0x00),
+    # Q (0x51)
+    0x51: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x6E, 0x6C, 0x36, 0x00, 0x00, 0x00, 0x00),
+    # R (0x52)
+    0x52: (0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x6C, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00),
+    # S (0x53)
+    0x53: (0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x38, 0x0C, 0x06, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # T (0x54)
+    0x54: (0x00, 0x00, 0x7E, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00),
+    # U (0x55)
+    0x55: (0x00, 0x00, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # [ (0x5B)
+    0x5B: (0x00, 0x00, 0x3C, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # \ (0x5C)
+    0x5C: (0x00, 0x00, 0x00, 0x80, 0xC0, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x03, 0x01, 0x00, 0x00, 0x00, 0x00),
+    # ] (0x5D)
+    0x5D: (0x00, 0x00, 0x3C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x3C, 0x00, 0x00, 0x00, 0x00),
+    # ^ (0x5E)
+    0x5E: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    # _ (0x5F)
+    0x5F: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00),
+    # ` (0x60)
+    0x60: (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+}
+
+_bit_expansion = None
+
+def bit_expansion():
+    """Таблица байт -> 8 пикселей (0/1), строится при первом обращении"""
+    global _bit_expansion
+    if _bit_expansion is None:
+        _bit_expansion = tuple(
+            bytes((byte >> (7 - col)) & 1 for col in range(8)) for byte in range(256)
+        )
+    return _bit_expansion
+
+class Font:
+    """Шрифт 8xN одним блобом: height байт на символ"""
+    __slots__ = ('data', 'width', 'height', 'count', '__weakref__')
+
+    def __init__(self, data, width=8, height=16):
+        self.data = bytes(data)
+        self.width = width
+        self.height = height
+        self.count = len(self.data) // height if height else 0
+
+    def __contains__(self, char_code):
+        return 0 <= char_code < self.count
+
+    def glyph(self, char_code):
+        start = char_code * self.height
+        return self.data[start:start + self.height]
+
+_font_pool = weakref.WeakValueDictionary() # одинаковые шрифты общие для всех ВМ
+
+def intern_font(data, width=8, height=16):
+    key = (bytes(data), width, height)
+    font = _font_pool.get(key)
+    if font is None:
+        font = Font(key[0], width, height)
+        _font_pool[key] = font
+    return font
+
+def build_font_blob(glyphs, height=16):
+    blob = bytearray(256 * height)
+    for code, rows in glyphs.items():
+        blob[code*height:(code+1)*height] = bytes(rows)
+    return bytes(blob)
+
+BASIC_FONT = intern_font(build_font_blob(BASIC_FONT_GLYPHS), 8, 16)
+
+# палитра DAC после сброса VGA, по 6 бит на канал
+VGA_EGA_COLORS = (
+    (0x00, 0x00, 0x00), (0x00, 0x00, 0x2A), (0x00, 0x2A, 0x00), (0x00, 0x2A, 0x2A),
+    (0x2A, 0x00, 0x00), (0x2A, 0x00, 0x2A), (0x2A, 0x15, 0x00), (0x2A, 0x2A, 0x2A),
+    (0x15, 0x15, 0x15), (0x15, 0x15, 0x3F), (0x15, 0x3F, 0x15), (0x15, 0x3F, 0x3F),
+    (0x3F, 0x15, 0x15), (0x3F, 0x15, 0x3F), (0x3F, 0x3F, 0x15), (0x3F, 0x3F, 0x3F),
+)
+VGA_GREYS = (0x00, 0x05, 0x08, 0x0B, 0x0E, 0x11, 0x14, 0x18, 0x1C, 0x20, 0x24, 0x28, 0x2D, 0x32, 0x38, 0x3F)
+# цветовой круг: 3 яркости x 3 насыщенности, от низкого уровня канала к высокому
+VGA_HUE_RAMPS = (
+    (0x00, 0x10, 0x1F, 0x2F, 0x3F), (0x1F, 0x27, 0x2D, 0x36, 0x3F), (0x2D, 0x31, 0x36, 0x3A, 0x3F),
+    (0x00, 0x07, 0x0E, 0x15, 0x1C), (0x0E, 0x11, 0x15, 0x18, 0x1C), (0x14, 0x16, 0x18, 0x1A, 0x1C),
+    (0x00, 0x04, 0x08, 0x0C, 0x10), (0x08, 0x0A, 0x0C, 0x0E, 0x10), (0x0B, 0x0C, 0x0D, 0x0F, 0x10),
+)
+
+def build_vga_palette():
+    colors = list(VGA_EGA_COLORS) + [(v, v, v) for v in VGA_GREYS]
+    for low, q1, mid, q3, high in VGA_HUE_RAMPS:
+        up = (low, q1, mid, q3)
+        down = (high, q3, mid, q1)
+        colors += [(v, low, high) for v in up] + [(high, low, v) for v in down]
+        colors += [(high, v, low) for v in up] + [(v, high, low) for v in down]
+        colors += [(low, high, v) for v in up] + [(low, v, high) for v in down]
+    colors += [(0, 0, 0)] * (256 - len(colors))
+    return tuple(tuple((c << 2) | (c >> 4) for c in rgb) for rgb in colors)
+
+VGA_PALETTE = build_vga_palette()
+
+# таблицы для вывода в терминал, считаются один раз при импорте
+CGA_TO_ANSI = (0, 4, 2, 6, 1, 5, 3, 7) # у CGA синий и красный поменяны местами
+CGA_TO_XTERM = tuple(CGA_TO_ANSI[i & 0x07] + (8 if i & 0x08 else 0) for i in range(16))
+
+def _text_attr_escape(attr):
+    fg = attr & 0x0F
+    bg = (attr >> 4) & 0x07
+    fg_code = (90 if fg & 0x08 else 30) + CGA_TO_ANSI[fg & 0x07]
+    return f"\x1b[{fg_code};{40 + CGA_TO_ANSI[bg]}m"
+
+TEXT_ATTR_ESCAPES = tuple(_text_attr_escape(attr) for attr in range(256))
+FG_256_ESCAPES = tuple(f"\x1b[38;5;{color}m" for color in range(256))
+BG_256_ESCAPES = tuple(f"\x1b[48;5;{color}m" for color in range(256))
+
+CP437_TO_UNICODE = (
+    " ☺☻♥♦♣♠•◘○◙♂♀♪♫☼►◄↕‼¶§▬↨↑↓→←∟↔▲▼"
+    + bytes(range(0x20, 0x7F)).decode('ascii') + "⌂"
+    + bytes(range(0x80, 0x100)).decode('cp437')
+)
+CP437_TRANSLATE = {code: char for code, char in enumerate(CP437_TO_UNICODE)}
+
+def encode_text_rows(vram, offsets, width):
+    """ANSI для текстового режима: escape только там, где меняется атрибут"""
+    escapes = TEXT_ATTR_ESCAPES
+    last_attr = -1
+    output = []
+    for base in offsets:
+        end = base + width * 2
+        text = bytes(vram[base:end:2]).decode('latin-1').translate(CP437_TRANSLATE)
+        attrs = vram[base+1:end:2]
+        line = []
+        start = 0
+        for x in range(width):
+            attr = attrs[x]
+            if attr != last_attr:
+                if x > start:
+                    line.append(text[start:x])
+                line.append(escapes[attr])
+                last_attr = attr
+                start = x
+        line.append(text[start:])
+        output.append(''.join(line))
+    return '\n'.join(output)
+
+def encode_color_cells(cells, glyph):
+    """ANSI для пар (fg, bg) по ячейкам: цвет выводится только при смене"""
+    fg_escapes = FG_256_ESCAPES
+    bg_escapes = BG_256_ESCAPES
+    last_fg = last_bg = -1
+    output = []
+    for row in cells:
+        line = []
+        run = 0
+        for fg, bg in row:
+            if fg != last_fg or bg != last_bg:
+                if run:
+                    line.append(glyph * run)
+                    run = 0
+                if fg != last_fg:
+                    line.append(fg_escapes[fg])
+                    last_fg = fg
+                if bg != last_bg:
+                    line.append(bg_escapes[bg])
+                    last_bg = bg
+            run += 1
+        if run:
+            line.append(glyph * run)
+        output.append(''.join(line))
+    return '\n'.join(output)
+
+class GlyphAtlas:
+    """LRU-кэш заранее растеризованных глифов"""
+    def __init__(self, capacity=GLYPH_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict() # (font, char_code, fg, bg) -> строки пикселей
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        rows = self.entries.get(key)
+        if rows is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return rows
+
+    def put(self, key, rows):
+        self.entries[key] = rows
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False) # выкидываем самый старый
+
+    def invalidate(self, font=None):
+        if font is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == font]:
+            del self.entries[key]
 
 class VideoController:
-    def __init__(self):
+    def __init__(self, scrollback_lines=0):
+        self.video_mode = 0x03
+        self.top_row = 0 # физическая строка, которая сейчас видна первой
+        self.scrollback = deque(maxlen=scrollback_lines) if scrollback_lines else None
+        self.fonts = {} # имя -> Font (общий объект из пула)
+        self.font = None
+        self.current_font = None
+        self.dirty_rects = []
+        self.glyph_atlas = GlyphAtlas()
+        self.cursor_shape = (0, 15)
+        self.active_page = 0
+        self.dac_palette = list(VGA_PALETTE)
+        self.palette_cache = None # упакованная палитра для захвата кадров
+        self.dac_read_index = 0
+        self.dac_write_index = 0
+        self.dac_component = 0 # какой из r, g, b следующий на 0x3C9
+        self.dac_rgb = [0, 0, 0]
+        self.dac_state = 0x00
+        self.crtc_registers = bytearray(25)
+        self.crtc_index = 0
+        self.capture = None
+        self.headless = False
+        self.vblank = False
+        self.blink_state = False
         self.set_video_mode(0x03)  # Инициализация текстового режима по умолчанию
         self.attr = 0x07  # Светло-серый на черном
         
@@ -17,23 +575,73 @@ class VideoController:
             self.width = 80
             self.height = 25
             self.vram = [0] * (self.width * self.height * 2)
-            self.cursor_x = 0
-            self.cursor_y = 0
-            self.clear_screen()
+        elif mode == 0x13:  # 320x200x256, байт на пиксель
+            self.width = 320
+            self.height = 200
+            self.vram = bytearray(self.width * self.height)
+        elif mode == 0x12:  # 640x480x16, два пикселя на байт
+            self.width = 640
+            self.height = 480
+            self.vram = bytearray(self.width * self.height // 2)
+        else:
+            return
+        self.video_mode = mode
+        self.cursor_x = 0
+        self.cursor_y = 0
+        self.glyph_atlas.invalidate() # формат пикселей поменялся
+        self.clear_screen()
             
+    def row_offset(self, y):
+        """Смещение логической строки y в кольцевом буфере текстового режима"""
+        row = y + self.top_row
+        if row >= self.height:
+            row -= self.height
+        return row * self.width * 2
+
+    def linear_vram(self):
+        """Текстовая видеопамять в логическом порядке строк"""
+        split = self.top_row * self.width * 2
+        return bytes(self.vram[split:]) + bytes(self.vram[:split])
+
+    def set_scrollback(self, lines):
+        self.scrollback = deque(self.scrollback or (), maxlen=lines) if lines else None
+
+    def get_scrollback(self):
+        if not self.scrollback:
+            return []
+        return [bytes(row[::2]).decode('latin-1').translate(CP437_TRANSLATE) for row in self.scrollback]
+
     def show_video_output(self):
-        output = []
-        for y in range(self.height):
-            line = []
-            for x in range(self.width):
-                pos = (y * self.width + x) * 2
-                char = self.vram[pos]
-                attr = self.vram[pos+1]
-                fg = 30 + (attr & 0x0F)
-                bg = 40 + ((attr >> 4) & 0x07)
-                line.append(f"\x1b[{fg};{bg}m{chr(char) if char else ' '}")
-            output.append(''.join(line))
-        print("\x1b[H" + "\n".join(output) + "\x1b[0m", end='', flush=True)
+        self.capture_frame()
+        if self.headless:
+            return
+        print("\x1b[H" + self.render() + "\x1b[0m", end='', flush=True)
+
+    def start_capture(self, path, image_format='ppm', queue_size=64):
+        self.stop_capture()
+        self.capture = FrameCapture(path, image_format, queue_size)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def capture_frame(self):
+        if self.capture is not None:
+            self.capture.submit(self)
+
+    def palette_bytes(self):
+        """DAC-палитра одним блобом r,g,b по 256 цветам"""
+        if self.palette_cache is None:
+            self.palette_cache = bytes(c & 0xFF for rgb in self.dac_palette for c in rgb)
+        return self.palette_cache
+
+    def render(self):
+        if self.video_mode == 0x13:
+            return self._render_256color_mode()
+        if self.video_mode == 0x12:
+            return self._render_16color_mode()
+        return self._render_text_mode()
 
     def put_char(self, char, attr):
         # Обработка специальных символов
@@ -49,7 +657,7 @@ class VideoController:
             return
             
         # Запись символа в видеопамять
-        pos = (self.cursor_y * self.width + self.cursor_x) * 2
+        pos = self.row_offset(self.cursor_y) + self.cursor_x * 2
         if pos + 1 < len(self.vram):
             self.vram[pos] = ord(char)
             self.vram[pos+1] = attr
@@ -58,13 +666,43 @@ class VideoController:
         if self.cursor_x >= self.width:
             self.new_line()
             
+    def read_char_attr(self):
+        pos = self.row_offset(self.cursor_y) + self.cursor_x * 2
+        return self.vram[pos], self.vram[pos+1]
+
+    def write_char_attr(self, char_code, attr, count=1):
+        x = self.cursor_x
+        y = self.cursor_y
+        for _ in range(count):
+            if y >= self.height:
+                break
+            pos = self.row_offset(y) + x * 2
+            self.vram[pos] = char_code
+            self.vram[pos+1] = attr
+            x += 1
+            if x >= self.width:
+                x = 0
+                y += 1
+
     def new_line(self):
         self.cursor_x = 0
         self.cursor_y += 1
         if self.cursor_y >= self.height:
-            self.vram = self.vram[self.width*2:] + [0]*(self.width*2)
+            self.scroll_text()
             self.cursor_y = self.height - 1
 
+    def scroll_text(self):
+        """Прокрутка на строку за O(1): верхняя строка кольца становится нижней"""
+        row_size = self.width * 2
+        start = self.top_row * row_size
+        if self.scrollback is not None:
+            self.scrollback.append(bytes(self.vram[start:start+row_size]))
+        self.vram[start:start+row_size] = b'\x20\x07' * self.width
+        self.top_row += 1
+        if self.top_row >= self.height:
+            self.top_row = 0
+        self.dirty_rects = [(0, 0, self.width, self.height)]
+
     def handle_int10(self, cpu):
         ah = (cpu.registers['AX'] >> 8) & 0xFF
         al = self.registers['AX'] & 0xFF
@@ -97,25 +735,26 @@ class VideoController:
             self.vram = bytearray([0x20, 0x07] * (self.width * self.height))
         else:
             self.vram = bytearray([0] * len(self.vram))
+        self.top_row = 0
         self.cursor_x = 0
         self.cursor_y = 0
         self.dirty_rects = [(0, 0, self.width, self.height)]
 
     def scroll_screen(self):
         if self.video_mode == 0x03:
-            self.vram = self.vram[self.width*2:] + bytearray([0x20, 0x07]*self.width)
+            self.scroll_text()
         else:
             self.vram = self.vram[self.width:] + bytearray([0]*self.width)
         self.cursor_y = max(0, self.height - 1)
         self.dirty_rects = [(0, 0, self.width, self.height)]
 
     def scroll(self):
-       self.vram = self.vram[self.width:] + [0x0720]*self.width
+       self.scroll_text()
        self.cursor_y = self.height - 1
 
     def get_display(self):
         return '\n'.join(
-            ''.join(chr(c & 0xFF) for c in self.vram[y*self.width:(y+1)*self.width])
+            ''.join(chr(c) for c in self.vram[self.row_offset(y):self.row_offset(y)+self.width*2:2])
             for y in range(self.height)
         )
             
@@ -193,68 +832,152 @@ class VideoController:
         self.framebuffer = []
 
     def get_display_output(self):
-        output = []
-        for y in range(25):
-            line = []
-            for x in range(80):
-                pos = (y * 80 + x) * 2
-                line.append(chr(self.video_memory[pos]))
-            output.append(''.join(line))
-        return '\n'.join(output)
-
-    def _render_text_mode(self):
         output = []
         for y in range(self.height):
             line = []
+            base = self.row_offset(y)
             for x in range(self.width):
-                pos = y * self.width * 2 + x * 2
-                char_code = self.vram[pos]
-                attr = self.vram[pos+1]
-                
-                # Упрощенная конвертация в ANSI
-                ansi = f"\x1b[{attr//16 + 40};{attr%16 + 30}m{chr(char_code)}"
-                line.append(ansi)
+                pos = base + x * 2
+                line.append(chr(self.vram[pos]))
             output.append(''.join(line))
         return '\n'.join(output)
 
+    def _render_text_mode(self):
+        offsets = [self.row_offset(y) for y in range(self.height)]
+        return encode_text_rows(self.vram, offsets, self.width)
+
     def _render_256color_mode(self):
-        output = []
+        # верхний пиксель - цвет символа, нижний - фон полублока
+        width = self.width
+        vram = self.vram
+        blank = bytes(width)
+        cells = []
         for y in range(0, self.height, 2):
-            line = []
-            for x in range(self.width):
-                top = self.vram[y * self.width + x]
-                bottom = self.vram[(y+1) * self.width + x] if y+1 < self.height else 0
-                line.append(f"\x1b[38;5;{top}m\x1b[48;5;{bottom}m▄")
-            output.append(''.join(line))
-        return '\n'.join(output)
+            top = vram[y*width:(y+1)*width]
+            bottom = vram[(y+1)*width:(y+2)*width] if y+1 < self.height else blank
+            cells.append(zip(top, bottom))
+        return encode_color_cells(cells, "▀")
 
     def _render_16color_mode(self):
-        output = []
-        for y in range(self.height):
-            line = []
-            for x in range(0, self.width, 2):
-                byte = self.vram[y * (self.width//2) + x//2]
-                fg = byte >> 4
-                bg = byte & 0x0F
-                line.append(f"\x1b[38;5;{fg}m\x1b[48;5;{bg}m▀")
-                output.append(''.join(line))
-        return '\n'.join(output)
+        xterm = CGA_TO_XTERM
+        stride = self.width // 2
+        vram = self.vram
+        cells = (
+            [(xterm[byte >> 4], xterm[byte & 0x0F]) for byte in vram[y*stride:(y+1)*stride]]
+            for y in range(self.height)
+        )
+        return encode_color_cells(cells, "▀")
 
     def write_crtc_register(self, index, value):
         if index < len(self.crtc_registers):
             self.crtc_registers[index] = value
+
+    def read_crtc_port(self, port):
+        if port == 0x3D4:
+            return self.crtc_index
+        return self.crtc_registers[self.crtc_index] if self.crtc_index < len(self.crtc_registers) else 0xFF
+
+    def write_crtc_port(self, port, value):
+        if port == 0x3D4:
+            self.crtc_index = value
+        else:
+            self.write_crtc_register(self.crtc_index, value)
+
+    def read_dac_port(self, port):
+        if port != 0x3C9:
+            return self.dac_state
+        value = self.dac_palette[self.dac_read_index][self.dac_component] >> 2
+        self.dac_component += 1
+        if self.dac_component == 3:
+            self.dac_component = 0
+            self.dac_read_index = (self.dac_read_index + 1) & 0xFF
+        return value
+
+    def write_dac_port(self, port, value):
+        # 0x3C7 - индекс чтения, 0x3C8 - индекс записи, 0x3C9 - r, g, b по 6 бит
+        if port == 0x3C7:
+            self.dac_read_index = value
+            self.dac_component = 0
+            self.dac_state = 0x00
+        elif port == 0x3C8:
+            self.dac_write_index = value
+            self.dac_component = 0
+            self.dac_state = 0x03
+        else:
+            value &= 0x3F
+            self.dac_rgb[self.dac_component] = (value << 2) | (value >> 4)
+            self.dac_component += 1
+            if self.dac_component == 3:
+                self.dac_component = 0
+                self.set_dac_color(self.dac_write_index, *self.dac_rgb)
+                self.dac_write_index = (self.dac_write_index + 1) & 0xFF
                 
     def set_dac_color(self, index, r, g, b):
         self.dac_palette[index] = (r, g, b)
+        self.palette_cache = None
             
     def handle_vblank(self):
         self.vblank = True
         self.blink_state = not self.blink_state
             
+    def load_font(self, name, font_data, width=8, height=16):
+        """Загрузка шрифта в память"""
+        self.fonts[name] = intern_font(font_data, width, height)
+        self.glyph_atlas.invalidate(name)
+        if self.font is None or self.current_font == name:
+            self.set_font(name)
+
+    def set_font(self, name):
+        if name not in self.fonts:
+            return False
+        self.current_font = name
+        self.font = self.fonts[name]
+        return True
+
+    def rasterize_glyph(self, char_code, fg, bg):
+        """Растеризация глифа в готовые строки видеопамяти"""
+        expand = bit_expansion()
+        lut = bytes((bg & 0xFF, fg & 0xFF)) + bytes(254) # 0 -> фон, 1 -> цвет
+        rows = []
+        for bits in self.font.glyph(char_code):
+            pixels = expand[bits].translate(lut)
+            if self.video_mode == 0x12:
+                # пакуем по два пикселя в байт, как в draw_pixel
+                rows.append(bytes(((pixels[i] & 0x0F) << 4) | (pixels[i+1] & 0x0F) for i in range(0, 8, 2)))
+            else:
+                rows.append(pixels)
+        return tuple(rows)
+
+    def blit_glyph(self, x, y, char_code, fg, bg):
+        key = (self.current_font, char_code, fg, bg)
+        rows = self.glyph_atlas.get(key)
+        if rows is None:
+            rows = self.rasterize_glyph(char_code, fg, bg)
+            self.glyph_atlas.put(key, rows)
+
+        if self.video_mode == 0x13:
+            stride = self.width
+            pos = y * stride + x
+            span = 8
+        else:
+            stride = self.width // 2
+            pos = y * stride + x // 2
+            span = 4
+        vram = self.vram
+        for row in rows:
+            vram[pos:pos+span] = row # одна строка глифа за один срез
+            pos += stride
+        self.dirty_rects.append((x, y, 8, len(rows)))
+
     def draw_glyph(self, x, y, char_code, fg, bg):
         if self.font and char_code in self.font:
-            for row in range(16):
-                bits = self.font[char_code][row]
+            if (self.video_mode == 0x13 or (self.video_mode == 0x12 and x % 2 == 0)) \
+                    and 0 <= x and x + 8 <= self.width and 0 <= y and y + self.font.height <= self.height:
+                self.blit_glyph(x, y, char_code, fg, bg)
+                return
+            expand = bit_expansion()
+            for row, byte in enumerate(self.font.glyph(char_code)):
+                bits = expand[byte]
                 for col in range(8):
                     if bits[col]:
                         self.draw_pixel(x + col, y + row, fg)
@@ -265,229 +988,3466 @@ class VideoController:
             self.draw_pixel(x+1, y, fg)
             self.draw_pixel(x, y+1, fg)
             self.draw_pixel(x+1, y+1, fg)
+
+    def draw_string(self, x, y, text, fg, bg):
+        for char in text:
+            self.draw_glyph(x, y, ord(char) & 0xFF, fg, bg)
+            x += 8
                        
     def get_ascii_output(self):
         output = []
         for y in range(self.height):
             line = []
+            base = self.row_offset(y)
             for x in range(self.width):
-                pos = (y * self.width + x) * 2
+                pos = base + x * 2
                 char_code = self.vram[pos]
                 line.append(chr(char_code) if 32 <= char_code < 127 else ' ')
             output.append(''.join(line))
         return '\n'.join(output)
 
-class PetyshCore16:
-    def __init__(self):
-        self.video_output = None
-        self.vc = VideoController()  # ммм ютубчик
-        self.keyboard_buffer = [] # клава
-        self.disk_data = {0: b"Boot sector"} # типо диск
-        self.timer_ticks = 0
-        self.rtc_time = datetime.datetime.now()
-        self.interrupt_enabled = True
-        self.debug_mode = False
-        self.breakpoints = set()
-        self.os_loaded = False
-        self.programs_dir = "programs/"
-        self.gpu_accelerated = False
-        self.ports = [0] * 65536 # 64KB
-        self.ports[0x60] = 0 # клава (НЕ БУФЕР)
-        self.memory = [0x00] * 1048576
-        self.load_basic_font()
-        self.vc.set_video_mode(0x03)
-        self.video_functions = {
-            0x10: self.handle_video_interrupt,
-            0x11: self.handle_font_interrupt
-        }
-        self.video_modes = {
-            0x13: (40, 25, 16),    # Текстовый режим
-            0x5A: (80, 50, 256),   # Псевдографический
-            0x5B: (160, 100, 65536) # RGB режим
+class FrameCapture:
+    """Запись кадров на диск из фонового потока: графика в PPM/PNG, текст в asciicast v2"""
+    def __init__(self, path, image_format='ppm', queue_size=64):
+        if image_format not in ('ppm', 'png'):
+            raise ValueError(f"Unknown capture format: {image_format}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.image_format = image_format
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.start_time = time.monotonic()
+        self.last_frame = None
+        self.frames = 0
+        self.images = 0
+        self.dropped = 0
+        self.cast = None
+        self.thread = threading.Thread(target=self.writer_loop, name="frame-capture", daemon=True)
+        self.thread.start()
+
+    def submit(self, vc):
+        """Снимок кадра в потоке CPU; одинаковые кадры подряд пропускаются"""
+        if not self.thread.is_alive():
+            self.dropped += 1 # писатель умер - кадры некуда девать
+            return
+        if vc.video_mode == 0x03:
+            frame = (0x03, vc.width, vc.height, vc.linear_vram(), None)
+        else:
+            frame = (vc.video_mode, vc.width, vc.height, bytes(vc.vram), vc.palette_bytes())
+        if frame == self.last_frame:
+            return
+        self.last_frame = frame
+        try:
+            self.queue.put_nowait((time.monotonic() - self.start_time, frame))
+        except queue.Full:
+            self.dropped += 1 # CPU никогда не ждёт диск
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.cast:
+            self.cast.close()
+            self.cast = None
+
+    def writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            elapsed, (mode, width, height, data, palette) = item
+            try:
+                if mode == 0x03:
+                    self.write_text_frame(elapsed, width, height, data)
+                else:
+                    self.write_image_frame(mode, width, height, data, palette)
+                self.frames += 1
+            except Exception as e: # поток должен дожить до close(), иначе он повиснет на очереди
+                print(f"\x1b[31mCapture error: {e}\x1b[0m")
+
+    def write_text_frame(self, elapsed, width, height, data):
+        if self.cast is None:
+            self.cast = open(os.path.join(self.path, "session.cast"), "w", encoding="utf-8")
+            header = {'version': 2, 'width': width, 'height': height, 'timestamp': int(time.time())}
+            self.cast.write(json.dumps(header) + "\n")
+        screen = encode_text_rows(data, range(0, width * height * 2, width * 2), width)
+        self.cast.write(json.dumps([round(elapsed, 6), "o", "\x1b[H" + screen + "\x1b[0m"]) + "\n")
+        self.cast.flush()
+
+    def write_image_frame(self, mode, width, height, data, palette):
+        if mode == 0x12:
+            # распаковка: старший полубайт - левый пиксель
+            pixels = bytearray(len(data) * 2)
+            pixels[0::2] = data.translate(bytes(b >> 4 for b in range(256)))
+            pixels[1::2] = data.translate(bytes(b & 0x0F for b in range(256)))
+        else:
+            pixels = data
+        rgb = bytearray(len(pixels) * 3)
+        for channel in range(3):
+            rgb[channel::3] = pixels.translate(palette[channel::3])
+        name = os.path.join(self.path, f"frame_{self.images:06d}.{self.image_format}")
+        self.images += 1
+        with open(name, "wb") as f:
+            if self.image_format == 'png':
+                f.write(encode_png(width, height, rgb))
+            else:
+                f.write(b"P6\n%d %d\n255\n" % (width, height))
+                f.write(rgb)
+
+def encode_png(width, height, rgb):
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    stride = width * 3
+    raw = b''.join(b'\x00' + bytes(rgb[y*stride:(y+1)*stride]) for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6))
+            + chunk(b'IEND', b''))
+
+# целые байты битсета: все 8 байт памяти заняты или все свободны
+FULL_BYTES = re.compile(rb'\xff+')
+EMPTY_BYTES = re.compile(rb'\x00+')
+
+class MemoryMap:
+    """Карта занятой памяти: упакованный битсет, бит на байт адресного пространства"""
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.bits = bytearray((size + 7) >> 3)
+        self.used = 0 # занятых байт, обновляется при каждой операции
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, addr):
+        return bool((self.bits[addr >> 3] >> (addr & 7)) & 1)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.size)
+        else:
+            start, stop = key, key + 1
+        self.fill(start, stop, bool(value))
+
+    def set_range(self, start, end):
+        self.fill(start, end, True)
+
+    def clear_range(self, start, end):
+        self.fill(start, end, False)
+
+    def fill(self, start, end, value):
+        start = max(0, start)
+        end = min(self.size, end)
+        if start >= end:
+            return
+        bits = self.bits
+        first = start >> 3
+        last = (end - 1) >> 3
+        before = int.from_bytes(bits[first:last+1], 'little').bit_count()
+        head = 0xFF ^ ((1 << (start & 7)) - 1)
+        tail = (1 << (end - (last << 3))) - 1
+        if first == last:
+            self.apply_mask(first, head & tail, value)
+        else:
+            self.apply_mask(first, head, value)
+            self.apply_mask(last, tail, value)
+            if last - first > 1:
+                # середина целыми байтами одним срезом
+                bits[first+1:last] = (b'\xff' if value else b'\x00') * (last - first - 1)
+        self.used += int.from_bytes(bits[first:last+1], 'little').bit_count() - before
+
+    def apply_mask(self, index, mask, value):
+        if value:
+            self.bits[index] |= mask
+        else:
+            self.bits[index] &= ~mask & 0xFF
+
+    def fragmentation(self):
+        """Отчёт о свободных участках"""
+        bits = self.bits
+        count = len(bits)
+        runs = []
+        run = index = 0
+        while index < count:
+            byte = bits[index]
+            if byte == 0x00:
+                # целые свободные байты пропускаются одним поиском
+                end = EMPTY_BYTES.match(bits, index).end()
+                run += (end - index) << 3
+                index = end
+            elif byte == 0xFF:
+                if run:
+                    runs.append(run)
+                    run = 0
+                index = FULL_BYTES.match(bits, index).end()
+            else:
+                # по битам только краевой байт
+                for bit in range(8):
+                    if (byte >> bit) & 1:
+                        if run:
+                            runs.append(run)
+                            run = 0
+                    else:
+                        run += 1
+                index += 1
+        run -= (count << 3) - self.size # хвост последнего байта за пределами карты
+        if run > 0:
+            runs.append(run)
+        free = self.size - self.used
+        largest = max(runs, default=0)
+        return {
+            'used': self.used,
+            'free': free,
+            'free_runs': len(runs),
+            'largest_free': largest,
+            'fragmentation': 1 - largest / free if free else 0.0,
         }
-        # 16-битные регистры
-        self.registers = {
-            'AX': 0x0000,
-            'BX': 0x0000,
-            'CX': 0x0000,
-            'DX': 0x0000,
-            'IP': 0x0000,
-            'SP': 0xFFFF,
-            'FLAGS': 0b00000000
+
+class DosAllocator:
+    """Куча DOS по параграфам: список свободных участков, first-fit и слияние при освобождении"""
+    def __init__(self, memory, start=HEAP_START, end=HEAP_END, memory_map=None):
+        self.memory = memory
+        self.memory_map = memory_map
+        self.start = start
+        self.end = end
+        self.free_starts = [start] # отсортированные начала свободных участков
+        self.free_sizes = {start: end - start}
+        self.blocks = {} # сегмент данных -> размер в параграфах
+        self.total = end - start
+        self.used = 0 # вместе с MCB
+
+    def allocate(self, paragraphs):
+        need = paragraphs + 1 # +1 параграф под MCB
+        free_starts = self.free_starts
+        for i, start in enumerate(free_starts):
+            size = self.free_sizes[start]
+            if size < need:
+                continue
+            del self.free_sizes[start]
+            if size == need:
+                del free_starts[i]
+            else:
+                free_starts[i] = start + need # порядок списка не меняется
+                self.free_sizes[start + need] = size - need
+            self.used += need
+            if self.memory_map is not None:
+                self.memory_map.set_range(start << 4, (start + need) << 4)
+            self.write_mcb(start, paragraphs)
+            self.blocks[start + 1] = paragraphs
+            return start + 1
+        return None
+
+    def free(self, segment):
+        paragraphs = self.blocks.pop(segment, None)
+        if paragraphs is None:
+            return False
+        start = segment - 1
+        size = paragraphs + 1
+        self.used -= size
+        if self.memory_map is not None:
+            self.memory_map.clear_range(start << 4, (start + size) << 4)
+        self.memory[(start << 4) + 2] = 0x00 # MCB больше не действителен
+
+        free_starts = self.free_starts
+        free_sizes = self.free_sizes
+        i = bisect_left(free_starts, start)
+        if i < len(free_starts) and free_starts[i] == start + size:
+            # сливаемся с правым соседом
+            size += free_sizes.pop(free_starts[i])
+            del free_starts[i]
+        if i > 0 and free_starts[i-1] + free_sizes[free_starts[i-1]] == start:
+            # и с левым
+            free_sizes[free_starts[i-1]] += size
+        else:
+            free_starts.insert(i, start)
+            free_sizes[start] = size
+        return True
+
+    def write_mcb(self, start, paragraphs):
+        addr = start << 4
+        self.memory[addr] = paragraphs & 0xFF
+        self.memory[addr+1] = (paragraphs >> 8) & 0xFF
+        self.memory[addr+2] = MCB_SIGNATURE
+
+    def largest_free(self):
+        largest = max(self.free_sizes.values(), default=0)
+        return max(0, largest - 1)
+
+class Profiler:
+    """Профиль исполнения: опкоды (счёт и время хоста), хиты по IP в array, векторы прерываний, рендер"""
+    def __init__(self, address_space=1 << 20):
+        self.address_mask = address_space - 1
+        self.opcode_counts = array('Q', bytes(8 * 256))
+        self.opcode_ns = array('Q', bytes(8 * 256))
+        self.ip_hits = array('I', bytes(4 * address_space))
+        self.vector_counts = array('Q', bytes(8 * IVT_SIZE))
+        self.vector_ns = array('Q', bytes(8 * IVT_SIZE))
+        self.render_ns = 0
+        self.frames = 0
+        self.started = time.perf_counter_ns()
+
+    def record(self, opcode, ip, elapsed):
+        self.opcode_counts[opcode] += 1
+        self.opcode_ns[opcode] += elapsed
+        self.ip_hits[ip & self.address_mask] += 1
+
+    def record_vector(self, int_num, elapsed):
+        self.vector_counts[int_num] += 1
+        self.vector_ns[int_num] += elapsed
+
+    def record_frame(self, elapsed):
+        self.frames += 1
+        self.render_ns += elapsed
+
+    def hot_spots(self, n=10):
+        hits = self.ip_hits
+        return [(ip, hits[ip]) for ip in heapq.nlargest(n, range(len(hits)), key=hits.__getitem__) if hits[ip]]
+
+    def report(self, top=10):
+        exec_ns = sum(self.opcode_ns)
+        counts = self.opcode_counts
+        opcodes = sorted((op for op in range(256) if counts[op]), key=self.opcode_ns.__getitem__, reverse=True)
+        return {
+            'wall_ms': (time.perf_counter_ns() - self.started) / 1e6,
+            'instructions': sum(counts),
+            'exec_ms': exec_ns / 1e6,
+            'render_ms': self.render_ns / 1e6,
+            'frames': self.frames,
+            'opcodes': [{'opcode': f"{op:02X}", 'count': counts[op], 'ms': self.opcode_ns[op] / 1e6}
+                        for op in opcodes[:top]],
+            'hot_ips': [{'ip': f"{ip:05X}", 'hits': hits} for ip, hits in self.hot_spots(top)],
+            'vectors': [{'vector': f"{n:02X}", 'count': self.vector_counts[n], 'ms': self.vector_ns[n] / 1e6}
+                        for n in range(IVT_SIZE) if self.vector_counts[n]],
         }
 
-        self.registers.update({
-            'CS': 0x0000,
-            'DS': 0x0000,
-            'ES': 0x0000,
-            'SS': 0x0000,
-            'SI': 0x0000,
-            'DI': 0x0000,
-            'BP': 0x0000,
-        })
-        
-        self.rep_prefix = False
-        self.direction_flag = False
-        self.reg_names = ['AX', 'BX', 'CX', 'DX']
+    def to_json(self, top=10):
+        return json.dumps(self.report(top), indent=2)
 
-        self.ivt = [0x0000] * IVT_SIZE # каждая запись
-        self.memory = [0x00] * 1048576 # 1мб
-        self.memory_map = [False] * 65536 # карта занятой памяти
-        self.memory_map[0x0000:0x0400] = [True]*0x0400 # ivt
-        self.memory_blocks = {} # блоки памяти (выделенной)
-        self.current_mcb = 0x0000 # memory control block
-        
-        self.gdt = [
-            {'base': 0, 'limit': 0, 'access': 0x00},  # Нулевой дескриптор
-            {'base': 0, 'limit': 0xFFFFF, 'access': 0x9A},  # Код сегмент
-            {'base': 0, 'limit': 0xFFFFF, 'access': 0x92}   # Данные сегмент
-        ]
-        self.ldt = []
-        self.gdtr = {'base': 0, 'limit': 0}
-        self.ldtr = 0
-        
-        self.commands = {
-            'help': self.cmd_help,
-            'cls': self.cmd_cls,
-            'run': self.cmd_run,
-            'list': self.cmd_list,
-            'meminfo': self.cmd_meminfo,
-            'edit': self.cmd_edit
+class SymbolTable:
+    """Метки гостя по адресам из листинга (nasm -l) или map-файла NASM"""
+    def __init__(self):
+        self.addresses = []
+        self.names = []
+
+    def add(self, address, name):
+        i = bisect_right(self.addresses, address)
+        self.addresses.insert(i, address)
+        self.names.insert(i, name)
+
+    def lookup(self, address):
+        i = bisect_right(self.addresses, address) - 1
+        return self.names[i] if i >= 0 else f"{address:05X}"
+
+    def function(self, address):
+        # локальная метка .done относится к своей функции
+        return self.lookup(address).split('.', 1)[0]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith('.asm'):
+            return cls.from_listing(assemble_listing(path))
+        with open(path, encoding='latin-1') as f:
+            text = f.read()
+        if 'Real' in text and 'Virtual' in text:
+            return cls.from_map(text)
+        return cls.from_listing(text)
+
+    @classmethod
+    def from_map(cls, text):
+        table = cls()
+        in_symbols = False
+        for line in text.splitlines():
+            if line.lstrip().startswith('Real'):
+                in_symbols = 'Name' in line
+                continue
+            match = MAP_LINE.match(line) if in_symbols else None
+            if match:
+                table.add(int(match.group(1), 16), match.group(3))
+        return table
+
+    @classmethod
+    def from_listing(cls, text):
+        table = cls()
+        org = 0
+        scope = ''
+        pending = [] # метки без байтов, получат смещение следующей строки с кодом
+        for line in text.splitlines():
+            match = LISTING_LINE.match(line)
+            if not match:
+                continue
+            offset, _, source = match.groups()
+            source = source.split(';', 1)[0].strip()
+            org_match = ORG.match(source)
+            if org_match:
+                org = int(org_match.group(1), 0)
+                continue
+            label = LABEL.match(source)
+            if label:
+                name = label.group(1)
+                if name.startswith('.'):
+                    name = scope + name
+                else:
+                    scope = name
+                pending.append(name)
+            if offset and pending:
+                for name in pending:
+                    table.add(org + int(offset, 16), name)
+                pending = []
+        return table
+
+def assemble_listing(path):
+    """Листинг через nasm, если он есть: исходник сам по себе адресов не знает"""
+    import shutil, subprocess, tempfile
+    nasm = shutil.which('nasm')
+    if nasm is None:
+        raise RuntimeError("nasm not found, pass a listing (nasm -l) or map file instead")
+    with tempfile.TemporaryDirectory() as tmp:
+        listing = os.path.join(tmp, 'out.lst')
+        subprocess.run([nasm, '-f', 'bin', '-l', listing, '-o', os.path.join(tmp, 'out.bin'), path], check=True)
+        with open(listing, encoding='latin-1') as f:
+            return f.read()
+
+class SamplingProfiler:
+    """Сэмплы CS:IP раз в N инструкций (событие планировщика) или раз в X мс (поток-таймер),
+    стеки из теневого стека CALL/RET, вывод в collapsed-формате для flamegraph"""
+    def __init__(self, cpu, every=10000, period_ms=None, symbols=None):
+        self.cpu = cpu
+        self.every = every
+        self.period = period_ms / 1000 if period_ms else None
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.shadow = [] # линейные адреса возврата
+        self.stacks = Counter() # кортеж адресов -> сэмплов, символы только при выводе
+        self.samples = 0
+        self.due = False
+        self.running = False
+        self.event = None
+        self.timer = None
+
+    def start(self):
+        self.running = True
+        if self.period:
+            self.timer = threading.Thread(target=self.timer_loop, daemon=True)
+            self.timer.start()
+        else:
+            self.event = self.cpu.scheduler.schedule(self.every, self.tick)
+
+    def stop(self):
+        self.running = False
+        if self.event is not None:
+            self.cpu.scheduler.cancel(self.event)
+            self.event = None
+        if self.timer is not None:
+            self.timer.join()
+            self.timer = None
+
+    def tick(self, when):
+        self.event = self.cpu.scheduler.schedule_at(when + self.every, self.tick)
+        self.sample()
+
+    def timer_loop(self):
+        while self.running:
+            time.sleep(self.period)
+            self.due = True
+            self.cpu.request_service()
+
+    def sample(self):
+        self.due = False
+        registers = self.cpu.registers
+        self.stacks[tuple(self.shadow) + ((registers['CS'] << 4) + registers['IP'],)] += 1
+        self.samples += 1
+
+    def call(self, return_address):
+        shadow = self.shadow
+        if len(shadow) >= SHADOW_STACK_DEPTH:
+            del shadow[0]
+        shadow.append(return_address)
+
+    def ret(self):
+        if self.shadow:
+            self.shadow.pop()
+
+    def collapsed(self):
+        function = self.symbols.function
+        folded = Counter()
+        for stack, count in self.stacks.items():
+            folded[';'.join(function(address) for address in stack)] += count
+        return folded
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.collapsed().items()):
+                f.write(f"{stack} {count}\n")
+
+class Checkpoint:
+    __slots__ = ('time', 'state', 'undo')
+
+    def __init__(self, time, state, undo):
+        self.time = time # сколько инструкций выполнено к моменту снимка
+        self.state = state # регистры и устройства
+        self.undo = undo # страница -> содержимое на предыдущей контрольной точке
+
+class TimeTravel:
+    """Запись для обратной отладки: контрольные точки раз в N инструкций с грязными страницами,
+    шаг назад - откат к ближайшей точке и повтор вперёд"""
+    def __init__(self, cpu, interval=CHECKPOINT_INTERVAL):
+        self.cpu = cpu
+        self.interval = interval
+        self.checkpoints = []
+        self.position = -1 # контрольная точка, которой соответствует shadow
+        self.shadow = bytearray(cpu.memory) # память на момент точки position
+        self.hits = [] # такты срабатываний точек останова и наблюдения
+        self.inputs = [] # (такт, где, текст): ввод хоста, без него повтор разойдётся с записью
+        self.replay = {} # (такт, где) -> текст на время повтора
+
+    def start(self):
+        self.capture(self.cpu.scheduler.cycles, {})
+        self.cpu.scheduler.schedule(self.interval, self.tick)
+
+    def stop(self):
+        # после отката в очереди тик из контрольной точки с другим номером
+        self.cpu.scheduler.cancel_callback(self.tick)
+
+    def log_input(self, where, text):
+        time = self.cpu.scheduler.cycles
+        self.inputs.append((time, where, text))
+        self.forget(time)
+
+    def resume(self):
+        """Живое выполнение: ввод, записанный дальше текущего такта, уже не наступит"""
+        now = self.cpu.scheduler.cycles
+        inputs = self.inputs
+        if inputs and inputs[-1][0] > now:
+            index = bisect_right([time for time, _, _ in inputs], now)
+            self.forget(inputs[index][0])
+            del inputs[index:]
+
+    def forget(self, time):
+        # контрольные точки с такта time сняты при другом вводе
+        index = bisect_left([checkpoint.time for checkpoint in self.checkpoints], time)
+        del self.checkpoints[max(index, self.position + 1):]
+
+    def prepare_replay(self, start, end):
+        """Ввод на (start, end] для повтора; вернуть события, будящие цикл на границах с вводом"""
+        scheduler = self.cpu.scheduler
+        self.replay = {(time, where): text for time, where, text in self.inputs if start < time <= end}
+        return [scheduler.schedule_at(time, self.wake) for time in sorted({time for time, where in self.replay
+                                                                         if where == 'service'})]
+
+    def wake(self, when):
+        pass # ввод подаст service_devices этого такта
+
+    def dirty_pages(self):
+        size = 1 << CHECKPOINT_PAGE_SHIFT
+        memory = memoryview(self.cpu.memory)
+        shadow = memoryview(self.shadow)
+        return [start for start in range(0, len(memory), size)
+                if memory[start:start+size] != shadow[start:start+size]]
+
+    def tick(self, when):
+        self.cpu.scheduler.schedule_at(when + self.interval, self.tick)
+        # событие срабатывает в начале такта when, выполнено when - 1 инструкций
+        time = when - 1
+        size = 1 << CHECKPOINT_PAGE_SHIFT
+        undo = {}
+        for start in self.dirty_pages():
+            undo[start] = bytes(self.shadow[start:start+size])
+            self.shadow[start:start+size] = self.cpu.memory[start:start+size]
+        following = self.position + 1
+        if following < len(self.checkpoints) and self.checkpoints[following].time == time:
+            self.position = following # повтор прошёл через уже записанную точку
+            return
+        del self.checkpoints[following:]
+        self.capture(time, undo)
+
+    def capture(self, time, undo):
+        cpu = self.cpu
+        state = {
+            'cpu': copy_fields(cpu, CPU_STATE),
+            'scheduler': copy_fields(cpu.scheduler, SCHEDULER_STATE),
+            'pic': copy_fields(cpu.pic, PIC_STATE),
+            'pit': copy_fields(cpu.pit, PIT_STATE),
+            'keyboard': copy_fields(cpu.keyboard, KEYBOARD_STATE),
+            'video': copy_fields(cpu.vc, VIDEO_STATE),
         }
-        self.prompt = "\x1b[32mPCI1~$\x1b[0m "
-        self.history = []
+        state['scheduler']['cycles'] = time
+        self.checkpoints.append(Checkpoint(time, state, undo))
+        self.position = len(self.checkpoints) - 1
+
+    def restore(self, index):
+        """Откат назад к точке index (не дальше текущей позиции)"""
+        cpu = self.cpu
+        size = 1 << CHECKPOINT_PAGE_SHIFT
+        memory = cpu.memory
+        for start in self.dirty_pages():
+            memory[start:start+size] = self.shadow[start:start+size]
+        for checkpoint in reversed(self.checkpoints[index + 1:self.position + 1]):
+            for start, data in checkpoint.undo.items():
+                memory[start:start+size] = data
+        self.shadow[:] = memory
+        self.position = index
+        cpu.arm_breakpoints()
+        cpu.memory_written(0, len(memory))
+
+        state = self.checkpoints[index].state
+        restore_fields(cpu, state['cpu'])
+        restore_fields(cpu.scheduler, state['scheduler'])
+        restore_fields(cpu.pic, state['pic'])
+        restore_fields(cpu.pit, state['pit'])
+        restore_fields(cpu.keyboard, state['keyboard'])
+        restore_fields(cpu.vc, state['video'])
+        scheduler = cpu.scheduler
+        scheduler.deadline = scheduler.events[0][0] if scheduler.events else NEVER
+        cpu.invalidate_segments()
+        cpu.descriptor_cache.clear()
+
+    def index_before(self, time):
+        """Последняя контрольная точка не позже time"""
+        times = [checkpoint.time for checkpoint in self.checkpoints[:self.position + 1]]
+        return bisect_right(times, time) - 1
+
+    def seek(self, time):
+        index = self.index_before(time)
+        if index < 0:
+            return False
+        self.restore(index)
+        self.cpu.run_until(time)
+        return True
+
+    def reverse_continue(self):
+        """Назад до последнего срабатывания точки останова/наблюдения раньше текущего такта"""
+        now = self.cpu.scheduler.cycles
+        index = self.index_before(now - 1)
+        while index >= 0:
+            self.restore(index)
+            following = self.checkpoints[index + 1].time if index + 1 < len(self.checkpoints) else now
+            self.hits = []
+            self.cpu.run_until(min(following, now - 1))
+            hits = [hit for hit in self.hits if hit < now]
+            if hits:
+                self.restore(index)
+                self.cpu.run_until(hits[-1])
+                return True
+            index -= 1
+        self.restore(0)
+        return False
+
+class IOBus:
+    """Шина портов: устройства регистрируют обработчики на диапазоны, поиск по словарю"""
+    def __init__(self):
+        self.readers = {} # порт -> read(port)
+        self.writers = {} # порт -> write(port, value)
+
+    def register(self, first, last, read=None, write=None):
+        for port in range(first, last + 1):
+            if read is not None:
+                self.readers[port] = read
+            if write is not None:
+                self.writers[port] = write
+
+    def unregister(self, first, last):
+        for port in range(first, last + 1):
+            self.readers.pop(port, None)
+            self.writers.pop(port, None)
+
+    def read(self, port):
+        handler = self.readers.get(port)
+        if handler is None:
+            return 0xFF # никого нет, шина висит в единицах
+        return handler(port)
+
+    def write(self, port, value):
+        handler = self.writers.get(port)
+        if handler is not None:
+            handler(port, value)
+
+class DeviceScheduler:
+    """Очередь событий устройств по виртуальным тактам ЦП"""
+    def __init__(self):
+        self.events = [] # куча (такт, номер, callback)
+        self.cycles = 0
+        self.deadline = NEVER # такт ближайшего события, единственное что смотрит цикл ЦП
+        self.sequence = 0
+        self.cancelled = set()
+
+    def schedule(self, delay, callback):
+        return self.schedule_at(self.cycles + delay, callback)
+
+    def schedule_at(self, when, callback):
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, callback))
+        if when < self.deadline:
+            self.deadline = when
+        return self.sequence
+
+    def cancel(self, event_id):
+        # отменённое событие просто пропускается при извлечении
+        if any(queued == event_id for _, queued, _ in self.events):
+            self.cancelled.add(event_id)
+
+    def cancel_callback(self, callback):
+        for _, event_id, queued in self.events:
+            if queued == callback:
+                self.cancelled.add(event_id)
+
+    def run_due(self):
+        events = self.events
+        while events and events[0][0] <= self.cycles:
+            when, event_id, callback = heapq.heappop(events)
+            if event_id in self.cancelled:
+                self.cancelled.discard(event_id)
+                continue
+            callback(when)
+        self.deadline = events[0][0] if events else NEVER
+
+class IntervalTimer:
+    """Канал 0 PIT (порты 0x40-0x43), по истечении счёта поднимает IRQ0"""
+    def __init__(self, scheduler, raise_irq, irq=0):
+        self.scheduler = scheduler
+        self.raise_irq = raise_irq
+        self.irq = irq
+        self.reload = 0x10000 # делитель 0 = 65536, 18.2 Гц
+        self.latch = None # байты делителя, ждущие записи
+        self.read_latch = []
+        self.started = 0
+        self.event = None
+        self.start()
+
+    @property
+    def period(self):
+        return self.reload * PIT_CYCLES
+
+    def start(self):
+        if self.event is not None:
+            self.scheduler.cancel(self.event)
+        self.started = self.scheduler.cycles
+        self.event = self.scheduler.schedule(self.period, self.expire)
+
+    def expire(self, when):
+        # перезапуск от дедлайна, а не от текущего такта, чтобы частота не плыла
+        self.started = when
+        self.event = self.scheduler.schedule_at(when + self.period, self.expire)
+        self.raise_irq(self.irq)
+
+    def count(self):
+        elapsed = (self.scheduler.cycles - self.started) // PIT_CYCLES
+        return (self.reload - elapsed % self.reload) & 0xFFFF
+
+    def read_port(self, port):
+        if port != 0x40:
+            return 0xFF
+        if not self.read_latch:
+            count = self.count()
+            self.read_latch = [count & 0xFF, count >> 8]
+        return self.read_latch.pop(0)
+
+    def write_port(self, port, value):
+        if port == 0x43:
+            if value >> 6 == 0:
+                if (value >> 4) & 0x03 == 0: # команда защёлки
+                    count = self.count()
+                    self.read_latch = [count & 0xFF, count >> 8]
+                else:
+                    self.latch = []
+        elif port == 0x40:
+            if self.latch is None:
+                self.latch = []
+            self.latch.append(value & 0xFF)
+            if len(self.latch) == 2:
+                self.reload = (self.latch[0] | (self.latch[1] << 8)) or 0x10000
+                self.latch = None
+                self.start()
+
+class InterruptController:
+    """PIC 8259: битовые маски ожидающих (IRR), замаскированных (IMR) и обслуживаемых (ISR) IRQ"""
+    def __init__(self, vector_base=IRQ_BASE):
+        self.vector_base = vector_base
+        self.pending = 0
+        self.mask = 0
+        self.in_service = 0
+        self.read_isr = False
+        self.init_words = 0 # сколько ещё ICW ждём на 0x21
+        self.need_icw4 = False
+
+    def raise_irq(self, irq):
+        self.pending |= 1 << irq
+
+    def ready(self):
+        """Есть IRQ приоритетнее всех обслуживаемых (меньший номер важнее)"""
+        ready = self.pending & ~self.mask
+        if not ready:
+            return False
+        if not self.in_service:
+            return True
+        return (ready & -ready) < (self.in_service & -self.in_service)
+
+    def acknowledge(self):
+        ready = self.pending & ~self.mask
+        bit = ready & -ready
+        self.pending &= ~bit
+        self.in_service |= bit
+        return self.vector_base + bit.bit_length() - 1
+
+    def end_of_interrupt(self, irq=None):
+        if irq is None:
+            self.in_service &= self.in_service - 1 # снять самый приоритетный
+        else:
+            self.in_service &= ~(1 << irq)
+
+    def read_port(self, port):
+        if port & 1:
+            return self.mask
+        return self.in_service if self.read_isr else self.pending
+
+    def write_port(self, port, value):
+        if port & 1:
+            if self.init_words:
+                if self.init_words == 3:
+                    self.vector_base = value & 0xF8 # ICW2
+                self.init_words -= 1
+                if self.init_words == 1 and not self.need_icw4:
+                    self.init_words = 0
+            else:
+                self.mask = value # OCW1
+        elif value & 0x10: # ICW1
+            self.mask = 0
+            self.in_service = 0
+            self.pending = 0
+            self.read_isr = False
+            self.need_icw4 = bool(value & 0x01)
+            self.init_words = 3
+        elif value & 0x08: # OCW3
+            if value & 0x02:
+                self.read_isr = bool(value & 0x01)
+        elif value & 0x20: # OCW2: EOI
+            self.end_of_interrupt(value & 0x07 if value & 0x40 else None)
+
+class KeyboardDevice:
+    """Клавиатура: поток чтения терминала -> deque, скан-коды на порт 0x60 с IRQ1, буфер BIOS для INT 16h"""
+    def __init__(self, raise_irq, irq=1, maxlen=KEY_BUFFER_SIZE):
+        self.raise_irq = raise_irq
+        self.irq = irq
+        self.incoming = deque(maxlen=maxlen) # сырые куски от потока чтения
+        self.keys = deque(maxlen=maxlen) # слова BIOS: скан-код << 8 | ASCII
+        self.scancodes = deque(maxlen=maxlen * 4)
+        self.script = '' # ввод сценария, ещё не попавший в буферы
+        self.data = 0 # защёлка порта 0x60
+        self.full = False
+        self.wakeup = None # зовётся из потока чтения, будит цикл ЦП
+        self.reader = None
+        self.running = False
+        self.saved_mode = None
+
+    def feed(self, text):
+        i = 0
+        while i < len(text):
+            char = text[i]
+            code = ANSI_KEYS.get(text[i:i+3]) if char == '\x1b' else None
+            if code is not None:
+                self.keys.append(code << 8)
+                self.scancodes.extend((0xE0, code, 0xE0, code | 0x80))
+                i += 3
+                continue
+            i += 1
+            key = ASCII_SCANCODES.get(char)
+            if key is None:
+                self.keys.append(ord(char) & 0xFF)
+                continue
+            code, shift, ascii_code = key
+            self.keys.append((code << 8) | ascii_code)
+            if shift:
+                self.scancodes.extend((SHIFT_MAKE, code, code | 0x80, SHIFT_MAKE | 0x80))
+            else:
+                self.scancodes.extend((code, code | 0x80))
+        self.latch()
+
+    def queue_script(self, text):
+        """Ввод сценария любой длины: в буферы порциями, по мере того как гость их читает"""
+        self.script += text
+        self.refill()
+
+    def refill(self):
+        script = self.script
+        if not script:
+            return
+        maxlen = self.keys.maxlen
+        if self.keys and self.scancodes:
+            room = min(maxlen - len(self.keys), (self.scancodes.maxlen - len(self.scancodes)) // 4)
+        else:
+            room = maxlen # один из потребителей всё прочитал, второй, возможно, буфер не читает вовсе
+        if room <= 0:
+            return
+        cut = min(room, len(script))
+        escape = script.rfind('\x1b', max(0, cut - 2), cut)
+        if escape >= 0 and script[escape:escape+3] in ANSI_KEYS:
+            cut = escape or 3 # стрелку не рвём пополам
+        self.script = script[cut:]
+        self.feed(script[:cut])
+
+    def drain(self):
+        """Накопленное потоком чтения - в буферы; вернуть разобранный текст"""
+        incoming = self.incoming
+        if not incoming:
+            return ''
+        chunks = []
+        while incoming:
+            chunks.append(incoming.popleft())
+        text = ''.join(chunks)
+        self.feed(text)
+        return text
+
+    def latch(self):
+        if not self.full and self.scancodes:
+            self.data = self.scancodes.popleft()
+            self.full = True
+            self.raise_irq(self.irq)
+
+    def read_port(self, port):
+        if port == 0x64:
+            return 0x01 if self.full else 0x00 # статус: выходной буфер полон
+        if port != 0x60:
+            return 0xFF
+        value = self.data
+        self.full = False
+        if not self.scancodes:
+            self.refill()
+        self.latch()
+        return value
+
+    def start(self, fd):
+        if self.running:
+            return
+        try:
+            import termios, tty
+            self.saved_mode = (fd, termios.tcgetattr(fd))
+            tty.setcbreak(fd)
+        except Exception:
+            self.saved_mode = None
+        self.running = True
+        self.reader = threading.Thread(target=self.read_loop, args=(fd,), daemon=True)
+        self.reader.start()
+
+    def stop(self):
+        self.running = False
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+        if self.saved_mode is not None:
+            import termios
+            fd, mode = self.saved_mode
+            termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+            self.saved_mode = None
+
+    def read_loop(self, fd):
+        # select/read только здесь, горячий путь ЦП их не видит
+        from select import select
+        while self.running:
+            if not select([fd], [], [], 0.1)[0]:
+                continue
+            data = os.read(fd, 64)
+            if not data:
+                break
+            self.incoming.append(data.decode('latin-1'))
+            if self.wakeup is not None:
+                self.wakeup()
+
+SCRIPT_ESCAPE = re.compile(r'\\(?:x[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|N\{[A-Za-z0-9 -]+\}|[0-7]{1,3}|[\\\'"abfnrtv])')
+
+def unescape_script(text):
+    """Escape-последовательности как в строках Python; символы вне latin-1 - байтами UTF-8,
+    как их прислал бы терминал"""
+    text = SCRIPT_ESCAPE.sub(lambda m: m.group().encode('ascii').decode('unicode_escape'), text)
+    return ''.join(c if ord(c) < 0x100 else c.encode('utf-8').decode('latin-1') for c in text)
+
+def parse_input_script(text):
+    """Сценарий ввода: строка = набрать текст и Enter; @type без Enter,
+    @after N / @at N - ждать инструкций, @until TEXT - ждать текст на экране"""
+    steps = []
+    for line in text.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        command, _, arg = line.partition(' ')
+        if command == '@after':
+            steps.append(('after', int(arg, 0)))
+        elif command == '@at':
+            steps.append(('at', int(arg, 0)))
+        elif command == '@until':
+            steps.append(('until', arg))
+        elif command == '@type':
+            steps.append(('keys', unescape_script(arg)))
+        else:
+            steps.append(('keys', unescape_script(line) + '\r'))
+    return deque(steps)
+
+class InputScript:
+    """Проигрывание сценария ввода: ожидания по тактам - события планировщика,
+    ожидание текста проверяется только на vblank"""
+    def __init__(self, cpu, steps):
+        self.cpu = cpu
+        self.steps = steps
+        self.waiting = None # текст, которого ждём на экране
+        self.typed = 0
+
+    def advance(self, when=None):
+        steps = self.steps
+        while steps:
+            kind, arg = steps.popleft()
+            if kind == 'keys':
+                self.cpu.add_key_input(arg)
+                self.typed += len(arg)
+            elif kind == 'after':
+                self.cpu.scheduler.schedule(arg, self.advance)
+                return
+            elif kind == 'at':
+                self.cpu.scheduler.schedule_at(arg, self.advance)
+                return
+            elif arg not in self.screen_text():
+                self.waiting = arg
+                return
+        self.waiting = None
+
+    def screen_text(self):
+        vc = self.cpu.vc
+        return vc.get_ascii_output() if vc.video_mode == 0x03 else ''
+
+    def check_screen(self):
+        if self.waiting in self.screen_text():
+            self.waiting = None
+            self.advance()
+
+    @property
+    def done(self):
+        return not self.steps and self.waiting is None
+
+# x86 реального режима: флаги в раскладке 8086, регистры в порядке кодирования ModRM
+X86_CF = 0x0001
+X86_PF = 0x0004
+X86_AF = 0x0010
+X86_ZF = 0x0040
+X86_SF = 0x0080
+X86_TF = 0x0100
+X86_IF = 0x0200
+X86_DF = 0x0400
+X86_OF = 0x0800
+X86_ARITH = X86_CF | X86_PF | X86_AF | X86_ZF | X86_SF | X86_OF
+X86_REGS = ('AX', 'CX', 'DX', 'BX', 'SP', 'BP', 'SI', 'DI')
+X86_SREGS = ('ES', 'CS', 'SS', 'DS')
+R_AX, R_CX, R_DX, R_BX, R_SP, R_BP, R_SI, R_DI = range(8)
+S_ES, S_CS, S_SS, S_DS = range(4)
+X86_SEGMENT_PREFIXES = {0x26: S_ES, 0x2E: S_CS, 0x36: S_SS, 0x3E: S_DS}
+X86_PREFIXES = frozenset((0x26, 0x2E, 0x36, 0x3E, 0xF0, 0xF2, 0xF3))
+X86_CODE_PAGE_SHIFT = 8 # страницы по 256 байт для сброса кэша декодера
+BOOT_SECTOR_ADDRESS = 0x7C00
+KERNEL_ADDRESS = 0x8000 # org ядра PetyshkOS
+FLOPPY_SECTORS = 18 # геометрия 1.44М для CHS
+FLOPPY_HEADS = 2
+FLOPPY_TOTAL = 80 * FLOPPY_HEADS * FLOPPY_SECTORS # короткий образ дополняется нулями до дискеты
+
+PARITY = bytes(X86_PF if bin(value).count('1') % 2 == 0 else 0 for value in range(256))
+SZP8 = bytes(PARITY[value] | (X86_ZF if value == 0 else 0) | (value & X86_SF) for value in range(256))
+
+# ModRM: байт -> (mod, reg, rm); 16-битная адресация, SIB в реальном режиме нет
+MODRM = tuple((byte >> 6, (byte >> 3) & 7, byte & 7) for byte in range(256))
+MODRM_DISP = bytes(2 if (mod == 0 and rm == 6) or mod == 2 else mod & 1 if mod != 3 else 0
+                   for mod, reg, rm in MODRM)
+# база эффективного адреса по rm, смещение из инструкции прибавляется отдельно
+EA_FUNCTIONS = (
+    lambda r: r[R_BX] + r[R_SI],
+    lambda r: r[R_BX] + r[R_DI],
+    lambda r: r[R_BP] + r[R_SI],
+    lambda r: r[R_BP] + r[R_DI],
+    lambda r: r[R_SI],
+    lambda r: r[R_DI],
+    lambda r: r[R_BP],
+    lambda r: r[R_BX],
+)
+EA_SEGMENTS = (S_DS, S_DS, S_SS, S_SS, S_DS, S_DS, S_SS, S_DS) # через BP - по умолчанию стек
+
+def ea_direct(r):
+    return 0 # mod=00 rm=110: только disp16
+
+# те же адреса исходником для транслятора блоков
+EA_SOURCE = dict(zip(EA_FUNCTIONS + (ea_direct,), (
+    ('bx', 'si'), ('bx', 'di'), ('bp', 'si'), ('bp', 'di'), ('si',), ('di',), ('bp',), ('bx',), ())))
+
+# условия Jcc по старшим трём битам кода, младший бит инвертирует
+X86_CONDITIONS = (
+    lambda f: f & X86_OF,
+    lambda f: f & X86_CF,
+    lambda f: f & X86_ZF,
+    lambda f: f & (X86_CF | X86_ZF),
+    lambda f: f & X86_SF,
+    lambda f: f & X86_PF,
+    lambda f: (f ^ (f >> 4)) & X86_SF, # SF != OF
+    lambda f: ((f ^ (f >> 4)) & X86_SF) or f & X86_ZF,
+)
+# те же условия прямо по операндам CMP (знаковые уже расширены); None - только через флаги
+X86_COMPARISONS = (
+    None,
+    lambda a, b: a < b,
+    lambda a, b: a == b,
+    lambda a, b: a <= b,
+    None,
+    None,
+    lambda a, b: a < b,
+    lambda a, b: a <= b,
+)
+X86_CONDITION_NAMES = ('o', 'b', 'e', 'be', 's', 'p', 'l', 'le')
+
+# формы операндов для декодера
+X86_MODRM = 0x01
+X86_IMM8 = 0x02
+X86_IMM16 = 0x04
+X86_SIMM8 = 0x08 # знаковый байт: rel8 и imm8 с расширением
+X86_FAR = 0x10 # ptr16:16, сегмент идёт в поле reg
+X86_GROUP3 = 0x20 # F6/F7: непосредственный операнд только у TEST
+
+# опкод -> (обработчик op_*, форма)
+X86_OPCODES = {}
+for base in range(0x00, 0x40, 0x08):
+    X86_OPCODES.update({
+        base: ('alu_rm8', X86_MODRM), base + 1: ('alu_rm16', X86_MODRM),
+        base + 2: ('alu_r8', X86_MODRM), base + 3: ('alu_r16', X86_MODRM),
+        base + 4: ('alu_al', X86_IMM8), base + 5: ('alu_ax', X86_IMM16),
+    })
+for base in (0x06, 0x0E, 0x16, 0x1E):
+    X86_OPCODES[base] = ('push_sreg', 0)
+for base in (0x07, 0x17, 0x1F):
+    X86_OPCODES[base] = ('pop_sreg', 0)
+for opcode in range(8):
+    X86_OPCODES.update({
+        0x40 + opcode: ('inc16', 0), 0x48 + opcode: ('dec16', 0),
+        0x50 + opcode: ('push16', 0), 0x58 + opcode: ('pop16', 0),
+        0x90 + opcode: ('xchg_ax', 0),
+        0xB0 + opcode: ('mov_r8_imm', X86_IMM8), 0xB8 + opcode: ('mov_r16_imm', X86_IMM16),
+        0xD8 + opcode: ('esc', X86_MODRM),
+    })
+for opcode in range(0x70, 0x80):
+    X86_OPCODES[opcode] = ('jcc', X86_SIMM8)
+X86_OPCODES.update({
+    0x27: ('daa', 0), 0x2F: ('das', 0), 0x37: ('aaa', 0), 0x3F: ('aas', 0),
+    0x60: ('pusha', 0), 0x61: ('popa', 0), 0x68: ('push_imm', X86_IMM16), 0x6A: ('push_imm', X86_SIMM8),
+    0x80: ('group1_8', X86_MODRM | X86_IMM8), 0x81: ('group1_16', X86_MODRM | X86_IMM16),
+    0x82: ('group1_8', X86_MODRM | X86_IMM8), 0x83: ('group1_16', X86_MODRM | X86_SIMM8),
+    0x84: ('test_rm8', X86_MODRM), 0x85: ('test_rm16', X86_MODRM),
+    0x86: ('xchg_rm8', X86_MODRM), 0x87: ('xchg_rm16', X86_MODRM),
+    0x88: ('mov_rm8', X86_MODRM), 0x89: ('mov_rm16', X86_MODRM),
+    0x8A: ('mov_r8', X86_MODRM), 0x8B: ('mov_r16', X86_MODRM),
+    0x8C: ('mov_rm_sreg', X86_MODRM), 0x8D: ('lea', X86_MODRM),
+    0x8E: ('mov_sreg_rm', X86_MODRM), 0x8F: ('pop_rm', X86_MODRM),
+    0x98: ('cbw', 0), 0x99: ('cwd', 0), 0x9A: ('call_far', X86_FAR), 0x9B: ('nop', 0),
+    0x9C: ('pushf', 0), 0x9D: ('popf', 0), 0x9E: ('sahf', 0), 0x9F: ('lahf', 0),
+    0xA0: ('mov_acc_moffs', X86_IMM16), 0xA1: ('mov_acc_moffs', X86_IMM16),
+    0xA2: ('mov_moffs_acc', X86_IMM16), 0xA3: ('mov_moffs_acc', X86_IMM16),
+    0xA4: ('movs', 0), 0xA5: ('movs', 0), 0xA6: ('cmps', 0), 0xA7: ('cmps', 0),
+    0xA8: ('test_al', X86_IMM8), 0xA9: ('test_ax', X86_IMM16),
+    0xAA: ('stos', 0), 0xAB: ('stos', 0), 0xAC: ('lods', 0), 0xAD: ('lods', 0),
+    0xAE: ('scas', 0), 0xAF: ('scas', 0),
+    0xC0: ('shift', X86_MODRM | X86_IMM8), 0xC1: ('shift', X86_MODRM | X86_IMM8),
+    0xC2: ('ret', X86_IMM16), 0xC3: ('ret', 0), 0xC4: ('load_far', X86_MODRM), 0xC5: ('load_far', X86_MODRM),
+    0xC6: ('mov_rm8_imm', X86_MODRM | X86_IMM8), 0xC7: ('mov_rm16_imm', X86_MODRM | X86_IMM16),
+    0xC9: ('leave', 0), 0xCA: ('retf', X86_IMM16), 0xCB: ('retf', 0),
+    0xCC: ('int3', 0), 0xCD: ('int', X86_IMM8), 0xCE: ('into', 0), 0xCF: ('iret', 0),
+    0xD0: ('shift', X86_MODRM), 0xD1: ('shift', X86_MODRM), 0xD2: ('shift', X86_MODRM), 0xD3: ('shift', X86_MODRM),
+    0xD4: ('aam', X86_IMM8), 0xD5: ('aad', X86_IMM8), 0xD7: ('xlat', 0),
+    0xE0: ('loop', X86_SIMM8), 0xE1: ('loop', X86_SIMM8), 0xE2: ('loop', X86_SIMM8), 0xE3: ('loop', X86_SIMM8),
+    0xE4: ('in', X86_IMM8), 0xE5: ('in', X86_IMM8), 0xE6: ('out', X86_IMM8), 0xE7: ('out', X86_IMM8),
+    0xE8: ('call_rel', X86_IMM16), 0xE9: ('jmp_rel', X86_IMM16), 0xEA: ('jmp_far', X86_FAR), 0xEB: ('jmp_rel', X86_SIMM8),
+    0xEC: ('in', 0), 0xED: ('in', 0), 0xEE: ('out', 0), 0xEF: ('out', 0),
+    0xF4: ('hlt', 0), 0xF5: ('cmc', 0),
+    0xF6: ('group3', X86_MODRM | X86_IMM8 | X86_GROUP3), 0xF7: ('group3', X86_MODRM | X86_IMM16 | X86_GROUP3),
+    0xF8: ('flag', 0), 0xF9: ('flag', 0), 0xFA: ('flag', 0), 0xFB: ('flag', 0), 0xFC: ('flag', 0), 0xFD: ('flag', 0),
+    0xFE: ('group4', X86_MODRM), 0xFF: ('group5', X86_MODRM),
+})
+X86_FORMS = bytes(X86_OPCODES.get(opcode, (None, 0))[1] for opcode in range(256))
+X86_FLAG_BITS = (X86_CF, X86_IF, X86_DF) # CLC/STC, CLI/STI, CLD/STD
+# конец базового блока: переходы, прерывания, деление (INT 0), всё, что может запросить обслуживание
+X86_BLOCK_END = frozenset(range(0x70, 0x80)) | frozenset((
+    0x9A, 0x9D, 0xC2, 0xC3, 0xCA, 0xCB, 0xCC, 0xCD, 0xCE, 0xCF, 0xD4, 0xE0, 0xE1, 0xE2, 0xE3,
+    0xE6, 0xE7, 0xE8, 0xE9, 0xEA, 0xEB, 0xEE, 0xEF, 0xF4, 0xF6, 0xF7, 0xFB))
+HOT_BLOCK_THRESHOLD = 16 # входов в блок до трансляции
+# склейки: CMP и DEC r16 с условным переходом, серии PUSH/POP r16
+X86_FUSION_HEADS = frozenset(range(0x38, 0x3E)) | frozenset(range(0x48, 0x60)) | frozenset(range(0x80, 0x84))
+MAX_FUSED_RUN = 8
+# не читают и не пишут флаги: PUSH/POP r16, MOV, LEA, XCHG, CBW/CWD, JMP
+X86_FLAGS_UNTOUCHED = (frozenset(range(0x50, 0x60)) | frozenset(range(0x88, 0x8E)) | frozenset(range(0x90, 0x9A))
+                       | frozenset(range(0xA0, 0xA4)) | frozenset(range(0xB0, 0xC0)) | frozenset((0xC6, 0xC7, 0xE9, 0xEB)))
+
+class WatchedMemory:
+    """Память x86 на время наблюдения: обращения к отмеченным страницам идут через отладчик"""
+    __slots__ = ('engine', 'memory', 'pages')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.memory = engine.cpu.memory
+        self.pages = engine.cpu.watch_pages
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __getitem__(self, address):
+        if self.pages[address >> WATCH_PAGE_SHIFT] & WATCH_READ:
+            self.engine.watch(address, WATCH_READ)
+        return self.memory[address]
+
+    def __setitem__(self, address, value):
+        if self.pages[address >> WATCH_PAGE_SHIFT] & WATCH_WRITE:
+            self.engine.watch(address, WATCH_WRITE)
+        self.memory[address] = value
+
+class X86Engine:
+    """Движок настоящего 8086 реального режима: таблицы ModRM и эффективных адресов,
+    обработчик на опкод, декодированные инструкции кэшируются по линейному адресу.
+    Сервисы BIOS/DOS - нативные обработчики ЦП, пока гость не поставил свой вектор"""
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.mem = cpu.memory # под наблюдением - WatchedMemory
+        self.code = cpu.memory # выборка инструкций мимо наблюдения
+        self.regs = [0] * 8
+        self.sregs = [0] * 4
+        self.ip = 0
+        self.flags = 0x0002
+        self.running = False
+        self.handlers = [getattr(self, 'op_' + X86_OPCODES[opcode][0]) if opcode in X86_OPCODES else None
+                         for opcode in range(256)]
+        # линейный адрес -> (обработчик, длина, rm, reg, imm, сегмент, rep, опкод, конец блока)
+        self.cache = {}
+        self.code_pages = bytearray(len(self.mem) >> X86_CODE_PAGE_SHIFT) # страницы с кэшированным кодом
+        self.page_entries = {} # страница -> адреса декодированных инструкций и блоков
+        self.translator = BlockTranslator(self)
+        self.scheduler = cpu.scheduler
+        self.fusion = True
+        self.fusions = Counter() # имя склейки -> сколько раз сработала
+        self.writes = 0 # записей в память: холостой цикл ничего не пишет
+        self.debugging = False # наблюдение или профиль: только интерпретатор
+
+    def set_translator(self, threshold=HOT_BLOCK_THRESHOLD):
+        """Порог трансляции горячих блоков; None - только интерпретатор"""
+        self.invalidate(0, len(self.mem))
+        self.translator = BlockTranslator(self, threshold) if threshold else None
+
+    def set_fusion(self, enabled):
+        self.invalidate(0, len(self.mem))
+        self.fusion = enabled
+
+    # состояние
+    def load_registers(self):
+        registers = self.cpu.registers
+        self.regs[:] = [registers[name] for name in X86_REGS]
+        self.sregs[:] = [registers[name] for name in X86_SREGS]
+        self.ip = registers['IP']
+        self.flags = registers['FLAGS'] | 0x0002
+
+    def store_registers(self):
+        cpu = self.cpu
+        registers = cpu.registers
+        registers.update(zip(X86_REGS, self.regs))
+        registers.update(zip(X86_SREGS, self.sregs))
+        registers['IP'] = self.ip
+        registers['FLAGS'] = self.flags
+        cpu.interrupt_enabled = bool(self.flags & X86_IF)
+
+    def boot(self, image, address=BOOT_SECTOR_ADDRESS, drive=0x00):
+        """Как BIOS: образ в 0:address, пустая IVT (всё на нативных сервисах), DL - диск"""
+        cpu = self.cpu
+        self.mem[0:0x400] = bytes(0x400)
+        self.mem[address:address + len(image)] = image
+        cpu.memory_written(0, address + len(image))
+        registers = cpu.registers
+        for name in X86_REGS + X86_SREGS:
+            registers[name] = 0
+        registers['SP'] = BOOT_SECTOR_ADDRESS
+        registers['DX'] = drive
+        registers['IP'] = address
+        registers['FLAGS'] = X86_IF | 0x0002
+        cpu.interrupt_enabled = True
+        cpu.os_loaded = True
+
+    # цикл
+    def run(self):
+        """До HLT, ожидания клавиши или холостого цикла (возврат в цикл хоста)
+        или остановки на границе бюджета"""
+        cpu = self.cpu
+        scheduler = cpu.scheduler
+        cache = self.cache
+        decode = self.decode
+        regs = self.regs
+        sregs = self.sregs
+        translator = self.translator
+        profiler = cpu.profiler
+        perf_counter_ns = time.perf_counter_ns
+        debugging = bool(cpu.watchpoints) or profiler is not None
+        if debugging:
+            # оттранслированные блоки ходят в память напрямую и не считают инструкции
+            if not self.debugging:
+                self.invalidate(0, len(self.code))
+            translator = None
+            if cpu.watchpoints:
+                self.mem = WatchedMemory(self)
+        self.debugging = debugging
+        # блок, который раз за разом возвращается к себе с тем же состоянием
+        spin_address = None
+        spin_regs = [0] * 8
+        spin_sregs = [0] * 4
+        spin_flags = spin_writes = spins = 0
+        self.load_registers()
+        self.running = True
+        try:
+            while self.running:
+                scheduler.cycles += 1
+                if scheduler.cycles >= scheduler.deadline and self.service():
+                    scheduler.cycles -= 1 # этот такт ещё не начат
+                    break
+                address = ((sregs[S_CS] << 4) + self.ip) & 0xFFFFF
+                entry = cache.get(address) or decode(address)
+                self.ip = (self.ip + entry[1]) & 0xFFFF
+                if profiler is not None:
+                    start = perf_counter_ns()
+                    entry[0](entry)
+                    profiler.record(entry[7], address, perf_counter_ns() - start)
+                else:
+                    entry[0](entry)
+                if entry[8]:
+                    address = ((sregs[S_CS] << 4) + self.ip) & 0xFFFFF
+                    if translator is not None:
+                        translator.enter(address)
+                    if address != spin_address:
+                        spin_address = address
+                        spins = 0
+                    elif (spins and regs == spin_regs and sregs == spin_sregs
+                          and self.flags == spin_flags and self.writes == spin_writes):
+                        # до события устройства цикл будет повторяться точно так же
+                        spins += 1
+                        if spins == IDLE_SPINS:
+                            spins = 0
+                            self.idle()
+                    else:
+                        spin_regs[:] = regs
+                        spin_sregs[:] = sregs
+                        spin_flags = self.flags
+                        spin_writes = self.writes
+                        spins = 1
+        finally:
+            self.mem = self.code
+            self.store_registers()
+
+    def service(self):
+        # устройства работают с регистрами ЦП, синхронизируемся только на границе
+        self.store_registers()
+        stop = self.cpu.service_devices(self.deliver)
+        self.load_registers()
+        return stop
+
+    def watch(self, address, flags):
+        # отладчик показывает регистры ЦП
+        self.store_registers()
+        self.cpu.watch_access(address, flags)
+
+    def deliver(self, vector):
+        self.load_registers()
+        self.interrupt(vector)
+        self.store_registers()
+
+    def idle(self):
+        # HLT, ожидание клавиши или холостой цикл: время до ближайшего события, хост рисует кадр и спит
+        self.cpu.idle()
+        self.running = False
+
+    def halt(self):
+        # HLT при IF=0 - навсегда
+        self.running = False
+        self.cpu.os_loaded = False
+
+    # декодер
+    def decode(self, address, store=True):
+        mem = self.code
+        pos = address
+        segment = None
+        rep = 0
+        opcode = mem[pos]
+        while opcode in X86_PREFIXES:
+            if opcode in X86_SEGMENT_PREFIXES:
+                segment = X86_SEGMENT_PREFIXES[opcode]
+            elif opcode != 0xF0:
+                rep = opcode
+            pos += 1
+            opcode = mem[pos]
+        pos += 1
+        handler = self.handlers[opcode]
+        if handler is None:
+            raise RuntimeError(f"Unknown x86 opcode {opcode:02X} at {address:05X}")
+        form = X86_FORMS[opcode]
+        rm = None
+        reg = opcode & 7
+        imm = 0
+        if form & X86_MODRM:
+            byte = mem[pos]
+            pos += 1
+            mod, reg, low = MODRM[byte]
+            if mod == 3:
+                rm = low
+            else:
+                if mod == 0 and low == 6:
+                    function, default = ea_direct, S_DS
+                else:
+                    function, default = EA_FUNCTIONS[low], EA_SEGMENTS[low]
+                size = MODRM_DISP[byte]
+                if size == 1:
+                    disp = mem[pos]
+                    disp -= (disp & 0x80) << 1
+                elif size == 2:
+                    disp = mem[pos] | (mem[pos + 1] << 8)
+                else:
+                    disp = 0
+                pos += size
+                rm = (function, disp, default if segment is None else segment)
+            if form & X86_GROUP3 and reg > 1:
+                form = 0
+        if form & X86_IMM8:
+            imm = mem[pos]
+            pos += 1
+        elif form & X86_SIMM8:
+            imm = mem[pos]
+            imm -= (imm & 0x80) << 1
+            pos += 1
+        elif form & X86_IMM16:
+            imm = mem[pos] | (mem[pos + 1] << 8)
+            pos += 2
+        elif form & X86_FAR:
+            imm = mem[pos] | (mem[pos + 1] << 8)
+            reg = mem[pos + 2] | (mem[pos + 3] << 8)
+            pos += 4
+        ends = opcode in X86_BLOCK_END or (opcode == 0xFF and 2 <= reg <= 5) or (opcode == 0x8E and reg == S_CS)
+        entry = (handler, pos - address, rm, reg, imm, segment, rep, opcode, ends)
+        if not store:
+            return entry
+        pages = {address >> X86_CODE_PAGE_SHIFT, (pos - 1) >> X86_CODE_PAGE_SHIFT}
+        if self.fusion and opcode in X86_FUSION_HEADS:
+            entry = self.fuse(address, entry, pages)
+        self.cache[address] = entry
+        for page in pages:
+            self.code_pages[page] = 1
+            self.page_entries.setdefault(page, []).append(address)
+        return entry
+
+    def peek(self, address):
+        # соседняя инструкция без записи в кэш; мусор после кода - не склеиваем
+        try:
+            return self.decode(address, store=False)
+        except (RuntimeError, IndexError):
+            return None
+
+    def fuse(self, address, entry, pages):
+        """Склейка частых пар в одну запись кэша: CMP+Jcc, DEC+JNZ, серии PUSH и POP.
+        К полям первой инструкции добавлены исходные записи, имя для счётчика, нужны ли флаги
+        и операнд склейки: регистры серии, смещение перехода или (условие, инверсия, смещение)"""
+        opcode = entry[7]
+        parts = [entry]
+        pos = (address + entry[1]) & 0xFFFFF
+        if 0x50 <= opcode < 0x60:
+            base = opcode & 0xF8
+            while len(parts) < MAX_FUSED_RUN:
+                following = self.peek(pos)
+                if following is None or following[7] & 0xF8 != base or following[3] == R_SP:
+                    break
+                parts.append(following)
+                pos = (pos + following[1]) & 0xFFFFF
+            if len(parts) == 1 or entry[3] == R_SP:
+                return entry
+            name = f"{'push' if base == 0x50 else 'pop'}*{len(parts)}"
+            handler = self.op_fused_push if base == 0x50 else self.op_fused_pop
+            need = False
+            operand = tuple(part[3] for part in parts)
+        else:
+            if opcode >= 0x80 and entry[3] != 7:
+                return entry # из группы 1 склеивается только CMP
+            decrement = 0x48 <= opcode < 0x50
+            following = self.peek(pos)
+            if following is None or (following[7] != 0x75 if decrement else following[7] >> 4 != 7):
+                return entry
+            parts.append(following)
+            pos = (pos + following[1]) & 0xFFFFF
+            code = following[7] & 0x0F
+            if decrement:
+                name, handler = 'dec+jnz', self.op_fused_dec_jnz
+                need = False
+                operand = following[4]
+            else:
+                name = f"cmp+j{'n' if code & 1 else ''}{X86_CONDITION_NAMES[code >> 1]}"
+                handler = self.op_fused_cmp_jcc
+                need = X86_COMPARISONS[code >> 1] is None # O, S, P - только по флагам
+                operand = (code >> 1, code & 1, following[4])
+            # флаги нужны, если их может прочитать кто-то на любом из двух путей
+            need = need or not (self.flags_dead(pos, pages) and self.flags_dead((pos + following[4]) & 0xFFFFF, pages))
+        pages.add((pos - 1) >> X86_CODE_PAGE_SHIFT)
+        return (handler, pos - address, entry[2], entry[3], entry[4], entry[5], entry[6], opcode,
+                parts[-1][8], tuple(parts), name, need, operand)
+
+    def flags_dead(self, address, pages):
+        """Арифметические флаги перезаписываются раньше, чем их прочтут: вперёд через
+        инструкции, которые флагов не касаются. Страницы просмотренного кода держат склейку"""
+        for _ in range(MAX_FUSED_RUN):
+            following = self.peek(address)
+            if following is None:
+                return False
+            pages.add(address >> X86_CODE_PAGE_SHIFT)
+            pages.add(((address + following[1] - 1) & 0xFFFFF) >> X86_CODE_PAGE_SHIFT)
+            opcode = following[7]
+            if opcode < 0x40:
+                return opcode & 7 < 6 and (opcode >> 3) not in (2, 3) # кроме ADC/SBB
+            if 0x80 <= opcode < 0x84:
+                return following[3] not in (2, 3)
+            if opcode in (0x84, 0x85, 0xA8, 0xA9) or (opcode in (0xF6, 0xF7) and following[3] < 2):
+                return True
+            if opcode not in X86_FLAGS_UNTOUCHED:
+                return False
+            address = (address + following[1]) & 0xFFFFF
+            if opcode == 0xEB or opcode == 0xE9:
+                address = (address + following[4]) & 0xFFFFF
+        return False
+
+    def invalidate(self, lo, hi):
+        """Запись в страницы с кодом: декодированные инструкции этих страниц выбрасываются"""
+        code_pages = self.code_pages
+        cache = self.cache
+        heat = self.translator.heat if self.translator is not None else {}
+        for page in range(lo >> X86_CODE_PAGE_SHIFT, ((hi - 1) >> X86_CODE_PAGE_SHIFT) + 1):
+            if code_pages[page]:
+                code_pages[page] = 0
+                for address in self.page_entries.pop(page, ()):
+                    cache.pop(address, None)
+                    heat.pop(address, None) # блок снова греется с нуля
+
+    # память и операнды
+    def ea(self, rm):
+        function, disp, segment = rm
+        return ((self.sregs[segment] << 4) + ((function(self.regs) + disp) & 0xFFFF)) & 0xFFFFF
+
+    def read16(self, address):
+        mem = self.mem
+        return mem[address] | (mem[(address + 1) & 0xFFFFF] << 8)
+
+    def write8(self, address, value):
+        self.mem[address] = value
+        self.writes += 1
+        if self.code_pages[address >> X86_CODE_PAGE_SHIFT]:
+            self.invalidate(address, address + 1)
+
+    def write16(self, address, value):
+        mem = self.mem
+        high = (address + 1) & 0xFFFFF
+        mem[address] = value & 0xFF
+        mem[high] = value >> 8
+        self.writes += 1
+        code_pages = self.code_pages
+        if code_pages[address >> X86_CODE_PAGE_SHIFT] or code_pages[high >> X86_CODE_PAGE_SHIFT]:
+            self.invalidate(address, address + 2)
+
+    def get8(self, rm):
+        # rm - номер регистра (0-3 младшие, 4-7 старшие байты) или операнд в памяти
+        if rm.__class__ is int:
+            return self.regs[rm] & 0xFF if rm < 4 else self.regs[rm - 4] >> 8
+        return self.mem[self.ea(rm)]
+
+    def set8(self, rm, value):
+        if rm.__class__ is int:
+            regs = self.regs
+            if rm < 4:
+                regs[rm] = (regs[rm] & 0xFF00) | value
+            else:
+                regs[rm - 4] = (regs[rm - 4] & 0x00FF) | (value << 8)
+        else:
+            self.write8(self.ea(rm), value)
+
+    def get16(self, rm):
+        if rm.__class__ is int:
+            return self.regs[rm]
+        return self.read16(self.ea(rm))
+
+    def set16(self, rm, value):
+        if rm.__class__ is int:
+            self.regs[rm] = value
+        else:
+            self.write16(self.ea(rm), value)
+
+    def push(self, value):
+        regs = self.regs
+        sp = regs[R_SP] = (regs[R_SP] - 2) & 0xFFFF
+        self.write16(((self.sregs[S_SS] << 4) + sp) & 0xFFFFF, value)
+
+    def pop(self):
+        regs = self.regs
+        sp = regs[R_SP]
+        regs[R_SP] = (sp + 2) & 0xFFFF
+        return self.read16(((self.sregs[S_SS] << 4) + sp) & 0xFFFFF)
+
+    def segment_base(self, e):
+        return self.sregs[S_DS if e[5] is None else e[5]] << 4
+
+    # прерывания
+    def interrupt(self, vector):
+        """INT n: вектор гостя из IVT в памяти, пустой вектор - нативный сервис"""
+        mem = self.mem
+        base = vector << 2
+        offset = mem[base] | (mem[base + 1] << 8)
+        segment = mem[base + 2] | (mem[base + 3] << 8)
+        if not (offset or segment):
+            handler = self.cpu.interrupt_table[vector]
+            if handler is not None:
+                self.call_native(handler, vector)
+            return
+        self.push(self.flags)
+        self.push(self.sregs[S_CS])
+        self.push(self.ip)
+        self.flags &= ~(X86_IF | X86_TF)
+        self.sregs[S_CS] = segment
+        self.ip = offset
+
+    def call_native(self, handler, vector):
+        cpu = self.cpu
+        registers = cpu.registers
+        flags = self.flags
+        self.store_registers()
+        # нативные сервисы пишут ZF в бит 0, CF в бит 1
+        registers['FLAGS'] = (1 if flags & X86_ZF else 0) | (2 if flags & X86_CF else 0)
+        cpu.key_wait = False
+        handler(vector)
+        result = registers['FLAGS']
+        registers['FLAGS'] = (flags & ~(X86_ZF | X86_CF)) | (X86_ZF if result & 1 else 0) | (X86_CF if result & 2 else 0)
+        self.load_registers()
+        if not cpu.os_loaded:
+            self.running = False # INT 21h/4Ch
+
+    def wake(self):
+        # IF мог открыться при ожидающих IRQ
+        if self.flags & X86_IF and self.cpu.pic.pending:
+            self.cpu.request_service()
+
+    # АЛУ: 0 ADD, 1 OR, 2 ADC, 3 SBB, 4 AND, 5 SUB, 6 XOR, 7 CMP
+    def alu8(self, op, a, b):
+        if op == 0 or op == 2:
+            r = a + b + (self.flags & X86_CF if op == 2 else 0)
+            f = (r >> 8) | (((a ^ r) & (b ^ r) & 0x80) << 4) | ((a ^ b ^ r) & X86_AF)
+        elif op == 5 or op == 7 or op == 3:
+            r = a - b - (self.flags & X86_CF if op == 3 else 0)
+            f = ((r >> 8) & X86_CF) | (((a ^ b) & (a ^ r) & 0x80) << 4) | ((a ^ b ^ r) & X86_AF)
+        else:
+            r = a | b if op == 1 else a & b if op == 4 else a ^ b
+            f = 0
+        r &= 0xFF
+        self.flags = (self.flags & ~X86_ARITH) | f | SZP8[r]
+        return r
+
+    def alu16(self, op, a, b):
+        if op == 0 or op == 2:
+            r = a + b + (self.flags & X86_CF if op == 2 else 0)
+            f = (r >> 16) | (((a ^ r) & (b ^ r) & 0x8000) >> 4) | ((a ^ b ^ r) & X86_AF)
+        elif op == 5 or op == 7 or op == 3:
+            r = a - b - (self.flags & X86_CF if op == 3 else 0)
+            f = ((r >> 16) & X86_CF) | (((a ^ b) & (a ^ r) & 0x8000) >> 4) | ((a ^ b ^ r) & X86_AF)
+        else:
+            r = a | b if op == 1 else a & b if op == 4 else a ^ b
+            f = 0
+        r &= 0xFFFF
+        self.flags = (self.flags & ~X86_ARITH) | f | (X86_ZF if r == 0 else 0) | ((r >> 8) & X86_SF) | PARITY[r & 0xFF]
+        return r
+
+    def incdec8(self, a, delta):
+        r = (a + delta) & 0xFF
+        overflow = r == (0x80 if delta > 0 else 0x7F)
+        self.flags = ((self.flags & (X86_CF | ~X86_ARITH)) | SZP8[r] | ((a ^ r ^ 1) & X86_AF)
+                      | (X86_OF if overflow else 0))
+        return r
+
+    def incdec16(self, a, delta):
+        r = (a + delta) & 0xFFFF
+        overflow = r == (0x8000 if delta > 0 else 0x7FFF)
+        self.flags = ((self.flags & (X86_CF | ~X86_ARITH)) | (X86_ZF if r == 0 else 0) | ((r >> 8) & X86_SF)
+                      | PARITY[r & 0xFF] | ((a ^ r ^ 1) & X86_AF) | (X86_OF if overflow else 0))
+        return r
+
+    def shift(self, op, value, count, bits):
+        """ROL ROR RCL RCR SHL SHR SAL SAR; count уже не ноль"""
+        mask = (1 << bits) - 1
+        top = bits - 1
+        flags = self.flags
+        if op < 4:
+            if op < 2:
+                count %= bits
+                if op == 0:
+                    r = ((value << count) | (value >> (bits - count))) & mask
+                    cf = r & 1
+                    of = (r >> top) ^ cf
+                else:
+                    r = ((value >> count) | (value << (bits - count))) & mask
+                    cf = r >> top
+                    of = (r >> top) ^ ((r >> (top - 1)) & 1)
+            else:
+                count %= bits + 1
+                wide = value | ((flags & X86_CF) << bits)
+                if op == 2:
+                    wide = ((wide << count) | (wide >> (bits + 1 - count))) & ((mask << 1) | 1)
+                    r = wide & mask
+                    cf = wide >> bits
+                    of = (r >> top) ^ cf
+                else:
+                    wide = ((wide >> count) | (wide << (bits + 1 - count))) & ((mask << 1) | 1)
+                    r = wide & mask
+                    cf = wide >> bits
+                    of = (r >> top) ^ ((r >> (top - 1)) & 1)
+            self.flags = (flags & ~(X86_CF | X86_OF)) | cf | (of << 11)
+            return r
+        if op == 5:
+            cf = (value >> (count - 1)) & 1
+            r = value >> count
+            of = value >> top
+        elif op == 7:
+            signed = value - (1 << bits) if value >> top else value
+            cf = (signed >> (count - 1)) & 1
+            r = (signed >> count) & mask
+            of = 0
+        else:
+            wide = value << count
+            cf = (wide >> bits) & 1
+            r = wide & mask
+            of = (r >> top) ^ cf
+        szp = SZP8[r] if bits == 8 else (X86_ZF if r == 0 else 0) | ((r >> 8) & X86_SF) | PARITY[r & 0xFF]
+        self.flags = (flags & ~X86_ARITH) | cf | szp | (of << 11)
+        return r
+
+    # обработчики: e = (обработчик, длина, rm, reg, imm, сегмент, rep, опкод), IP уже за инструкцией
+    def op_alu_rm8(self, e):
+        op = e[7] >> 3
+        result = self.alu8(op, self.get8(e[2]), self.get8(e[3]))
+        if op != 7:
+            self.set8(e[2], result)
+
+    def op_alu_rm16(self, e):
+        op = e[7] >> 3
+        result = self.alu16(op, self.get16(e[2]), self.regs[e[3]])
+        if op != 7:
+            self.set16(e[2], result)
+
+    def op_alu_r8(self, e):
+        op = e[7] >> 3
+        result = self.alu8(op, self.get8(e[3]), self.get8(e[2]))
+        if op != 7:
+            self.set8(e[3], result)
+
+    def op_alu_r16(self, e):
+        op = e[7] >> 3
+        result = self.alu16(op, self.regs[e[3]], self.get16(e[2]))
+        if op != 7:
+            self.regs[e[3]] = result
+
+    def op_alu_al(self, e):
+        op = e[7] >> 3
+        regs = self.regs
+        result = self.alu8(op, regs[R_AX] & 0xFF, e[4])
+        if op != 7:
+            regs[R_AX] = (regs[R_AX] & 0xFF00) | result
+
+    def op_alu_ax(self, e):
+        op = e[7] >> 3
+        result = self.alu16(op, self.regs[R_AX], e[4])
+        if op != 7:
+            self.regs[R_AX] = result
+
+    def op_group1_8(self, e):
+        op = e[3]
+        result = self.alu8(op, self.get8(e[2]), e[4])
+        if op != 7:
+            self.set8(e[2], result)
+
+    def op_group1_16(self, e):
+        op = e[3]
+        result = self.alu16(op, self.get16(e[2]), e[4] & 0xFFFF)
+        if op != 7:
+            self.set16(e[2], result)
+
+    def op_test_rm8(self, e):
+        self.alu8(4, self.get8(e[2]), self.get8(e[3]))
+
+    def op_test_rm16(self, e):
+        self.alu16(4, self.get16(e[2]), self.regs[e[3]])
+
+    def op_test_al(self, e):
+        self.alu8(4, self.regs[R_AX] & 0xFF, e[4])
+
+    def op_test_ax(self, e):
+        self.alu16(4, self.regs[R_AX], e[4])
+
+    def op_inc16(self, e):
+        self.regs[e[3]] = self.incdec16(self.regs[e[3]], 1)
+
+    def op_dec16(self, e):
+        self.regs[e[3]] = self.incdec16(self.regs[e[3]], -1)
+
+    def op_push16(self, e):
+        self.push(self.regs[e[3]])
+
+    def op_pop16(self, e):
+        self.regs[e[3]] = self.pop()
+
+    def op_push_sreg(self, e):
+        self.push(self.sregs[(e[7] >> 3) & 3])
+
+    def op_pop_sreg(self, e):
+        self.sregs[(e[7] >> 3) & 3] = self.pop()
+
+    def op_pusha(self, e):
+        regs = self.regs
+        sp = regs[R_SP]
+        for index in range(8):
+            self.push(sp if index == R_SP else regs[index])
+
+    def op_popa(self, e):
+        regs = self.regs
+        for index in reversed(range(8)):
+            value = self.pop()
+            if index != R_SP:
+                regs[index] = value
+
+    def op_push_imm(self, e):
+        self.push(e[4] & 0xFFFF)
+
+    def op_daa(self, e):
+        self.decimal_adjust(1)
+
+    def op_das(self, e):
+        self.decimal_adjust(-1)
+
+    def decimal_adjust(self, sign):
+        regs = self.regs
+        flags = self.flags
+        al = old = regs[R_AX] & 0xFF
+        f = 0
+        if (al & 0x0F) > 9 or flags & X86_AF:
+            al += 6 * sign
+            f |= X86_AF
+        if old > 0x99 or flags & X86_CF:
+            al += 0x60 * sign
+            f |= X86_CF
+        al &= 0xFF
+        regs[R_AX] = (regs[R_AX] & 0xFF00) | al
+        self.flags = (flags & ~X86_ARITH) | f | SZP8[al]
+
+    def op_aaa(self, e):
+        self.ascii_adjust(1)
+
+    def op_aas(self, e):
+        self.ascii_adjust(-1)
+
+    def ascii_adjust(self, sign):
+        regs = self.regs
+        ax = regs[R_AX]
+        if (ax & 0x0F) > 9 or self.flags & X86_AF:
+            ax = (ax + 0x106 * sign) & 0xFFFF
+            self.flags |= X86_AF | X86_CF
+        else:
+            self.flags &= ~(X86_AF | X86_CF)
+        regs[R_AX] = ax & 0xFF0F
+
+    def op_jcc(self, e):
+        code = e[7] & 0x0F
+        if (not X86_CONDITIONS[code >> 1](self.flags)) == (code & 1):
+            self.ip = (self.ip + e[4]) & 0xFFFF
+
+    # склейки: e[9] - исходные записи, e[10] - имя для счётчика, e[11] - нужны ли флаги
+    def fused_first(self, e):
+        # склейка не влезает до дедлайна: только первая инструкция, как в интерпретаторе
+        first = e[9][0]
+        self.ip = (self.ip - e[1] + first[1]) & 0xFFFF
+        first[0](first)
+
+    def op_fused_cmp_jcc(self, e):
+        scheduler = self.scheduler
+        if scheduler.cycles + 1 >= scheduler.deadline:
+            return self.fused_first(e)
+        scheduler.cycles += 1
+        self.fusions[e[10]] += 1
+        opcode = e[7]
+        wide = opcode & 1
+        get = self.get16 if wide else self.get8
+        if opcode < 0x3C:
+            a, b = (get(e[3]), get(e[2])) if opcode & 2 else (get(e[2]), get(e[3]))
+        elif opcode < 0x3E:
+            a, b = self.regs[R_AX] if wide else self.regs[R_AX] & 0xFF, e[4]
+        else:
+            a, b = get(e[2]), e[4] & 0xFFFF
+        condition, negate, displacement = e[12]
+        if e[11]:
+            (self.alu16 if wide else self.alu8)(7, a, b)
+            taken = X86_CONDITIONS[condition](self.flags)
+        else:
+            if condition >= 6:
+                half = 0x8000 if wide else 0x80
+                a -= (a & half) << 1
+                b -= (b & half) << 1
+            taken = X86_COMPARISONS[condition](a, b)
+        if (not taken) == negate:
+            self.ip = (self.ip + displacement) & 0xFFFF
+
+    def op_fused_dec_jnz(self, e):
+        scheduler = self.scheduler
+        if scheduler.cycles + 1 >= scheduler.deadline:
+            return self.fused_first(e)
+        scheduler.cycles += 1
+        self.fusions[e[10]] += 1
+        regs = self.regs
+        if e[11]:
+            value = regs[e[3]] = self.incdec16(regs[e[3]], -1)
+        else:
+            value = regs[e[3]] = (regs[e[3]] - 1) & 0xFFFF
+        if value:
+            self.ip = (self.ip + e[12]) & 0xFFFF
+
+    def op_fused_push(self, e):
+        # серия без SP: указатель стека двигается один раз
+        scheduler = self.scheduler
+        registers = e[12]
+        extra = len(registers) - 1
+        if scheduler.cycles + extra >= scheduler.deadline:
+            return self.fused_first(e)
+        scheduler.cycles += extra
+        self.fusions[e[10]] += 1
+        regs = self.regs
+        write16 = self.write16
+        base = self.sregs[S_SS] << 4
+        sp = regs[R_SP]
+        for index in registers:
+            sp = (sp - 2) & 0xFFFF
+            write16((base + sp) & 0xFFFFF, regs[index])
+        regs[R_SP] = sp
+
+    def op_fused_pop(self, e):
+        scheduler = self.scheduler
+        registers = e[12]
+        extra = len(registers) - 1
+        if scheduler.cycles + extra >= scheduler.deadline:
+            return self.fused_first(e)
+        scheduler.cycles += extra
+        self.fusions[e[10]] += 1
+        regs = self.regs
+        read16 = self.read16
+        base = self.sregs[S_SS] << 4
+        sp = regs[R_SP]
+        for index in registers:
+            regs[index] = read16((base + sp) & 0xFFFFF)
+            sp = (sp + 2) & 0xFFFF
+        regs[R_SP] = sp
+
+    def op_xchg_rm8(self, e):
+        value = self.get8(e[2])
+        self.set8(e[2], self.get8(e[3]))
+        self.set8(e[3], value)
+
+    def op_xchg_rm16(self, e):
+        value = self.get16(e[2])
+        self.set16(e[2], self.regs[e[3]])
+        self.regs[e[3]] = value
+
+    def op_xchg_ax(self, e):
+        regs = self.regs
+        regs[R_AX], regs[e[3]] = regs[e[3]], regs[R_AX]
+
+    def op_mov_rm8(self, e):
+        self.set8(e[2], self.get8(e[3]))
+
+    def op_mov_rm16(self, e):
+        self.set16(e[2], self.regs[e[3]])
+
+    def op_mov_r8(self, e):
+        self.set8(e[3], self.get8(e[2]))
+
+    def op_mov_r16(self, e):
+        self.regs[e[3]] = self.get16(e[2])
+
+    def op_mov_rm_sreg(self, e):
+        self.set16(e[2], self.sregs[e[3] & 3])
+
+    def op_mov_sreg_rm(self, e):
+        self.sregs[e[3] & 3] = self.get16(e[2])
+
+    def op_lea(self, e):
+        function, disp, segment = e[2]
+        self.regs[e[3]] = (function(self.regs) + disp) & 0xFFFF
+
+    def op_pop_rm(self, e):
+        self.set16(e[2], self.pop())
+
+    def op_mov_r8_imm(self, e):
+        self.set8(e[3], e[4])
+
+    def op_mov_r16_imm(self, e):
+        self.regs[e[3]] = e[4]
+
+    def op_mov_rm8_imm(self, e):
+        self.set8(e[2], e[4])
+
+    def op_mov_rm16_imm(self, e):
+        self.set16(e[2], e[4])
+
+    def op_mov_acc_moffs(self, e):
+        address = (self.segment_base(e) + e[4]) & 0xFFFFF
+        regs = self.regs
+        if e[7] & 1:
+            regs[R_AX] = self.read16(address)
+        else:
+            regs[R_AX] = (regs[R_AX] & 0xFF00) | self.mem[address]
+
+    def op_mov_moffs_acc(self, e):
+        address = (self.segment_base(e) + e[4]) & 0xFFFFF
+        if e[7] & 1:
+            self.write16(address, self.regs[R_AX])
+        else:
+            self.write8(address, self.regs[R_AX] & 0xFF)
+
+    def op_load_far(self, e):
+        # LES/LDS: reg <- [m], ES/DS <- [m+2]
+        address = self.ea(e[2])
+        self.regs[e[3]] = self.read16(address)
+        self.sregs[S_DS if e[7] & 1 else S_ES] = self.read16((address + 2) & 0xFFFFF)
+
+    def op_cbw(self, e):
+        al = self.regs[R_AX] & 0xFF
+        self.regs[R_AX] = al | 0xFF00 if al & 0x80 else al
+
+    def op_cwd(self, e):
+        self.regs[R_DX] = 0xFFFF if self.regs[R_AX] & 0x8000 else 0
+
+    def op_nop(self, e):
+        pass
+
+    def op_esc(self, e):
+        pass # сопроцессора нет
+
+    def op_pushf(self, e):
+        self.push(self.flags)
+
+    def op_popf(self, e):
+        self.flags = (self.pop() & 0x0FD5) | 0x0002
+        self.wake()
+
+    def op_sahf(self, e):
+        self.flags = (self.flags & 0xFF00) | ((self.regs[R_AX] >> 8) & 0xD5) | 0x0002
+
+    def op_lahf(self, e):
+        regs = self.regs
+        regs[R_AX] = (regs[R_AX] & 0x00FF) | ((self.flags & 0xFF) << 8)
+
+    # строковые: за один вызов все повторы REP
+    def string_step(self, e):
+        size = 1 + (e[7] & 1)
+        return -size if self.flags & X86_DF else size
+
+    def op_movs(self, e):
+        regs = self.regs
+        mem = self.mem
+        step = self.string_step(e)
+        source = self.segment_base(e)
+        dest = self.sregs[S_ES] << 4
+        si, di = regs[R_SI], regs[R_DI]
+        for _ in range(regs[R_CX] if e[6] else 1):
+            if e[7] & 1:
+                self.write16((dest + di) & 0xFFFFF, self.read16((source + si) & 0xFFFFF))
+            else:
+                self.write8((dest + di) & 0xFFFFF, mem[(source + si) & 0xFFFFF])
+            si = (si + step) & 0xFFFF
+            di = (di + step) & 0xFFFF
+        regs[R_SI], regs[R_DI] = si, di
+        if e[6]:
+            regs[R_CX] = 0
+
+    def op_stos(self, e):
+        regs = self.regs
+        step = self.string_step(e)
+        dest = self.sregs[S_ES] << 4
+        di = regs[R_DI]
+        for _ in range(regs[R_CX] if e[6] else 1):
+            if e[7] & 1:
+                self.write16((dest + di) & 0xFFFFF, regs[R_AX])
+            else:
+                self.write8((dest + di) & 0xFFFFF, regs[R_AX] & 0xFF)
+            di = (di + step) & 0xFFFF
+        regs[R_DI] = di
+        if e[6]:
+            regs[R_CX] = 0
+
+    def op_lods(self, e):
+        regs = self.regs
+        step = self.string_step(e)
+        source = self.segment_base(e)
+        si = regs[R_SI]
+        for _ in range(regs[R_CX] if e[6] else 1):
+            if e[7] & 1:
+                regs[R_AX] = self.read16((source + si) & 0xFFFFF)
+            else:
+                regs[R_AX] = (regs[R_AX] & 0xFF00) | self.mem[(source + si) & 0xFFFFF]
+            si = (si + step) & 0xFFFF
+        regs[R_SI] = si
+        if e[6]:
+            regs[R_CX] = 0
+
+    def op_cmps(self, e):
+        regs = self.regs
+        mem = self.mem
+        step = self.string_step(e)
+        source = self.segment_base(e)
+        dest = self.sregs[S_ES] << 4
+        si, di = regs[R_SI], regs[R_DI]
+        rep = e[6]
+        count = regs[R_CX] if rep else 1
+        while count:
+            if e[7] & 1:
+                self.alu16(7, self.read16((source + si) & 0xFFFFF), self.read16((dest + di) & 0xFFFFF))
+            else:
+                self.alu8(7, mem[(source + si) & 0xFFFFF], mem[(dest + di) & 0xFFFFF])
+            si = (si + step) & 0xFFFF
+            di = (di + step) & 0xFFFF
+            count -= 1
+            if rep and (not self.flags & X86_ZF) == (rep == 0xF3):
+                break # REPE до неравенства, REPNE до равенства
+        regs[R_SI], regs[R_DI] = si, di
+        if rep:
+            regs[R_CX] = count
+
+    def op_scas(self, e):
+        regs = self.regs
+        step = self.string_step(e)
+        dest = self.sregs[S_ES] << 4
+        di = regs[R_DI]
+        rep = e[6]
+        count = regs[R_CX] if rep else 1
+        while count:
+            if e[7] & 1:
+                self.alu16(7, regs[R_AX], self.read16((dest + di) & 0xFFFFF))
+            else:
+                self.alu8(7, regs[R_AX] & 0xFF, self.mem[(dest + di) & 0xFFFFF])
+            di = (di + step) & 0xFFFF
+            count -= 1
+            if rep and (not self.flags & X86_ZF) == (rep == 0xF3):
+                break
+        regs[R_DI] = di
+        if rep:
+            regs[R_CX] = count
+
+    # переходы и вызовы
+    def op_call_rel(self, e):
+        self.push(self.ip)
+        if self.cpu.sampler is not None:
+            self.cpu.sampler.call((self.sregs[S_CS] << 4) + self.ip)
+        self.ip = (self.ip + e[4]) & 0xFFFF
+
+    def op_call_far(self, e):
+        self.push(self.sregs[S_CS])
+        self.push(self.ip)
+        if self.cpu.sampler is not None:
+            self.cpu.sampler.call((self.sregs[S_CS] << 4) + self.ip)
+        self.sregs[S_CS] = e[3]
+        self.ip = e[4]
+
+    def op_jmp_rel(self, e):
+        self.ip = (self.ip + e[4]) & 0xFFFF
+
+    def op_jmp_far(self, e):
+        self.sregs[S_CS] = e[3]
+        self.ip = e[4]
+
+    def op_ret(self, e):
+        self.ip = self.pop()
+        if e[4]:
+            self.regs[R_SP] = (self.regs[R_SP] + e[4]) & 0xFFFF
+        if self.cpu.sampler is not None:
+            self.cpu.sampler.ret()
+
+    def op_retf(self, e):
+        self.ip = self.pop()
+        self.sregs[S_CS] = self.pop()
+        if e[4]:
+            self.regs[R_SP] = (self.regs[R_SP] + e[4]) & 0xFFFF
+        if self.cpu.sampler is not None:
+            self.cpu.sampler.ret()
+
+    def op_leave(self, e):
+        self.regs[R_SP] = self.regs[R_BP]
+        self.regs[R_BP] = self.pop()
+
+    def op_loop(self, e):
+        # E0 LOOPNE, E1 LOOPE, E2 LOOP, E3 JCXZ
+        opcode = e[7]
+        regs = self.regs
+        if opcode == 0xE3:
+            taken = regs[R_CX] == 0
+        else:
+            count = regs[R_CX] = (regs[R_CX] - 1) & 0xFFFF
+            taken = count != 0 and (opcode == 0xE2 or bool(self.flags & X86_ZF) == (opcode == 0xE1))
+        if taken:
+            self.ip = (self.ip + e[4]) & 0xFFFF
+
+    def op_int(self, e):
+        self.interrupt(e[4])
+        if self.cpu.key_wait:
+            # INT 16h без клавиши: BIOS ждал бы, повторяем инструкцию после кадра хоста
+            self.cpu.key_wait = False
+            self.ip = (self.ip - e[1]) & 0xFFFF
+            self.idle()
+
+    def op_int3(self, e):
+        cpu = self.cpu
+        address = ((self.sregs[S_CS] << 4) + self.ip - 1) & 0xFFFFF
+        if address not in cpu.breakpoints:
+            self.interrupt(3) # настоящий INT 3 гостя
+            return
+        # ловушка отладчика: IP на начало инструкции, дальше исполнится исходный байт
+        self.ip = (self.ip - e[1]) & 0xFFFF
+        self.store_registers()
+        cpu.hit_breakpoint(address)
+        self.load_registers()
+
+    def op_into(self, e):
+        if self.flags & X86_OF:
+            self.interrupt(4)
+
+    def op_iret(self, e):
+        self.ip = self.pop()
+        self.sregs[S_CS] = self.pop()
+        self.flags = (self.pop() & 0x0FD5) | 0x0002
+        self.wake()
+
+    # сдвиги и группы
+    def op_shift(self, e):
+        opcode = e[7]
+        if opcode < 0xD0:
+            count = e[4]
+        else:
+            count = 1 if opcode < 0xD2 else self.regs[R_CX] & 0xFF
+        count &= 0x1F
+        if not count:
+            return
+        if opcode & 1:
+            self.set16(e[2], self.shift(e[3], self.get16(e[2]), count, 16))
+        else:
+            self.set8(e[2], self.shift(e[3], self.get8(e[2]), count, 8))
+
+    def op_group3(self, e):
+        # TEST NOT NEG MUL IMUL DIV IDIV
+        op = e[3]
+        rm = e[2]
+        regs = self.regs
+        if e[7] & 1:
+            bits, mask, value = 16, 0xFFFF, self.get16(rm)
+            alu, store = self.alu16, self.set16
+            dividend = (regs[R_DX] << 16) | regs[R_AX]
+        else:
+            bits, mask, value = 8, 0xFF, self.get8(rm)
+            alu, store = self.alu8, self.set8
+            dividend = regs[R_AX]
+        if op < 2:
+            alu(4, value, e[4])
+        elif op == 2:
+            store(rm, ~value & mask)
+        elif op == 3:
+            store(rm, alu(5, 0, value))
+        elif op < 6:
+            accumulator = dividend & mask
+            if op == 5:
+                half = 1 << (bits - 1)
+                accumulator -= (accumulator & half) << 1
+                value -= (value & half) << 1
+            product = accumulator * value
+            if bits == 16:
+                regs[R_AX] = product & 0xFFFF
+                regs[R_DX] = (product >> 16) & 0xFFFF
+            else:
+                regs[R_AX] = product & 0xFFFF
+            fits = -half <= product < half if op == 5 else product <= mask
+            self.flags = (self.flags & ~(X86_CF | X86_OF)) | (0 if fits else X86_CF | X86_OF)
+        else:
+            if op == 7:
+                half = 1 << (bits - 1)
+                dividend -= (dividend & (half << bits)) << 1
+                value -= (value & half) << 1
+            if value == 0:
+                self.interrupt(0)
+                return
+            quotient = abs(dividend) // abs(value)
+            if (dividend < 0) != (value < 0):
+                quotient = -quotient
+            remainder = dividend - quotient * value
+            if (op == 6 and quotient > mask) or (op == 7 and not -half <= quotient < half):
+                self.interrupt(0)
+                return
+            if bits == 16:
+                regs[R_AX] = quotient & 0xFFFF
+                regs[R_DX] = remainder & 0xFFFF
+            else:
+                regs[R_AX] = ((remainder & 0xFF) << 8) | (quotient & 0xFF)
+
+    def op_group4(self, e):
+        if e[3] > 1:
+            raise RuntimeError(f"Invalid FE /{e[3]}")
+        self.set8(e[2], self.incdec8(self.get8(e[2]), 1 if e[3] == 0 else -1))
+
+    def op_group5(self, e):
+        # INC DEC CALL CALLF JMP JMPF PUSH
+        op = e[3]
+        rm = e[2]
+        if op < 2:
+            self.set16(rm, self.incdec16(self.get16(rm), 1 if op == 0 else -1))
+        elif op == 2 or op == 4:
+            target = self.get16(rm)
+            if op == 2:
+                self.push(self.ip)
+                if self.cpu.sampler is not None:
+                    self.cpu.sampler.call((self.sregs[S_CS] << 4) + self.ip)
+            self.ip = target
+        elif op == 3 or op == 5:
+            address = self.ea(rm)
+            offset = self.read16(address)
+            segment = self.read16((address + 2) & 0xFFFFF)
+            if op == 3:
+                self.push(self.sregs[S_CS])
+                self.push(self.ip)
+                if self.cpu.sampler is not None:
+                    self.cpu.sampler.call((self.sregs[S_CS] << 4) + self.ip)
+            self.sregs[S_CS] = segment
+            self.ip = offset
+        elif op == 6:
+            self.push(self.get16(rm))
+        else:
+            raise RuntimeError("Invalid FF /7")
+
+    def op_aam(self, e):
+        regs = self.regs
+        if not e[4]:
+            self.interrupt(0)
+            return
+        al = regs[R_AX] & 0xFF
+        high, low = divmod(al, e[4])
+        regs[R_AX] = (high << 8) | low
+        self.flags = (self.flags & ~X86_ARITH) | SZP8[low]
+
+    def op_aad(self, e):
+        regs = self.regs
+        al = ((regs[R_AX] & 0xFF) + (regs[R_AX] >> 8) * e[4]) & 0xFF
+        regs[R_AX] = al
+        self.flags = (self.flags & ~X86_ARITH) | SZP8[al]
+
+    def op_xlat(self, e):
+        regs = self.regs
+        offset = (regs[R_BX] + (regs[R_AX] & 0xFF)) & 0xFFFF
+        regs[R_AX] = (regs[R_AX] & 0xFF00) | self.mem[(self.segment_base(e) + offset) & 0xFFFFF]
+
+    # порты: через шину ЦП
+    def op_in(self, e):
+        opcode = e[7]
+        port = self.regs[R_DX] if opcode & 0x08 else e[4]
+        read = self.cpu.io.read
+        regs = self.regs
+        if opcode & 1:
+            regs[R_AX] = read(port) | (read((port + 1) & 0xFFFF) << 8)
+        else:
+            regs[R_AX] = (regs[R_AX] & 0xFF00) | read(port)
+
+    def op_out(self, e):
+        opcode = e[7]
+        port = self.regs[R_DX] if opcode & 0x08 else e[4]
+        write = self.cpu.io.write
+        ax = self.regs[R_AX]
+        write(port, ax & 0xFF)
+        if opcode & 1:
+            write((port + 1) & 0xFFFF, ax >> 8)
+
+    # флаги и останов
+    def op_hlt(self, e):
+        if self.flags & X86_IF:
+            self.idle()
+        else:
+            self.halt()
+
+    def op_cmc(self, e):
+        self.flags ^= X86_CF
+
+    def op_flag(self, e):
+        # F8-FD: CLC STC CLI STI CLD STD
+        opcode = e[7]
+        bit = X86_FLAG_BITS[(opcode - 0xF8) >> 1]
+        if opcode & 1:
+            self.flags |= bit
+            self.wake()
+        else:
+            self.flags &= ~bit
+
+class BlockTranslator:
+    """Горячий базовый блок x86 -> исходник Python: регистры в локальных переменных,
+    операнды инструкций подставлены константами, compile() один раз на блок.
+    Чего транслятор не знает, вызывается обработчиком движка со сбросом локальных"""
+    REGS = ('ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di')
+    ALU_OPERATORS = {1: '|', 4: '&', 6: '^'}
+    CONDITIONS = ('f & 0x800', 'f & 0x1', 'f & 0x40', 'f & 0x41', 'f & 0x80', 'f & 0x4',
+                  '(f ^ (f >> 4)) & 0x80', '((f ^ (f >> 4)) & 0x80) or f & 0x40')
+
+    def __init__(self, engine, threshold=HOT_BLOCK_THRESHOLD):
+        self.engine = engine
+        self.threshold = threshold
+        self.heat = {} # адрес начала блока -> сколько раз туда пришли
+        self.translated = 0
+        self.globals = {
+            'engine': engine, 'regs': engine.regs, 'sregs': engine.sregs, 'mem': engine.mem,
+            'scheduler': engine.cpu.scheduler, 'w8': engine.write8, 'w16': engine.write16,
+            'SZP8': SZP8, 'PARITY': PARITY,
+        }
+
+    def enter(self, address):
+        # вызывается движком после инструкции, завершающей блок
+        count = self.heat.get(address, 0) + 1
+        self.heat[address] = count
+        if count == self.threshold:
+            self.translate(address)
+
+    def translate(self, address):
+        engine = self.engine
+        entries = []
+        pos = address
+        while len(entries) < MAX_BLOCK_INSTRUCTIONS:
+            entry = engine.cache.get(pos)
+            if entry is not None and entry[1] == 0:
+                break # дальше уже оттранслированный блок
+            if entry is None:
+                entry = engine.decode(pos)
+            # склейку транслятор разбирает обратно: флаги он считает по своей живости
+            entries.extend(entry[9] if len(entry) > 9 else (entry,))
+            pos = (pos + entry[1]) & 0xFFFFF
+            if entry[8]:
+                break
+        if not entries:
+            return None
+        namespace = dict(self.globals)
+        source = self.generate(entries, namespace)
+        exec(compile(source, f"<x86 block {address:05X}>", 'exec'), namespace)
+        first = entries[0]
+        # блок в кэше декодера: длина 0, IP двигает сам; завершает блок для счётчика горячих
+        entry = (namespace['block'], 0, None, 0, 0, None, 0, first[7], True, source)
+        engine.cache[address] = entry
+        for page in range(address >> X86_CODE_PAGE_SHIFT, ((pos - 1) >> X86_CODE_PAGE_SHIFT) + 1):
+            engine.code_pages[page] = 1
+            engine.page_entries.setdefault(page, []).append(address)
+        self.translated += 1
+        return entry
+
+    # генерация
+    def generate(self, entries, namespace):
+        self.lines = []
+        self.dirty = set()
+        self.flags_dirty = False
+        count = len(entries)
+        first = entries[0]
+        namespace['first'] = first
+        # время: блок целиком до дедлайна, иначе первая инструкция как в интерпретаторе
+        self.lines += [
+            "def block(entry):",
+            f"    if scheduler.cycles + {count - 1} >= scheduler.deadline:",
+            "        engine.ip = (engine.ip + first[1]) & 0xFFFF",
+            "        first[0](first)",
+            "        return",
+            f"    scheduler.cycles += {count - 1}",
+            "    ip = engine.ip",
+            "    ax, cx, dx, bx, sp, bp, si, di = regs",
+            "    f = engine.flags",
+        ]
+        need = self.live_flags(entries)
+        self.namespace = namespace
+        offset = 0
+        exited = False
+        for index, entry in enumerate(entries):
+            offset += entry[1]
+            self.index = index
+            self.last = index == count - 1
+            generator = getattr(self, 'gen_' + entry[0].__name__[3:], None)
+            if generator is not None:
+                exited = generator(entry, need[index], offset)
+            else:
+                exited = self.generic(entry, offset)
+        if not exited:
+            self.spill()
+            self.emit(f"engine.ip = (ip + {offset}) & 0xFFFF")
+        return '\n'.join(self.lines) + '\n'
+
+    def live_flags(self, entries):
+        """Обратный проход: нужны ли флаги инструкции кому-то дальше (на выходе - всегда)"""
+        need = [True] * len(entries)
+        live = True
+        for index in range(len(entries) - 1, -1, -1):
+            entry = entries[index]
+            name = entry[0].__name__[3:]
+            need[index] = live
+            if not hasattr(self, 'gen_' + name) or self.is_generic(entry):
+                live = True # обработчик движка видит флаги целиком
+            elif name.startswith('alu') or name.startswith('group1'):
+                op = entry[3] if name.startswith('group1') else entry[7] >> 3
+                live = op == 2 or op == 3 # ADC/SBB читают CF
+            elif name.startswith('test'):
+                live = False
+            elif name in ('jcc', 'loop', 'cmc'):
+                live = True
+        return need
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def spill(self):
+        for name in sorted(self.dirty):
+            self.emit(f"regs[{self.REGS.index(name)}] = {name}")
+        self.dirty.clear()
+        if self.flags_dirty:
+            self.emit("engine.flags = f")
+            self.flags_dirty = False
+
+    def is_generic(self, entry):
+        # FE /2+ и CLI/STI транслятор отдаёт движку
+        name = entry[0].__name__[3:]
+        return (name == 'group4' and entry[3] > 1) or (name == 'flag' and entry[7] in (0xFA, 0xFB))
+
+    def generic(self, entry, offset):
+        """Вызов обработчика движка: локальные в регистры, после - обратно"""
+        name = f'e{self.index}'
+        self.namespace[name] = entry
+        self.spill()
+        self.emit(f"engine.ip = (ip + {offset}) & 0xFFFF")
+        self.emit(f"{name}[0]({name})")
+        if not self.last:
+            self.emit("ax, cx, dx, bx, sp, bp, si, di = regs")
+            self.emit("f = engine.flags")
+        return self.last # IP уже выставлен, обработчик перехода мог его сменить
+
+    # операнды
+    def reg8(self, index):
+        name = self.REGS[index & 3]
+        return f"({name} & 0xFF)" if index < 4 else f"({name} >> 8)"
+
+    def set_reg8(self, index, value):
+        name = self.REGS[index & 3]
+        self.dirty.add(name)
+        if index < 4:
+            self.emit(f"{name} = ({name} & 0xFF00) | {value}")
+        else:
+            self.emit(f"{name} = ({name} & 0xFF) | ({value} << 8)")
+
+    def set_reg16(self, index, value):
+        name = self.REGS[index]
+        self.dirty.add(name)
+        self.emit(f"{name} = {value}")
+
+    def offset(self, rm):
+        function, disp, segment = rm
+        parts = list(EA_SOURCE[function])
+        if not parts:
+            return str(disp & 0xFFFF)
+        if disp:
+            parts.append(str(disp))
+        return f"(({' + '.join(parts)}) & 0xFFFF)"
+
+    def operand(self, rm, wide):
+        """(выражение чтения, запись(value)); адрес в памяти считается один раз в 'a'"""
+        if rm.__class__ is int:
+            if wide:
+                return self.REGS[rm], lambda value: self.set_reg16(rm, value)
+            return self.reg8(rm), lambda value: self.set_reg8(rm, value)
+        self.emit(f"a = ((sregs[{rm[2]}] << 4) + {self.offset(rm)}) & 0xFFFFF")
+        if wide:
+            return "(mem[a] | (mem[(a + 1) & 0xFFFFF] << 8))", lambda value: self.emit(f"w16(a, {value})")
+        return "mem[a]", lambda value: self.emit(f"w8(a, {value})")
+
+    def szp(self, wide):
+        if wide:
+            return "(0x40 if t == 0 else 0) | ((t >> 8) & 0x80) | PARITY[t & 0xFF]"
+        return "SZP8[t]"
+
+    def alu(self, op, left, right, wide, need):
+        """Код АЛУ с результатом в t; флаги только если их кто-то прочтёт"""
+        mask = 0xFFFF if wide else 0xFF
+        sign = 0x8000 if wide else 0x80
+        if op in self.ALU_OPERATORS:
+            self.emit(f"t = {left} {self.ALU_OPERATORS[op]} {right}")
+            if need:
+                self.flags_dirty = True
+                self.emit(f"f = (f & {~X86_ARITH & 0xFFFF:#x}) | {self.szp(wide)}")
+            return
+        self.emit(f"x = {left}")
+        if not right.isdigit():
+            self.emit(f"y = {right}")
+            right = 'y'
+        carry = " + (f & 1)" if op == 2 else " - (f & 1)" if op == 3 else ""
+        operator = '+' if op == 0 or op == 2 else '-'
+        if not need:
+            self.emit(f"t = (x {operator} {right}{carry}) & {mask:#x}")
+            return
+        self.flags_dirty = True
+        self.emit(f"t = x {operator} {right}{carry}")
+        shift = f">> 4" if wide else f"<< 4"
+        if operator == '+':
+            overflow = f"(((x ^ t) & ({right} ^ t) & {sign:#x}) {shift})"
+        else:
+            overflow = f"(((x ^ {right}) & (x ^ t) & {sign:#x}) {shift})"
+        self.emit(f"f = (f & {~X86_ARITH & 0xFFFF:#x}) | ((t >> {16 if wide else 8}) & 1) | {overflow} | ((x ^ {right} ^ t) & 0x10)")
+        self.emit(f"t &= {mask:#x}")
+        self.emit(f"f |= {self.szp(wide)}")
+
+    def incdec(self, read, write, delta, wide, need):
+        mask = 0xFFFF if wide else 0xFF
+        self.emit(f"x = {read}")
+        self.emit(f"t = (x {'+' if delta > 0 else '-'} 1) & {mask:#x}")
+        if need:
+            self.flags_dirty = True
+            overflow = (0x8000 if wide else 0x80) if delta > 0 else (0x7FFF if wide else 0x7F)
+            self.emit(f"f = (f & {(~X86_ARITH | X86_CF) & 0xFFFF:#x}) | {self.szp(wide)} | ((x ^ t ^ 1) & 0x10)"
+                      f" | (0x800 if t == {overflow:#x} else 0)")
+        write("t")
+
+    # транслируемые инструкции: (entry, нужны ли флаги, смещение следующей) -> вышел ли из блока
+    def gen_alu_rm8(self, e, need, offset):
+        op = e[7] >> 3
+        read, write = self.operand(e[2], False)
+        self.alu(op, read, self.reg8(e[3]), False, need)
+        if op != 7:
+            write("t")
+
+    def gen_alu_rm16(self, e, need, offset):
+        op = e[7] >> 3
+        read, write = self.operand(e[2], True)
+        self.alu(op, read, self.REGS[e[3]], True, need)
+        if op != 7:
+            write("t")
+
+    def gen_alu_r8(self, e, need, offset):
+        op = e[7] >> 3
+        read, write = self.operand(e[2], False)
+        self.alu(op, self.reg8(e[3]), read, False, need)
+        if op != 7:
+            self.set_reg8(e[3], "t")
+
+    def gen_alu_r16(self, e, need, offset):
+        op = e[7] >> 3
+        read, write = self.operand(e[2], True)
+        self.alu(op, self.REGS[e[3]], read, True, need)
+        if op != 7:
+            self.set_reg16(e[3], "t")
+
+    def gen_alu_al(self, e, need, offset):
+        op = e[7] >> 3
+        self.alu(op, self.reg8(0), str(e[4]), False, need)
+        if op != 7:
+            self.set_reg8(0, "t")
+
+    def gen_alu_ax(self, e, need, offset):
+        op = e[7] >> 3
+        self.alu(op, "ax", str(e[4]), True, need)
+        if op != 7:
+            self.set_reg16(0, "t")
+
+    def gen_group1_8(self, e, need, offset):
+        read, write = self.operand(e[2], False)
+        self.alu(e[3], read, str(e[4]), False, need)
+        if e[3] != 7:
+            write("t")
+
+    def gen_group1_16(self, e, need, offset):
+        read, write = self.operand(e[2], True)
+        self.alu(e[3], read, str(e[4] & 0xFFFF), True, need)
+        if e[3] != 7:
+            write("t")
+
+    def gen_test_rm8(self, e, need, offset):
+        read, write = self.operand(e[2], False)
+        if need:
+            self.alu(4, read, self.reg8(e[3]), False, need)
+
+    def gen_test_rm16(self, e, need, offset):
+        read, write = self.operand(e[2], True)
+        if need:
+            self.alu(4, read, self.REGS[e[3]], True, need)
+
+    def gen_test_al(self, e, need, offset):
+        if need:
+            self.alu(4, self.reg8(0), str(e[4]), False, need)
+
+    def gen_test_ax(self, e, need, offset):
+        if need:
+            self.alu(4, "ax", str(e[4]), True, need)
+
+    def gen_inc16(self, e, need, offset):
+        self.incdec(self.REGS[e[3]], lambda value: self.set_reg16(e[3], value), 1, True, need)
+
+    def gen_dec16(self, e, need, offset):
+        self.incdec(self.REGS[e[3]], lambda value: self.set_reg16(e[3], value), -1, True, need)
+
+    def gen_group4(self, e, need, offset):
+        if self.is_generic(e):
+            return self.generic(e, offset)
+        read, write = self.operand(e[2], False)
+        self.incdec(read, write, 1 if e[3] == 0 else -1, False, need)
+
+    def gen_push16(self, e, need, offset):
+        self.emit(f"t = {self.REGS[e[3]]}")
+        self.set_reg16(R_SP, "(sp - 2) & 0xFFFF")
+        self.emit(f"w16(((sregs[{S_SS}] << 4) + sp) & 0xFFFFF, t)")
+
+    def gen_pop16(self, e, need, offset):
+        self.emit(f"a = ((sregs[{S_SS}] << 4) + sp) & 0xFFFFF")
+        self.set_reg16(R_SP, "(sp + 2) & 0xFFFF")
+        self.set_reg16(e[3], "mem[a] | (mem[(a + 1) & 0xFFFFF] << 8)")
+
+    def gen_mov_rm8(self, e, need, offset):
+        read, write = self.operand(e[2], False)
+        write(self.reg8(e[3]))
+
+    def gen_mov_rm16(self, e, need, offset):
+        read, write = self.operand(e[2], True)
+        write(self.REGS[e[3]])
+
+    def gen_mov_r8(self, e, need, offset):
+        read, write = self.operand(e[2], False)
+        self.set_reg8(e[3], read)
+
+    def gen_mov_r16(self, e, need, offset):
+        read, write = self.operand(e[2], True)
+        self.set_reg16(e[3], read)
+
+    def gen_mov_r8_imm(self, e, need, offset):
+        self.set_reg8(e[3], str(e[4]))
+
+    def gen_mov_r16_imm(self, e, need, offset):
+        self.set_reg16(e[3], str(e[4]))
+
+    def gen_mov_rm8_imm(self, e, need, offset):
+        read, write = self.operand(e[2], False)
+        write(str(e[4]))
+
+    def gen_mov_rm16_imm(self, e, need, offset):
+        read, write = self.operand(e[2], True)
+        write(str(e[4]))
+
+    def gen_lea(self, e, need, offset):
+        self.set_reg16(e[3], self.offset(e[2]))
+
+    def gen_xchg_ax(self, e, need, offset):
+        if e[3]:
+            name = self.REGS[e[3]]
+            self.dirty.update(('ax', name))
+            self.emit(f"ax, {name} = {name}, ax")
+
+    def gen_nop(self, e, need, offset):
+        pass
+
+    def gen_cmc(self, e, need, offset):
+        self.flags_dirty = True
+        self.emit("f ^= 0x1")
+
+    def gen_flag(self, e, need, offset):
+        if self.is_generic(e):
+            return self.generic(e, offset) # STI может открыть IRQ
+        opcode = e[7]
+        bit = X86_FLAG_BITS[(opcode - 0xF8) >> 1]
+        self.flags_dirty = True
+        self.emit(f"f |= {bit:#x}" if opcode & 1 else f"f &= {~bit & 0xFFFF:#x}")
+
+    # переходы: последние в блоке
+    def branch(self, condition, offset, target):
+        self.spill()
+        self.emit(f"if {condition}:")
+        self.emit(f"    engine.ip = (ip + {target}) & 0xFFFF")
+        self.emit("else:")
+        self.emit(f"    engine.ip = (ip + {offset}) & 0xFFFF")
+        return True
+
+    def gen_jcc(self, e, need, offset):
+        code = e[7] & 0x0F
+        condition = self.CONDITIONS[code >> 1]
+        return self.branch(f"not ({condition})" if code & 1 else condition, offset, offset + e[4])
+
+    def gen_jmp_rel(self, e, need, offset):
+        self.spill()
+        self.emit(f"engine.ip = (ip + {offset + e[4]}) & 0xFFFF")
+        return True
+
+    def gen_loop(self, e, need, offset):
+        opcode = e[7]
+        if opcode == 0xE3:
+            condition = "cx == 0"
+        else:
+            self.set_reg16(R_CX, "(cx - 1) & 0xFFFF")
+            condition = ("cx", "cx and f & 0x40", "cx and not f & 0x40")[(0xE2, 0xE1, 0xE0).index(opcode)]
+        return self.branch(condition, offset, offset + e[4])
+
+# ядро x86 под numba: состояние в одном массиве int64
+K_IP = 12
+K_FLAGS = 13
+KERNEL_STATE_SIZE = 16 # AX..DI, ES CS SS DS, IP, FLAGS, запас
+X86_EXIT_BUDGET = 0 # бюджет исчерпан
+X86_EXIT_STEP = 1 # инструкцию по IP исполняет X86Engine: INT, порты, HLT, редкое
+NUMBA_BUDGET = 1 << 20 # инструкций за вызов, если дедлайн далеко
+
+def kernel(function):
+    # без numba функции остаются обычными и не вызываются
+    return njit(cache=True)(function) if njit is not None else function
+
+KERNEL_FORMS = np.frombuffer(X86_FORMS, dtype=np.uint8).copy() if np is not None else None
+
+@kernel
+def kernel_read16(mem, a):
+    return np.int64(mem[a]) | (np.int64(mem[(a + 1) & 0xFFFFF]) << 8)
+
+@kernel
+def kernel_write16(mem, a, value):
+    mem[a] = value & 0xFF
+    mem[(a + 1) & 0xFFFFF] = (value >> 8) & 0xFF
+
+@kernel
+def kernel_get8(st, index):
+    if index < 4:
+        return st[index] & 0xFF
+    return st[index - 4] >> 8
+
+@kernel
+def kernel_set8(st, index, value):
+    if index < 4:
+        st[index] = (st[index] & 0xFF00) | value
+    else:
+        st[index - 4] = (st[index - 4] & 0x00FF) | (value << 8)
+
+@kernel
+def kernel_get_rm(mem, st, mod, rm, ea, wide):
+    if mod == 3:
+        return st[rm] if wide else kernel_get8(st, rm)
+    return kernel_read16(mem, ea) if wide else np.int64(mem[ea])
+
+@kernel
+def kernel_set_rm(mem, st, mod, rm, ea, wide, value):
+    if mod == 3:
+        if wide:
+            st[rm] = value
+        else:
+            kernel_set8(st, rm, value)
+    elif wide:
+        kernel_write16(mem, ea, value)
+    else:
+        mem[ea] = value
+
+@kernel
+def kernel_push(mem, st, value):
+    sp = (st[R_SP] - 2) & 0xFFFF
+    st[R_SP] = sp
+    kernel_write16(mem, ((st[8 + S_SS] << 4) + sp) & 0xFFFFF, value)
+
+@kernel
+def kernel_pop(mem, st):
+    sp = st[R_SP]
+    st[R_SP] = (sp + 2) & 0xFFFF
+    return kernel_read16(mem, ((st[8 + S_SS] << 4) + sp) & 0xFFFFF)
+
+@kernel
+def kernel_szp(r, wide):
+    p = r & 0xFF
+    p ^= p >> 4
+    p ^= p >> 2
+    p ^= p >> 1
+    f = 0 if p & 1 else X86_PF
+    if r == 0:
+        f |= X86_ZF
+    if wide:
+        f |= (r >> 8) & X86_SF
+    else:
+        f |= r & X86_SF
+    return f
+
+@kernel
+def kernel_alu(st, op, a, b, wide):
+    # 0 ADD, 1 OR, 2 ADC, 3 SBB, 4 AND, 5 SUB, 6 XOR, 7 CMP
+    bits = 16 if wide else 8
+    f = st[K_FLAGS]
+    if op == 0 or op == 2:
+        r = a + b + (f & X86_CF if op == 2 else 0)
+        new = ((r >> bits) & 1) | (((((a ^ r) & (b ^ r)) >> (bits - 1)) & 1) << 11) | ((a ^ b ^ r) & X86_AF)
+    elif op == 3 or op == 5 or op == 7:
+        r = a - b - (f & X86_CF if op == 3 else 0)
+        new = ((r >> bits) & 1) | (((((a ^ b) & (a ^ r)) >> (bits - 1)) & 1) << 11) | ((a ^ b ^ r) & X86_AF)
+    else:
+        r = a | b if op == 1 else (a & b if op == 4 else a ^ b)
+        new = 0
+    r &= (1 << bits) - 1
+    st[K_FLAGS] = (f & ~X86_ARITH) | new | kernel_szp(r, wide)
+    return r
+
+@kernel
+def kernel_incdec(st, a, delta, wide):
+    mask = 0xFFFF if wide else 0xFF
+    r = (a + delta) & mask
+    sign = 0x8000 if wide else 0x80
+    overflow = r == sign if delta > 0 else r == sign - 1
+    st[K_FLAGS] = ((st[K_FLAGS] & (X86_CF | ~X86_ARITH)) | kernel_szp(r, wide) | ((a ^ r ^ 1) & X86_AF)
+                   | (X86_OF if overflow else 0))
+    return r
+
+@kernel
+def kernel_shift(st, op, value, count, wide):
+    bits = 16 if wide else 8
+    mask = (1 << bits) - 1
+    top = bits - 1
+    flags = st[K_FLAGS]
+    if op < 4:
+        if op < 2:
+            count %= bits
+            if op == 0:
+                r = ((value << count) | (value >> (bits - count))) & mask
+                cf = r & 1
+                of = (r >> top) ^ cf
+            else:
+                r = ((value >> count) | (value << (bits - count))) & mask
+                cf = r >> top
+                of = (r >> top) ^ ((r >> (top - 1)) & 1)
+        else:
+            count %= bits + 1
+            wide_value = value | ((flags & X86_CF) << bits)
+            full = (mask << 1) | 1
+            if op == 2:
+                wide_value = ((wide_value << count) | (wide_value >> (bits + 1 - count))) & full
+                r = wide_value & mask
+                cf = wide_value >> bits
+                of = (r >> top) ^ cf
+            else:
+                wide_value = ((wide_value >> count) | (wide_value << (bits + 1 - count))) & full
+                r = wide_value & mask
+                cf = wide_value >> bits
+                of = (r >> top) ^ ((r >> (top - 1)) & 1)
+        st[K_FLAGS] = (flags & ~(X86_CF | X86_OF)) | cf | (of << 11)
+        return r
+    if op == 5:
+        cf = (value >> (count - 1)) & 1
+        r = value >> count
+        of = value >> top
+    elif op == 7:
+        signed = value - (1 << bits) if value >> top else value
+        cf = (signed >> (count - 1)) & 1
+        r = (signed >> count) & mask
+        of = 0
+    else:
+        shifted = value << count
+        cf = (shifted >> bits) & 1
+        r = shifted & mask
+        of = (r >> top) ^ cf
+    st[K_FLAGS] = (flags & ~X86_ARITH) | cf | kernel_szp(r, wide) | (of << 11)
+    return r
+
+@kernel
+def kernel_condition(flags, code):
+    kind = code >> 1
+    if kind == 0:
+        taken = flags & X86_OF
+    elif kind == 1:
+        taken = flags & X86_CF
+    elif kind == 2:
+        taken = flags & X86_ZF
+    elif kind == 3:
+        taken = flags & (X86_CF | X86_ZF)
+    elif kind == 4:
+        taken = flags & X86_SF
+    elif kind == 5:
+        taken = flags & X86_PF
+    elif kind == 6:
+        taken = (flags ^ (flags >> 4)) & X86_SF
+    else:
+        taken = ((flags ^ (flags >> 4)) & X86_SF) | (flags & X86_ZF)
+    return (taken != 0) != ((code & 1) != 0)
+
+@kernel
+def run_x86_kernel(mem, st, budget):
+    """Не больше budget инструкций; (код выхода, сколько исполнено).
+    На X86_EXIT_STEP IP стоит на инструкции, которую ядро не исполняет"""
+    executed = 0
+    while executed < budget:
+        ip = st[K_IP]
+        start = ((st[8 + S_CS] << 4) + ip) & 0xFFFFF
+        pos = start
+        segment = -1
+        rep = 0
+        opcode = np.int64(mem[pos])
+        while (opcode == 0x26 or opcode == 0x2E or opcode == 0x36 or opcode == 0x3E
+               or opcode == 0xF0 or opcode == 0xF2 or opcode == 0xF3):
+            if opcode == 0xF2 or opcode == 0xF3:
+                rep = opcode
+            elif opcode != 0xF0:
+                segment = (opcode >> 3) & 3
+            pos += 1
+            opcode = np.int64(mem[pos])
+        pos += 1
+        form = KERNEL_FORMS[opcode]
+        mod = 3
+        reg = opcode & 7
+        rm = 0
+        ea = 0
+        offset = 0
+        if form & X86_MODRM:
+            byte = np.int64(mem[pos])
+            pos += 1
+            mod = byte >> 6
+            reg = (byte >> 3) & 7
+            rm = byte & 7
+            if mod != 3:
+                base_segment = S_DS
+                if mod == 0 and rm == 6:
+                    offset = kernel_read16(mem, pos)
+                    pos += 2
+                else:
+                    if rm == 0:
+                        offset = st[R_BX] + st[R_SI]
+                    elif rm == 1:
+                        offset = st[R_BX] + st[R_DI]
+                    elif rm == 2:
+                        offset = st[R_BP] + st[R_SI]
+                        base_segment = S_SS
+                    elif rm == 3:
+                        offset = st[R_BP] + st[R_DI]
+                        base_segment = S_SS
+                    elif rm == 4:
+                        offset = st[R_SI]
+                    elif rm == 5:
+                        offset = st[R_DI]
+                    elif rm == 6:
+                        offset = st[R_BP]
+                        base_segment = S_SS
+                    else:
+                        offset = st[R_BX]
+                    if mod == 1:
+                        disp = np.int64(mem[pos])
+                        offset += disp - ((disp & 0x80) << 1)
+                        pos += 1
+                    elif mod == 2:
+                        offset += kernel_read16(mem, pos)
+                        pos += 2
+                if segment >= 0:
+                    base_segment = segment
+                ea = ((st[8 + base_segment] << 4) + (offset & 0xFFFF)) & 0xFFFFF
+            if form & X86_GROUP3 and reg > 1:
+                form = 0
+        imm = 0
+        if form & X86_IMM8:
+            imm = np.int64(mem[pos])
+            pos += 1
+        elif form & X86_SIMM8:
+            imm = np.int64(mem[pos])
+            imm -= (imm & 0x80) << 1
+            pos += 1
+        elif form & X86_IMM16:
+            imm = kernel_read16(mem, pos)
+            pos += 2
+        next_ip = (ip + pos - start) & 0xFFFF
+        wide = (opcode & 1) == 1
+        data_segment = (segment if segment >= 0 else S_DS)
+
+        if opcode < 0x40 and (opcode & 7) < 6:
+            op = opcode >> 3
+            kind = opcode & 7
+            if kind < 2:
+                r = kernel_alu(st, op, kernel_get_rm(mem, st, mod, rm, ea, wide),
+                               st[reg] if wide else kernel_get8(st, reg), wide)
+                if op != 7:
+                    kernel_set_rm(mem, st, mod, rm, ea, wide, r)
+            elif kind < 4:
+                wide = kind == 3
+                r = kernel_alu(st, op, st[reg] if wide else kernel_get8(st, reg),
+                               kernel_get_rm(mem, st, mod, rm, ea, wide), wide)
+                if op != 7:
+                    if wide:
+                        st[reg] = r
+                    else:
+                        kernel_set8(st, reg, r)
+            else:
+                wide = kind == 5
+                r = kernel_alu(st, op, st[R_AX] if wide else st[R_AX] & 0xFF, imm, wide)
+                if op != 7:
+                    if wide:
+                        st[R_AX] = r
+                    else:
+                        st[R_AX] = (st[R_AX] & 0xFF00) | r
+        elif opcode >= 0x40 and opcode < 0x50:
+            st[reg] = kernel_incdec(st, st[reg], 1 if opcode < 0x48 else -1, True)
+        elif opcode >= 0x50 and opcode < 0x58:
+            kernel_push(mem, st, st[reg])
+        elif opcode >= 0x58 and opcode < 0x60:
+            st[reg] = kernel_pop(mem, st)
+        elif opcode >= 0x70 and opcode < 0x80:
+            if kernel_condition(st[K_FLAGS], opcode & 0x0F):
+                next_ip = (next_ip + imm) & 0xFFFF
+        elif opcode >= 0x80 and opcode < 0x84:
+            wide = opcode != 0x80 and opcode != 0x82
+            r = kernel_alu(st, reg, kernel_get_rm(mem, st, mod, rm, ea, wide), imm & 0xFFFF, wide)
+            if reg != 7:
+                kernel_set_rm(mem, st, mod, rm, ea, wide, r)
+        elif opcode == 0x84 or opcode == 0x85:
+            kernel_alu(st, 4, kernel_get_rm(mem, st, mod, rm, ea, wide), st[reg] if wide else kernel_get8(st, reg), wide)
+        elif opcode == 0x86 or opcode == 0x87:
+            value = kernel_get_rm(mem, st, mod, rm, ea, wide)
+            kernel_set_rm(mem, st, mod, rm, ea, wide, st[reg] if wide else kernel_get8(st, reg))
+            if wide:
+                st[reg] = value
+            else:
+                kernel_set8(st, reg, value)
+        elif opcode == 0x88 or opcode == 0x89:
+            kernel_set_rm(mem, st, mod, rm, ea, wide, st[reg] if wide else kernel_get8(st, reg))
+        elif opcode == 0x8A or opcode == 0x8B:
+            value = kernel_get_rm(mem, st, mod, rm, ea, wide)
+            if wide:
+                st[reg] = value
+            else:
+                kernel_set8(st, reg, value)
+        elif opcode == 0x8C:
+            kernel_set_rm(mem, st, mod, rm, ea, True, st[8 + (reg & 3)])
+        elif opcode == 0x8D and mod != 3:
+            st[reg] = offset & 0xFFFF
+        elif opcode == 0x8E:
+            st[8 + (reg & 3)] = kernel_get_rm(mem, st, mod, rm, ea, True)
+        elif opcode >= 0x90 and opcode < 0x98:
+            value = st[R_AX]
+            st[R_AX] = st[reg]
+            st[reg] = value
+        elif opcode == 0x98:
+            al = st[R_AX] & 0xFF
+            st[R_AX] = al | 0xFF00 if al & 0x80 else al
+        elif opcode == 0x99:
+            st[R_DX] = 0xFFFF if st[R_AX] & 0x8000 else 0
+        elif opcode == 0xA8:
+            kernel_alu(st, 4, st[R_AX] & 0xFF, imm, False)
+        elif opcode == 0xA9:
+            kernel_alu(st, 4, st[R_AX], imm, True)
+        elif (opcode >= 0xA4 and opcode < 0xA6) or (opcode >= 0xAA and opcode < 0xAE):
+            # MOVS, STOS, LODS; CMPS/SCAS с условием повтора - в X86Engine
+            size = 2 if wide else 1
+            step = -size if st[K_FLAGS] & X86_DF else size
+            count = st[R_CX] if rep else 1
+            source = st[8 + data_segment] << 4
+            dest = st[8 + S_ES] << 4
+            for _ in range(count):
+                if opcode < 0xA6:
+                    a = (source + st[R_SI]) & 0xFFFFF
+                    b = (dest + st[R_DI]) & 0xFFFFF
+                    if wide:
+                        kernel_write16(mem, b, kernel_read16(mem, a))
+                    else:
+                        mem[b] = mem[a]
+                    st[R_SI] = (st[R_SI] + step) & 0xFFFF
+                    st[R_DI] = (st[R_DI] + step) & 0xFFFF
+                elif opcode < 0xAC:
+                    b = (dest + st[R_DI]) & 0xFFFFF
+                    if wide:
+                        kernel_write16(mem, b, st[R_AX])
+                    else:
+                        mem[b] = st[R_AX] & 0xFF
+                    st[R_DI] = (st[R_DI] + step) & 0xFFFF
+                else:
+                    a = (source + st[R_SI]) & 0xFFFFF
+                    if wide:
+                        st[R_AX] = kernel_read16(mem, a)
+                    else:
+                        st[R_AX] = (st[R_AX] & 0xFF00) | np.int64(mem[a])
+                    st[R_SI] = (st[R_SI] + step) & 0xFFFF
+            if rep:
+                st[R_CX] = 0
+        elif opcode >= 0xB0 and opcode < 0xB8:
+            kernel_set8(st, reg, imm)
+        elif opcode >= 0xB8 and opcode < 0xC0:
+            st[reg] = imm
+        elif opcode == 0xC2 or opcode == 0xC3:
+            next_ip = kernel_pop(mem, st)
+            st[R_SP] = (st[R_SP] + imm) & 0xFFFF
+        elif opcode == 0xC6 or opcode == 0xC7:
+            kernel_set_rm(mem, st, mod, rm, ea, wide, imm)
+        elif (opcode >= 0xD0 and opcode < 0xD4) or opcode == 0xC0 or opcode == 0xC1:
+            if opcode < 0xD0:
+                count = imm
+            elif opcode < 0xD2:
+                count = 1
+            else:
+                count = st[R_CX] & 0xFF
+            count &= 0x1F
+            if count:
+                kernel_set_rm(mem, st, mod, rm, ea, wide,
+                              kernel_shift(st, reg, kernel_get_rm(mem, st, mod, rm, ea, wide), count, wide))
+        elif opcode >= 0xE0 and opcode < 0xE4:
+            if opcode == 0xE3:
+                taken = st[R_CX] == 0
+            else:
+                st[R_CX] = (st[R_CX] - 1) & 0xFFFF
+                zero = (st[K_FLAGS] & X86_ZF) != 0
+                taken = st[R_CX] != 0 and (opcode == 0xE2 or zero == (opcode == 0xE1))
+            if taken:
+                next_ip = (next_ip + imm) & 0xFFFF
+        elif opcode == 0xE8:
+            kernel_push(mem, st, next_ip)
+            next_ip = (next_ip + imm) & 0xFFFF
+        elif opcode == 0xE9 or opcode == 0xEB:
+            next_ip = (next_ip + imm) & 0xFFFF
+        elif opcode == 0xF5:
+            st[K_FLAGS] ^= X86_CF
+        elif opcode == 0xF8 or opcode == 0xF9:
+            st[K_FLAGS] = (st[K_FLAGS] & ~X86_CF) | (opcode & 1)
+        elif opcode == 0xFC or opcode == 0xFD:
+            st[K_FLAGS] = (st[K_FLAGS] & ~X86_DF) | (X86_DF if opcode & 1 else 0)
+        elif (opcode == 0xF6 or opcode == 0xF7) and reg < 6:
+            value = kernel_get_rm(mem, st, mod, rm, ea, wide)
+            mask = 0xFFFF if wide else 0xFF
+            if reg < 2:
+                kernel_alu(st, 4, value, imm, wide)
+            elif reg == 2:
+                kernel_set_rm(mem, st, mod, rm, ea, wide, ~value & mask)
+            elif reg == 3:
+                kernel_set_rm(mem, st, mod, rm, ea, wide, kernel_alu(st, 5, 0, value, wide))
+            else:
+                accumulator = st[R_AX] & mask
+                half = 0x8000 if wide else 0x80
+                if reg == 5:
+                    accumulator -= (accumulator & half) << 1
+                    value -= (value & half) << 1
+                product = accumulator * value
+                st[R_AX] = product & 0xFFFF
+                if wide:
+                    st[R_DX] = (product >> 16) & 0xFFFF
+                fits = (product >= -half and product < half) if reg == 5 else product <= mask
+                st[K_FLAGS] = (st[K_FLAGS] & ~(X86_CF | X86_OF)) | (0 if fits else X86_CF | X86_OF)
+        elif opcode == 0xFE and reg < 2:
+            kernel_set_rm(mem, st, mod, rm, ea, False,
+                          kernel_incdec(st, kernel_get_rm(mem, st, mod, rm, ea, False), 1 if reg == 0 else -1, False))
+        elif opcode == 0xFF and (reg < 3 or reg == 4 or reg == 6):
+            value = kernel_get_rm(mem, st, mod, rm, ea, True)
+            if reg < 2:
+                kernel_set_rm(mem, st, mod, rm, ea, True, kernel_incdec(st, value, 1 if reg == 0 else -1, True))
+            elif reg == 2:
+                kernel_push(mem, st, next_ip)
+                next_ip = value
+            elif reg == 4:
+                next_ip = value
+            else:
+                kernel_push(mem, st, value)
+        else:
+            return X86_EXIT_STEP, executed
+        st[K_IP] = next_ip
+        executed += 1
+    return X86_EXIT_BUDGET, executed
+
+class NumbaEngine:
+    """x86 под numba: регистры, флаги и память в массивах NumPy (память - без копии),
+    @njit-цикл на бюджет до дедлайна планировщика. INT, порты, HLT и редкие инструкции
+    ядро отдаёт X86Engine, он же обслуживает устройства и доставляет IRQ"""
+    def __init__(self, cpu):
+        if njit is None:
+            raise RuntimeError("numba is not installed")
+        self.cpu = cpu
+        self.x86 = X86Engine(cpu)
+        self.x86.translator = None
+        self.memory = np.frombuffer(cpu.memory, dtype=np.uint8)
+        self.state = np.zeros(KERNEL_STATE_SIZE, dtype=np.int64)
+
+    def boot(self, image, address=BOOT_SECTOR_ADDRESS, drive=0x00):
+        self.x86.boot(image, address, drive)
+
+    def invalidate(self, lo, hi):
+        self.x86.invalidate(lo, hi)
+
+    def set_translator(self, threshold=None):
+        pass # ядро компилирует numba, трансляция блоков не нужна
+
+    def push_state(self):
+        x86 = self.x86
+        state = self.state
+        state[0:8] = x86.regs
+        state[8:12] = x86.sregs
+        state[K_IP] = x86.ip
+        state[K_FLAGS] = x86.flags
+
+    def pull_state(self):
+        x86 = self.x86
+        state = self.state.tolist()
+        x86.regs[:] = state[0:8]
+        x86.sregs[:] = state[8:12]
+        x86.ip = state[K_IP]
+        x86.flags = state[K_FLAGS]
+
+    def step(self):
+        # ядро пишет в память мимо кэша декодера, поэтому декодируем заново
+        self.pull_state()
+        x86 = self.x86
+        entry = x86.decode(((x86.sregs[S_CS] << 4) + x86.ip) & 0xFFFFF, store=False)
+        x86.ip = (x86.ip + entry[1]) & 0xFFFF
+        entry[0](entry)
+        self.push_state()
+
+    def run(self):
+        cpu = self.cpu
+        x86 = self.x86
+        if cpu.sampler is not None or cpu.watchpoints or cpu.profiler is not None:
+            # теневой стек CALL/RET, наблюдение и профиль ведёт только движок на Python
+            x86.invalidate(0, len(self.memory)) # ядро писало в код мимо кэша
+            x86.run()
+            return
+        scheduler = cpu.scheduler
+        memory = self.memory
+        state = self.state
+        x86.load_registers()
+        self.push_state()
+        x86.running = True
+        step = False
+        try:
+            while x86.running:
+                scheduler.cycles += 1
+                if scheduler.cycles >= scheduler.deadline:
+                    self.pull_state()
+                    stop = x86.service()
+                    self.push_state()
+                    if stop:
+                        scheduler.cycles -= 1 # этот такт ещё не начат
+                        break
+                if step:
+                    step = False
+                    self.step()
+                    continue
+                # первая инструкция уже в этом такте, остальные строго до дедлайна
+                budget = int(max(1, min(scheduler.deadline - scheduler.cycles, NUMBA_BUDGET)))
+                code, executed = run_x86_kernel(memory, state, budget)
+                if executed:
+                    scheduler.cycles += executed - 1
+                if code == X86_EXIT_STEP:
+                    if executed:
+                        step = True # своим тактом и после проверки дедлайна
+                    else:
+                        self.step()
+        finally:
+            self.pull_state()
+            x86.store_registers()
+
+class PetyshCore16:
+    def __init__(self):
+        self.video_output = None
+        self.vc = VideoController()  # ммм ютубчик
+        self.disk_data = {0: b"Boot sector"} # типо диск
+        self.timer_ticks = 0
+        self.rtc_time = datetime.datetime.now()
+        self.interrupt_enabled = True
+        self.debug_mode = False
+        self.breakpoints = {} # адрес -> исходный байт под ловушкой
+        self.watchpoints = {} # адрес -> WATCH_READ | WATCH_WRITE
+        self.os_loaded = False
+        self.programs_dir = "programs/"
+        self.gpu_accelerated = False
+        self.io = IOBus() # порты: только занятые, без списка на 64К
+        self.scheduler = DeviceScheduler()
+        self.pic = InterruptController()
+        self.pit = IntervalTimer(self.scheduler, self.raise_irq)
+        self.keyboard = KeyboardDevice(self.raise_irq) # клава
+        self.keyboard.wakeup = self.wake_host
+        self.host_wake = threading.Event() # клавиша будит хост из ожидания
+        self.idle_cycles = 0 # тактов, пропущенных гостем в ожидании с последнего сна хоста
+        self.empty_polls = 0 # пустых INT 16h/01 подряд
+        self.last_poll = 0
+        self.io.register(0x20, 0x21, self.pic.read_port, self.write_pic_port)
+        self.io.register(0x40, 0x43, self.pit.read_port, self.pit.write_port)
+        self.io.register(0x60, 0x60, self.keyboard.read_port)
+        self.io.register(0x64, 0x64, self.keyboard.read_port)
+        self.io.register(0x3C7, 0x3C9, self.vc.read_dac_port, self.vc.write_dac_port)
+        self.io.register(0x3D4, 0x3D5, self.vc.read_crtc_port, self.vc.write_crtc_port)
+        self.scheduler.schedule(VBLANK_CYCLES, self.vblank_event)
+        self.input_script = None
+        self.profiler = None # Profiler, включается командой profile on
+        self.sampler = None # SamplingProfiler, команда sample
+        self.recorder = None # TimeTravel, команда record
+        self.replaying = False
+        self.stop_requested = False
+        self.symbols = SymbolTable()
+        self.engine = None # X86Engine для настоящего x86-кода, None - своя система команд
+        self.key_wait = False # INT 16h/00h не дождался клавиши
+        self.load_basic_font()
+        self.vc.set_video_mode(0x03)
+        self.video_modes = {
+            0x13: (40, 25, 16),    # Текстовый режим
+            0x5A: (80, 50, 256),   # Псевдографический
+            0x5B: (160, 100, 65536) # RGB режим
+        }
+        # 16-битные регистры
+        self.registers = {
+            'AX': 0x0000,
+            'BX': 0x0000,
+            'CX': 0x0000,
+            'DX': 0x0000,
+            'IP': 0x0000,
+            'SP': 0xFFFF,
+            'FLAGS': 0b00000000
+        }
+
+        self.registers.update({
+            'CS': 0x0000,
+            'DS': 0x0000,
+            'ES': 0x0000,
+            'SS': 0x0000,
+            'SI': 0x0000,
+            'DI': 0x0000,
+            'BP': 0x0000,
+        })
+        
+        self.rep_prefix = False
+        self.direction_flag = False
+        self.reg_names = ['AX', 'BX', 'CX', 'DX']
+        self.opcode_handlers = [getattr(self, 'op_' + entry[2]) if entry else None for entry in OPCODE_TABLE]
+
+        self.ivt = [0x0000] * IVT_SIZE # каждая запись
+        self.memory = bytearray(1048576) # 1мб
+        self.memory_map = MemoryMap(len(self.memory)) # карта занятой памяти, весь 1мб
+        self.watch_pages = bytearray(len(self.memory) >> WATCH_PAGE_SHIFT) # флаги наблюдения по страницам
+        self.disassembler = Disassembler(self.memory, self.breakpoints)
+        self.memory_map.set_range(0x0000, 0x0400) # ivt
+        self.allocator = DosAllocator(self.memory, memory_map=self.memory_map)
+        self.memory_blocks = self.allocator.blocks # блоки памяти (выделенной)
+        self.dos_processes = [] # EXEC под x86: (регистры родителя, сегмент PSP ребёнка)
+        
+        self.gdt = [
+            make_descriptor(0, 0, 0x00),  # Нулевой дескриптор
+            make_descriptor(0, 0xFFFFF, 0x9A),  # Код сегмент
+            make_descriptor(0, 0xFFFFF, 0x92)   # Данные сегмент
+        ]
+        self.ldt = []
+        self.gdtr = {'base': 0, 'limit': 0}
+        self.ldtr = {'base': 0, 'limit': 0}
+        self.descriptor_cache = {} # селектор -> (base, limit, access)
+        self.descriptor_lo = 0 # диапазон памяти под GDT/LDT, запись туда сбрасывает кэш
+        self.descriptor_hi = 0
+        self.segment_tlb = [None] * len(SEGMENT_NAMES) # (base, limit, writable) по номеру сегмента
+        self.setup_memory_segments()
+        
+        self.commands = {
+            'help': self.cmd_help,
+            'cls': self.cmd_cls,
+            'run': self.cmd_run,
+            'list': self.cmd_list,
+            'meminfo': self.cmd_meminfo,
+            'edit': self.cmd_edit,
+            'profile': self.cmd_profile,
+            'sample': self.cmd_sample,
+            'break': self.cmd_break,
+            'watch': self.cmd_watch,
+            'record': self.cmd_record,
+            'rstep': self.cmd_rstep,
+            'rcontinue': self.cmd_rcontinue,
+            'disasm': self.cmd_disasm,
+            'boot': self.cmd_boot,
+            'fusion': self.cmd_fusion
+        }
+        self.prompt = "\x1b[32mPCI1~$\x1b[0m "
+        self.setup_interrupts()
+        self.history = []
+
+    def load_basic_font(self):
+        """Загрузка базового 8x16 шрифта"""
+        # блоб собирается один раз при импорте и общий для всех ВМ
+        self.vc.load_font('default', BASIC_FONT.data, 8, 16)
 
-    def load_basic_font(self):
-        """Загрузка базового 8x16 шрифта"""
-        # Базовый шрифт с ASCII символами (0x20-0x7F)
-        font = [
-                        # Пробел (0x20)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # ! (0x21)
-            0x00, 0x00, 0x18, 0x3C, 0x3C, 0x3C, 0x18, 0x18, 0x18, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00,
-            # " (0x22)
-            0x00, 0x66, 0x66, 0x66, 0x24, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # # (0x23)
-            0x00, 0x00, 0x6C, 0x6C, 0xFE, 0x6C, 0x6C, 0x6C, 0xFE, 0x6C, 0x6C, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # $ (0x24)
-            0x18, 0x18, 0x7C, 0xC6, 0xC2, 0xC0, 0x7C, 0x06, 0x06, 0x86, 0xC6, 0x7C, 0x18, 0x18, 0x00, 0x00,
-            # % (0x25)
-            0x00, 0x00, 0x00, 0x00, 0xC2, 0xC6, 0x0C, 0x18, 0x30, 0x60, 0xC6, 0x86, 0x00, 0x00, 0x00, 0x00,
-            # & (0x26)
-            0x00, 0x00, 0x38, 0x6C, 0x6C, 0x38, 0x76, 0xDC, 0xCC, 0xCC, 0xCC, 0x76, 0x00, 0x00, 0x00, 0x00,
-            # ' (0x27)
-            0x00, 0x30, 0x30, 0x30, 0x60, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # ( (0x28)
-            0x00, 0x00, 0x0C, 0x18, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x18, 0x0C, 0x00, 0x00, 0x00, 0x00,
-            # ) (0x29)
-            0x00, 0x00, 0x30, 0x18, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x18, 0x30, 0x00, 0x00, 0x00, 0x00,
-            # * (0x2A)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x66, 0x3C, 0xFF, 0x3C, 0x66, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # + (0x2B)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x7E, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # , (0x2C)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x18, 0x30, 0x00, 0x00, 0x00,
-            # - (0x2D)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # . (0x2E)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00,
-            # / (0x2F)
-            0x00, 0x00, 0x00, 0x00, 0x02, 0x06, 0x0C, 0x18, 0x30, 0x60, 0xC0, 0x80, 0x00, 0x00, 0x00, 0x00,
-            # 0 (0x30)
-            0x00, 0x00, 0x7C, 0xC6, 0xC6, 0xCE, 0xDE, 0xF6, 0xE6, 0xC6, 0xC6, 0x7C, 0x00, 0x00, 0x00, 0x00,
-            # 1 (0x31)
-            0x00, 0x00, 0x18, 0x38, 0x78, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x7E, 0x00, 0x00, 0x00, 0x00,
-            # 2 (0x32)
-            0x00, 0x00, 0x7C, 0xC6, 0x06, 0x0C, 0x18, 0x30, 0x60, 0xC0, 0xC6, 0xFE, 0x00, 0x00, 0x00, 0x00,
-            # 3 (0x33)
-            0x00, 0x00, 0x7C, 0xC6, 0x06, 0x06, 0x3C, 0x06, 0x06, 0x06, 0xC6, 0x7C, 0x00, 0x00, 0x00, 0x00,
-            # 4 (0x34)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00,
-            # 5 (0x35)
-            0x00, 0x00, 0x7E, 0x60, 0x60, 0x7C, 0x06, 0x06, 0x06, 0x06, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # 6 (0x36)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x7C, 0x60, 0x60, 0x60, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # 7 (0x37)
-            0x00, 0x00, 0x7E, 0x06, 0x06, 0x0C, 0x0C, 0x18, 0x18, 0x30, 0x30, 0x30, 0x00, 0x00, 0x00, 0x00,
-            # 8 (0x38)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # 9 (0x39)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x3E, 0x06, 0x06, 0x06, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # : (0x3A)
-            0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # ; (0x3B)
-            0x00, 0x00, 0x00, 0x00, 0x18, 0x18, 0x00, 0x00, 0x18, 0x18, 0x30, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # < (0x3C)
-            0x00, 0x00, 0x00, 0x06, 0x0C, 0x18, 0x30, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x00, 0x00, 0x00, 0x00,
-            # = (0x3D)
-            0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # > (0x3E)
-            0x00, 0x00, 0x00, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x0C, 0x18, 0x30, 0x60, 0x00, 0x00, 0x00, 0x00,
-            # ? (0x3F)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x0C, 0x18, 0x18, 0x18, 0x00, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00,
-            # @ (0x40)
-            0x00, 0x00, 0x3C, 0x42, 0x99, 0xA5, 0xA5, 0xA5, 0xA5, 0x9E, 0x40, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # A (0x41)
-            0x00, 0x00, 0x18, 0x3C, 0x66, 0x66, 0x7E, 0x66, 0x66, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00,
-            # B (0x42)
-            0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x00, 0x00, 0x00, 0x00,
-            # C (0x43)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x60, 0x60, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # D (0x44)
-            0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x00, 0x00, 0x00, 0x00,
-            # E (0x45)
-            0x00, 0x00, 0x7E, 0x60, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00,
-            # F (0x46)
-            0x00, 0x00, 0x7E, 0x60, 0x60, 0x60, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x60, 0x00, 0x00, 0x00, 0x00,
-            # G (0x47)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x60, 0x6E, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # H (0x48)
-            0x00, 0x00, 0x66, 0x66, 0x66, 0x66, 0x7E, 0x66, 0x66, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00,
-            # I (0x49)
-            0x00, 0x00, 0x3C, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # J (0x4A)
-            0x00, 0x00, 0x1E, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x6C, 0x6C, 0x38, 0x00, 0x00, 0x00, 0x00,
-            # K (0x4B)
-            0x00, 0x00, 0x66, 0x66, 0x6C, 0x6C, 0x78, 0x78, 0x6C, 0x6C, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00,
-            # L (0x4C)
-            0x00, 0x00, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x60, 0x7E, 0x00, 0x00, 0x00, 0x00,
-            # M (0x4D)
-            0x00, 0x00, 0x63, 0x77, 0x7F, 0x6B, 0x6B, 0x6B, 0x63, 0x63, 0x63, 0x63, 0x00, 0x00, 0x00, 0x00,
-            # N (0x4E)
-            0x00, 0x00, 0x66, 0x66, 0x76, 0x76, 0x7E, 0x6E, 0x6E, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00,
-            # O (0x4F)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # P (0x50)
-            0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x60, 0x60, 0x60, 0x60, 0x00, 0x00, 0x00, 0x00,
-            # Q (0x51)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x6E, 0x6C, 0x36, 0x00, 0x00, 0x00, 0x00,
-            # R (0x52)
-            0x00, 0x00, 0x7C, 0x66, 0x66, 0x66, 0x66, 0x7C, 0x6C, 0x66, 0x66, 0x66, 0x00, 0x00, 0x00, 0x00,
-            # S (0x53)
-            0x00, 0x00, 0x3C, 0x66, 0x66, 0x60, 0x38, 0x0C, 0x06, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # T (0x54)
-            0x00, 0x00, 0x7E, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x18, 0x00, 0x00, 0x00, 0x00,
-            # U (0x55)
-            0x00, 0x00, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # [ (0x5B)
-            0x00, 0x00, 0x3C, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x30, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # \ (0x5C)
-            0x00, 0x00, 0x00, 0x80, 0xC0, 0x60, 0x30, 0x18, 0x0C, 0x06, 0x03, 0x01, 0x00, 0x00, 0x00, 0x00,
-            # ] (0x5D)
-            0x00, 0x00, 0x3C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x0C, 0x3C, 0x00, 0x00, 0x00, 0x00,
-            # ^ (0x5E)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-            # _ (0x5F)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x7E, 0x00, 0x00, 0x00, 0x00,
-            # ` (0x60)
-            0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
-        ]
-        # Fill remaining characters with empty data
-        while len(font) < 256 * 16:
-            font.append(0x00)
-        
-        # Corrected call to load_font with all required arguments
-        self.vc.load_font('default', bytes(font[:256*16]), 8, 16)
 
     def terminal_loop(self):
         """Основной цикл терминала"""
@@ -521,8 +4481,18 @@ class PetyshCore16:
         cls       - Очистить экран
         run <bin> - Запустить бинарный файл
         list      - Показать файлы в директории программ
-        meminfo   - Показать информацию о памяти
+        meminfo   - Показать информацию о памяти (meminfo frag - фрагментация)
         edit <f>  - Редактировать файл (базовый редактор)
+        profile   - Профилировщик (on/off/reset/show [N]/json [file])
+        sample    - Сэмплирование гостя (on [N|Xms]/off/symbols <lst|map|asm>/show [N]/save <file>)
+        break     - Точки останова (break <addr>, break del <addr>)
+        watch     - Наблюдение за памятью (watch <addr> [r|w|rw], watch del <addr>)
+        record    - Запись для обратной отладки (record on [N], record off)
+        rstep [n] - Шаг назад на n инструкций
+        rcontinue - Назад до предыдущей точки останова/наблюдения
+        disasm <addr> [n] - Дизассемблировать n инструкций
+        boot <img> [addr] - Загрузить x86-образ (55AA - в 0:7C00, иначе в 0:8000)
+        fusion    - Склейка пар инструкций x86 (on/off/reset/show)
         exit      - Выйти из эмулятора
         help      - Показать эту справку
         """
@@ -543,6 +4513,7 @@ class PetyshCore16:
         try:
             with open(os.path.join(self.programs_dir, filename), "rb") as f:
                 program = list(f.read())
+            self.set_engine(None)
             self.load_program(program)
             self.registers['IP'] = 0
             self.os_loaded = True  # Добавлено: Устанавливаем флаг загрузки ОС
@@ -551,6 +4522,48 @@ class PetyshCore16:
         except Exception as e:
             print(f"\x1b[31mFailed to run {filename}: {str(e)}\x1b[0m")
 
+    def cmd_boot(self, args):
+        """Загрузка настоящего x86-образа"""
+        if not args:
+            print("Usage: boot <image> [addr]")
+            return
+        path = args[0] if os.path.exists(args[0]) else os.path.join(self.programs_dir, args[0])
+        try:
+            self.boot_image(path, int(args[1], 16) if len(args) > 1 else None)
+            print(f"Booting {args[0]}...\n")
+            self.execute_program()
+        except Exception as e:
+            print(f"\x1b[31mFailed to boot {args[0]}: {str(e)}\x1b[0m")
+
+    def boot_image(self, path, address=None):
+        """Загрузочный сектор (55AA) - как диск в 0:7C00, иначе сырой образ в 0:8000"""
+        with open(path, 'rb') as f:
+            image = f.read()
+        if address is None and len(image) >= 512 and image[510:512] == b'\x55\xAA':
+            self.disk_data = {i // 512: image[i:i+512] for i in range(0, len(image), 512)}
+            image = image[:512]
+            address = BOOT_SECTOR_ADDRESS
+        self.set_engine(self.engine or self.create_engine("x86"))
+        self.engine.boot(image, KERNEL_ADDRESS if address is None else address)
+
+    def set_engine(self, engine):
+        # у x86 INT 13h/02h читает по CHS, у своей системы команд CX - номер сектора
+        self.engine = engine
+        self.register_service(0x13, 0x02, self.handle_disk_interrupt if engine is None else self.int13_read_sectors)
+
+    def create_engine(self, name):
+        """x86 или numba; без numba - x86 с предупреждением"""
+        if name == "numba":
+            if njit is not None:
+                return NumbaEngine(self)
+            print("\x1b[33mWarning: numba is not installed, using the x86 engine\x1b[0m")
+        return X86Engine(self)
+
+    def memory_written(self, lo, hi):
+        # запись мимо ЦП (диск, загрузка, откат): декодированный код в [lo, hi) устарел
+        if self.engine is not None:
+            self.engine.invalidate(lo, hi)
+
     def cmd_list(self, args):
         """Показать файлы в директории программ"""
         try:
@@ -563,12 +4576,195 @@ class PetyshCore16:
 
     def cmd_meminfo(self, args):
         """Информация о памяти"""
-        used = sum(self.memory_map)
+        used = self.memory_map.used
         total = len(self.memory_map)
         print(f"Memory usage: {used/1024:.1f} KB / {total/1024:.1f} KB")
+        if args and args[0] == 'frag':
+            report = self.memory_map.fragmentation()
+            print(f"Free runs: {report['free_runs']}, largest free: {report['largest_free']/1024:.1f} KB, "
+                  f"fragmentation: {report['fragmentation']*100:.1f}%")
         print(f"Allocated blocks: {len(self.memory_blocks)}")
+        heap = self.allocator
+        print(f"DOS heap: {heap.used*16/1024:.1f} KB / {heap.total*16/1024:.1f} KB, "
+              f"largest free: {heap.largest_free()} paragraphs")
         print(f"Video memory: {len(self.vc.vram)} bytes")
 
+    def cmd_profile(self, args):
+        """Профилировщик исполнения"""
+        action = args[0] if args else 'show'
+        if action == 'on':
+            if self.profiler is None:
+                self.profiler = Profiler(len(self.memory))
+            print("Profiler enabled")
+        elif action == 'off':
+            self.profiler = None
+            print("Profiler disabled")
+        elif action == 'reset':
+            self.profiler = Profiler(len(self.memory))
+            print("Profiler reset")
+        elif self.profiler is None:
+            print("Profiler is off, use 'profile on'")
+        elif action == 'json':
+            data = self.profiler.to_json()
+            if len(args) > 1:
+                with open(args[1], "w") as f:
+                    f.write(data)
+                print(f"Profile saved to {args[1]}")
+            else:
+                print(data)
+        else:
+            top = int(args[1]) if len(args) > 1 else 10
+            report = self.profiler.report(top)
+            print(f"Instructions: {report['instructions']}, exec: {report['exec_ms']:.1f} ms, "
+                  f"render: {report['render_ms']:.1f} ms ({report['frames']} frames)")
+            print("Opcodes:")
+            for entry in report['opcodes']:
+                print(f"  {entry['opcode']}: {entry['count']:>10} {entry['ms']:>10.2f} ms")
+            print("Hot IPs:")
+            for entry in report['hot_ips']:
+                print(f"  {entry['ip']}: {entry['hits']}")
+            if report['vectors']:
+                print("Interrupts:")
+                for entry in report['vectors']:
+                    print(f"  INT {entry['vector']}: {entry['count']:>8} {entry['ms']:>10.2f} ms")
+
+    def cmd_fusion(self, args):
+        """Склейка частых пар инструкций в декодере x86 и её счётчики"""
+        engine = self.engine
+        if not isinstance(engine, X86Engine):
+            print("Fusion works in the x86 engine: boot an image first")
+            return
+        action = args[0] if args else 'show'
+        if action in ('on', 'off'):
+            engine.set_fusion(action == 'on')
+            print(f"Fusion {'enabled' if engine.fusion else 'disabled'}")
+        elif action == 'reset':
+            engine.fusions.clear()
+            print("Fusion counters reset")
+        else:
+            print(f"Fusion: {'on' if engine.fusion else 'off'}")
+            for name, count in engine.fusions.most_common():
+                print(f"  {name:<10} {count:>10}")
+
+    def cmd_sample(self, args):
+        """Сэмплирующий профилировщик гостя"""
+        action = args[0] if args else 'show'
+        if action == 'on':
+            if self.sampler is not None:
+                self.sampler.stop()
+            rate = args[1] if len(args) > 1 else '10000'
+            if rate.endswith('ms'):
+                self.sampler = SamplingProfiler(self, period_ms=float(rate[:-2]), symbols=self.symbols)
+            else:
+                self.sampler = SamplingProfiler(self, every=int(rate, 0), symbols=self.symbols)
+            self.sampler.start()
+            print(f"Sampling every {rate}")
+        elif action == 'off':
+            if self.sampler is not None:
+                self.sampler.stop()
+            print("Sampling stopped")
+        elif action == 'symbols':
+            self.symbols = SymbolTable.load(args[1])
+            if self.sampler is not None:
+                self.sampler.symbols = self.symbols
+            print(f"Loaded {len(self.symbols)} symbols from {args[1]}")
+        elif self.sampler is None:
+            print("Sampler is off, use 'sample on'")
+        elif action == 'save':
+            self.sampler.write_collapsed(args[1])
+            print(f"{self.sampler.samples} samples saved to {args[1]}")
+        else:
+            top = int(args[1]) if len(args) > 1 else 10
+            for stack, count in self.sampler.collapsed().most_common(top):
+                print(f"  {count:>8} {stack}")
+
+    def cmd_break(self, args):
+        """Точки останова"""
+        if not args:
+            for address in sorted(self.breakpoints):
+                print(f"  {address:05X}")
+        elif args[0] == 'del':
+            self.clear_breakpoint(int(args[1], 16))
+        else:
+            self.set_breakpoint(int(args[0], 16))
+            self.debug_mode = True
+
+    def cmd_watch(self, args):
+        """Точки наблюдения за памятью"""
+        if not args:
+            for address, flags in sorted(self.watchpoints.items()):
+                print(f"  {address:05X} {'r' if flags & WATCH_READ else ''}{'w' if flags & WATCH_WRITE else ''}")
+        elif args[0] == 'del':
+            self.clear_watchpoint(int(args[1], 16))
+        else:
+            mode = args[1] if len(args) > 1 else 'w'
+            flags = (WATCH_READ if 'r' in mode else 0) | (WATCH_WRITE if 'w' in mode else 0)
+            self.set_watchpoint(int(args[0], 16), flags)
+
+    def cmd_record(self, args):
+        """Запись контрольных точек для обратной отладки"""
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+        if args and args[0] == 'on':
+            interval = int(args[1], 0) if len(args) > 1 else CHECKPOINT_INTERVAL
+            self.recorder = TimeTravel(self, interval)
+            self.recorder.start()
+            print(f"Recording, checkpoint every {interval} instructions")
+        else:
+            print("Recording stopped")
+
+    def cmd_rstep(self, args):
+        """Шаг назад"""
+        if self.recorder is None:
+            print("Not recording, use 'record on'")
+            return
+        count = int(args[0], 0) if args else 1
+        if not self.recorder.seek(self.scheduler.cycles - count):
+            print("\x1b[31mBefore the first checkpoint\x1b[0m")
+        self.debug_show_registers()
+
+    def cmd_rcontinue(self, args):
+        """Обратное продолжение"""
+        if self.recorder is None:
+            print("Not recording, use 'record on'")
+            return
+        if not self.recorder.reverse_continue():
+            print("No earlier breakpoint or watchpoint, at the first checkpoint")
+        self.debug_show_registers()
+
+    def cmd_disasm(self, args):
+        """Дизассемблер"""
+        start = int(args[0], 16) if args else self.registers['IP']
+        count = int(args[1], 0) if len(args) > 1 else 16
+        for address, length, text in islice(self.disassembler.sweep(start), count):
+            raw = ' '.join(f"{byte:02X}" for byte in self.memory[address:address+length])
+            print(f"{address:05X}: {raw:<12} {text}")
+
+    def run_until(self, time):
+        """Выполнить вперёд ровно до time инструкций без остановок отладчика"""
+        scheduler = self.scheduler
+        if time <= scheduler.cycles:
+            return
+        events = [scheduler.schedule_at(time + 1, self.request_stop)]
+        if self.recorder is not None:
+            events += self.recorder.prepare_replay(scheduler.cycles, time)
+        self.replaying = True
+        try:
+            while not self.stop_requested: # HLT и ожидание клавиши тоже возвращают из execute
+                self.execute()
+        finally:
+            self.replaying = False
+            self.stop_requested = False
+            self.idle_cycles = 0
+            for event_id in events:
+                scheduler.cancel(event_id) # гость мог остановиться раньше
+            if self.recorder is not None:
+                self.recorder.replay = {}
+
+    def request_stop(self, when):
+        self.stop_requested = True
+
     def cmd_edit(self, args):
         """Простой текстовый редактор"""
         if not args:
@@ -601,15 +4797,34 @@ class PetyshCore16:
     def execute_program(self):
         """Выполнение загруженной программы"""
         try:
+            self.keyboard.start(sys.stdin.fileno())
             while self.os_loaded:
                 self.execute()
-                self.vc.show_video_output()
-                time.sleep(0.01)
+                self.render_frame()
+                self.wait_idle()
         except Exception as e:
             print(f"\x1b[31mProgram crashed: {str(e)}\x1b[0m")
         finally:
+            self.keyboard.stop()
             self.os_loaded = False
 
+    def idle(self):
+        """Гость ждёт события: виртуальное время сразу к ближайшему, хост потом спит столько же"""
+        scheduler = self.scheduler
+        if scheduler.deadline != NEVER:
+            target = max(scheduler.cycles, scheduler.deadline - 1)
+            self.idle_cycles += target - scheduler.cycles
+            scheduler.cycles = target
+
+    def wait_idle(self):
+        """Сон хоста на реальное время пропущенных тактов; клавиша будит сразу"""
+        skipped = self.idle_cycles
+        self.idle_cycles = 0
+        self.host_wake.clear()
+        if not skipped or self.keyboard.incoming or self.keyboard.keys:
+            return
+        self.host_wake.wait(min(skipped / CPU_HZ, IDLE_MAX_WAIT))
+
     def execute_binary_command(self, cmd):
         """Выполнение бинарной команды напрямую"""
         if cmd == "exit":
@@ -639,7 +4854,71 @@ class PetyshCore16:
             self.registers['FLAGS'] |= 0b00010000
 
     def set_breakpoint(self, address):
-        self.breakpoints.add(address)
+        # ловушка прямо в коде: остальные инструкции идут без проверок
+        if address not in self.breakpoints:
+            self.breakpoints[address] = self.memory[address]
+            self.memory[address] = BREAKPOINT_OPCODE
+            self.memory_written(address, address + 1)
+
+    def arm_breakpoints(self, lo=0, hi=None):
+        # после перезаписи памяти ставим ловушки заново поверх нового кода
+        if hi is None:
+            hi = len(self.memory)
+        for address in self.breakpoints:
+            if lo <= address < hi and self.memory[address] != BREAKPOINT_OPCODE:
+                self.breakpoints[address] = self.memory[address]
+                self.memory[address] = BREAKPOINT_OPCODE
+                self.memory_written(address, address + 1)
+
+    def clear_breakpoint(self, address):
+        original = self.breakpoints.pop(address, None)
+        if original is not None:
+            self.memory[address] = original
+            self.memory_written(address, address + 1)
+
+    def hit_breakpoint(self, address):
+        """Ловушка по адресу address; IP вызывающий уже вернул на начало инструкции"""
+        original = self.breakpoints[address]
+        # ловушка не считается инструкцией, иначе точки останова сдвигали бы время повтора
+        self.scheduler.cycles -= 1
+        if self.recorder is not None:
+            self.recorder.hits.append(self.scheduler.cycles)
+        if self.debug_mode and not self.replaying:
+            self.step_debug()
+        # исходная инструкция выполняется один раз, ловушка возвращается следующим тактом
+        self.memory[address] = original
+        self.memory_written(address, address + 1)
+        self.scheduler.schedule(2, lambda when: self.rearm_breakpoint(address))
+
+    def rearm_breakpoint(self, address):
+        if address in self.breakpoints:
+            self.memory[address] = BREAKPOINT_OPCODE
+            self.memory_written(address, address + 1)
+
+    def set_watchpoint(self, address, flags=WATCH_WRITE):
+        self.watchpoints[address] = self.watchpoints.get(address, 0) | flags
+        self.watch_pages[address >> WATCH_PAGE_SHIFT] |= flags
+
+    def clear_watchpoint(self, address):
+        self.watchpoints.pop(address, None)
+        page = address >> WATCH_PAGE_SHIFT
+        self.watch_pages[page] = 0
+        for watched, flags in self.watchpoints.items():
+            if watched >> WATCH_PAGE_SHIFT == page:
+                self.watch_pages[page] |= flags
+
+    def watch_access(self, address, flags, size=1):
+        # медленный путь: страница под наблюдением, ищем точный адрес
+        for watched in range(address, address + size):
+            if self.watchpoints.get(watched, 0) & flags:
+                if self.recorder is not None:
+                    self.recorder.hits.append(self.scheduler.cycles)
+                if self.replaying:
+                    continue
+                kind = 'write' if flags & WATCH_WRITE else 'read'
+                print(f"\x1b[33mWatchpoint {kind} {watched:05X} at IP={self.registers['IP']:04X}\x1b[0m")
+                if self.debug_mode:
+                    self.step_debug()
 
     def single_step(self):
         old_ip = self.registers['IP']
@@ -650,21 +4929,19 @@ class PetyshCore16:
         return old_ip
 
     def load_program(self, program):
-        for i, byte in enumerate(program):
-            self.memory[i] = byte
+        self.memory[0:len(program)] = bytes(program)
+        self.memory_written(0, len(program))
+        self.arm_breakpoints()
+        if len(program) > self.descriptor_lo and self.descriptor_hi:
+            self.descriptor_tables_written()
 
     def fetch_instruction(self):
-        if self.registers['IP'] >= len(self.memory):
+        ip = self.registers['IP']
+        if ip >= len(self.memory):
             self.handle_interrupt(0x00)
             return 0xFF
-        return self.memory[self.registers['IP']]
-    
-        try:
-            opcode = self.memory[self.registers['IP']]
-        except IndexError:
-            opcode = 0xFF
-        self.registers['IP'] += 1
-        return opcode
+        self.registers['IP'] = ip + 1
+        return self.memory[ip]
 
     def update_flags(self):
         self.registers['FLAGS'] = 0b00000000
@@ -680,20 +4957,55 @@ class PetyshCore16:
         sector = self.registers['CX']
         address = (self.registers['ES'] << 4) + self.registers['BX']
         if sector in self.disk_data:
-            data = self.disk_data[sector]
-            for i, byte in enumerate(data):
-                if address+i < len(self.memory):
-                    self.memory[address+i] = byte
+            data = self.disk_data[sector][:len(self.memory) - address]
+            self.memory[address:address+len(data)] = data
+            self.disk_written(address, address + len(data))
             self.registers['AX'] = 0x0000
         else:
             self.registers['AX'] = 0x0001
 
+    def int13_read_sectors(self):
+        """AH=02h как у BIOS: AL секторов с CH/CL/DH в ES:BX, статус в AH и CF"""
+        count = self.registers['AX'] & 0xFF
+        cx = self.registers['CX']
+        cylinder = (cx >> 8) | ((cx & 0xC0) << 2)
+        sector = cx & 0x3F
+        head = self.registers['DX'] >> 8
+        first = (cylinder * FLOPPY_HEADS + head) * FLOPPY_SECTORS + sector - 1
+        address = (self.registers['ES'] << 4) + self.registers['BX']
+        start = address
+        for index in range(count):
+            lba = first + index
+            data = self.disk_data.get(lba, bytes(512) if lba < FLOPPY_TOTAL else None) if sector else None
+            if data is None:
+                self.registers['AX'] = (0x04 << 8) | index # сектор не найден
+                self.registers['FLAGS'] |= 0b00000010
+                break
+            data = data[:len(self.memory) - address]
+            self.memory[address:address+len(data)] = data
+            address += 512
+        else:
+            self.registers['AX'] = count
+            self.registers['FLAGS'] &= ~0b00000010
+        self.disk_written(start, min(address, len(self.memory)))
+
+    def disk_written(self, lo, hi):
+        """Сектора легли в [lo, hi): наблюдение, ловушки поверх нового кода, кэши"""
+        if lo >= hi:
+            return
+        watch = self.watch_pages
+        if any(watch[lo >> WATCH_PAGE_SHIFT:((hi - 1) >> WATCH_PAGE_SHIFT) + 1]):
+            self.watch_access(lo, WATCH_WRITE, hi - lo)
+        self.arm_breakpoints(lo, hi)
+        self.memory_written(lo, hi)
+        if lo < self.descriptor_hi and hi > self.descriptor_lo:
+            self.descriptor_tables_written()
+
     def handle_rtc_interrupt(self):
-        function = self.registers['AX'] & 0xFF
-        if function == 0x00:
-            # получение времени
-            self.registers['CX'] = self.rtc_time.hour
-            self.registers['DX'] = self.rtc_time.minute
+        # получение времени: момент запуска плюс виртуальное время
+        now = self.rtc_time + datetime.timedelta(seconds=self.scheduler.cycles / CPU_HZ)
+        self.registers['CX'] = now.hour
+        self.registers['DX'] = now.minute
 
     def handle_font_interrupt(self):
         function = self.registers['AX'] & 0xFF
@@ -712,15 +5024,16 @@ class PetyshCore16:
             # установка текущего шрифта
             name_ptr = (self.registers['DS'] << 4) + self.registers['SI']
             name = self.read_string(name_ptr)
-            self.vc.set_font(name)
+            if not self.vc.set_font(name):
+                self.registers['AX'] = 0xFFFF
         elif function == 0x02:  # Получение информации о шрифте
             name_ptr = (self.registers['DS'] << 4) + self.registers['SI']
             name = self.read_string(name_ptr)
             if name in self.vc.fonts:
                 font = self.vc.fonts[name]
-                self.registers['AX'] = font['width']
-                self.registers['BX'] = font['height']
-                self.registers['CX'] = len(font['data'])
+                self.registers['AX'] = font.width
+                self.registers['BX'] = font.height
+                self.registers['CX'] = len(font.data)
             else:
                 self.registers['AX'] = 0xFFFF
 
@@ -732,113 +5045,364 @@ class PetyshCore16:
             address += 1
         return result
 
-    def handle_video_interrupt(self):
-        function = self.registers['AX'] & 0xFF00
-        subfunction = self.registers['AX'] & 0xFF
-        ah = (self.registers['AX'] & 0xFF00) >> 8
-        al = self.registers['AX'] & 0xFF
+    # таблица прерываний
+    def setup_interrupts(self):
+        """Нативные обработчики BIOS/DOS: вектор -> 256 подфункций по AH"""
+        self.interrupt_table = [None] * IVT_SIZE # нативный обработчик вектора, handler(int_num)
+        self.service_tables = [None] * IVT_SIZE # подфункции по AH
+        services = {
+            0x10: {
+                0x00: self.int10_set_mode,
+                0x01: self.int10_set_cursor_shape,
+                0x02: self.int10_set_cursor,
+                0x03: self.int10_get_cursor,
+                0x05: self.int10_select_page,
+                0x08: self.int10_read_char,
+                0x09: self.int10_write_char,
+                0x0E: self.int10_teletype,
+                0x10: self.int10_palette,
+                0x11: self.handle_font_interrupt,
+            },
+            0x13: {
+                0x00: self.int13_reset,
+                0x02: self.handle_disk_interrupt,
+            },
+            0x16: {
+                0x00: self.keyboard_interrupt,
+                0x01: self.int16_check_key,
+                0x10: self.keyboard_interrupt,
+            },
+            0x1A: {
+                0x00: self.int1a_get_ticks,
+                0x02: self.handle_rtc_interrupt,
+            },
+            0x21: {
+                0x25: self.dos_set_vector,
+                0x35: self.dos_get_vector,
+                0x48: self.dos_allocate,
+                0x49: self.dos_free,
+                0x4B: self.dos_exec,
+                0x4C: self.dos_terminate,
+            },
+        }
+        for int_num, functions in services.items():
+            for function, handler in functions.items():
+                self.register_service(int_num, function, handler)
+        self.register_interrupt(0x08, self.int08_timer)
+        self.register_interrupt(0x20, self.int20_terminate)
+        self.register_interrupt(0x09, self.int09_keyboard)
 
-        if ah == 0x00:
-            self.vc.set_video_mode(al)
-        elif ah == 0x0E:
-            char = chr(al)
-            self.vc.put_char(char, self.vc.attr)
+    def register_service(self, int_num, function, handler):
+        """Новый сервис одной строкой: self.register_service(0x21, 0x30, self.dos_version)"""
+        table = self.service_tables[int_num]
+        if table is None:
+            table = self.service_tables[int_num] = [None] * 256
+            self.interrupt_table[int_num] = self.dispatch_service
+        table[function] = handler
+
+    def register_interrupt(self, int_num, handler):
+        self.interrupt_table[int_num] = handler
+
+    def dispatch_service(self, int_num):
+        handler = self.service_tables[int_num][(self.registers['AX'] >> 8) & 0xFF]
+        if handler is not None:
+            handler()
+
+    def handle_interrupt(self, int_num):
+        if int_num >= IVT_SIZE:
+            self.handle_memory_fault(0)
+            return 
+
+        vector = self.ivt[int_num]
+        if not vector:
+            handler = self.interrupt_table[int_num]
+            if handler is not None:
+                # нативный обработчик сразу возвращает управление вызвавшему
+                if self.profiler is None:
+                    handler(int_num)
+                else:
+                    start = time.perf_counter_ns()
+                    handler(int_num)
+                    self.profiler.record_vector(int_num, time.perf_counter_ns() - start)
+                return
+
+        # вектор гостя важнее встроенного: сохранения состояний
+        self.push(self.registers['IP'])
+        self.push(self.registers['FLAGS'])
+
+        # переход к обработчику
+        self.registers['IP'] = vector
+
+    # устройства
+    def raise_irq(self, irq):
+        # только отметка в IRR, доставка на ближайшей границе бюджета
+        self.pic.raise_irq(irq)
+        self.request_service()
+
+    def request_service(self):
+        # цикл ЦП проверяет лишь дедлайн планировщика, обнуляем его
+        self.scheduler.deadline = 0
+
+    def drain_keyboard(self, where):
+        """Ввод хоста в буферы: при записи - в журнал по такту, при повторе - из журнала"""
+        recorder = self.recorder
+        if self.replaying:
+            text = recorder.replay.pop((self.scheduler.cycles, where), None) if recorder is not None else None
+            if text:
+                self.keyboard.feed(text)
+            return
+        text = self.keyboard.drain()
+        if text and recorder is not None:
+            recorder.log_input(where, text)
+
+    def wake_host(self):
+        # из потока чтения: ввод разберётся на ближайшей границе, хост выходит из сна
+        self.request_service()
+        self.host_wake.set()
+
+    def service_devices(self, deliver=None):
+        """Граница бюджета: события устройств и доставка IRQ при IF=1; True - остановить цикл"""
+        self.scheduler.run_due()
+        if self.stop_requested:
+            return True
+        if self.sampler is not None and self.sampler.due:
+            self.sampler.sample()
+        if self.keyboard.incoming or self.replaying:
+            self.drain_keyboard('service')
+        if self.interrupt_enabled and self.pic.ready():
+            (deliver or self.handle_interrupt)(self.pic.acknowledge())
+            if self.pic.ready():
+                self.request_service()
+        return False
+
+    def write_pic_port(self, port, value):
+        self.pic.write_port(port, value)
+        # EOI или снятие маски могли открыть ожидающий IRQ
+        if self.pic.pending:
+            self.request_service()
+
+    def vblank_event(self, when):
+        self.scheduler.schedule_at(when + VBLANK_CYCLES, self.vblank_event)
+        self.vc.handle_vblank()
+        self.render_frame()
+        if self.input_script is not None and self.input_script.waiting is not None:
+            self.input_script.check_screen()
+
+    def render_frame(self):
+        if self.profiler is None:
             self.vc.show_video_output()
-            
-        if (self.registers['AX'] & 0xFF00) == 0x0E00:
-            char = self.registers['AX'] & 0xFF
-            self.vc.put_char(char, 0x07)
-            self.vc.dirty_rects = True
-
-        if function == 0x0000:  # Set video mode
-            self.vc.set_video_mode(subfunction)
-        elif function == 0x0100:  # Set cursor shape
-            self.vc.cursor_shape = (self.registers['CX'] >> 8, self.registers['CX'] & 0xFF)
-        elif function == 0x0200:  # Set cursor position
-            self.vc.cursor_y = self.registers['DX'] >> 8
-            self.vc.cursor_x = self.registers['DX'] & 0xFF
-        elif function == 0x0300:  # Get cursor info
-            self.registers['CX'] = (self.vc.cursor_shape[0] << 8) | self.vc.cursor_shape[1]
-            self.registers['DX'] = (self.vc.cursor_y << 8) | self.vc.cursor_x
-        elif function == 0x0500:  # Select active page
-            self.vc.active_page = subfunction
-        elif function == 0x0800:  # Write char+attr
-            char = self.registers['AX'] & 0xFF
-            count = self.registers['CX']
-            self.vc.put_char(char, self.registers['BX'], count)
-        elif function == 0x1000:  # Set DAC color
+            return
+        start = time.perf_counter_ns()
+        self.vc.show_video_output()
+        self.profiler.record_frame(time.perf_counter_ns() - start)
+
+    def load_input_script(self, text):
+        self.input_script = InputScript(self, parse_input_script(text))
+        self.input_script.advance()
+
+    def int08_timer(self, int_num):
+        # счётчик тиков BIOS, копия в 0040:006C для гостя
+        self.timer_ticks = (self.timer_ticks + 1) % TICKS_PER_DAY
+        self.memory[0x46C:0x470] = self.timer_ticks.to_bytes(4, 'little')
+        self.pic.end_of_interrupt()
+
+    def int09_keyboard(self, int_num):
+        # слово уже в буфере BIOS, остаётся снять скан-код и отдать EOI
+        self.keyboard.read_port(0x60)
+        self.pic.end_of_interrupt()
+
+    # INT 10h
+    def int10_set_mode(self):
+        self.vc.set_video_mode(self.registers['AX'] & 0xFF)
+
+    def int10_set_cursor_shape(self):
+        self.vc.cursor_shape = (self.registers['CX'] >> 8, self.registers['CX'] & 0xFF)
+
+    def int10_set_cursor(self):
+        self.vc.cursor_y = self.registers['DX'] >> 8
+        self.vc.cursor_x = self.registers['DX'] & 0xFF
+
+    def int10_get_cursor(self):
+        self.registers['CX'] = (self.vc.cursor_shape[0] << 8) | self.vc.cursor_shape[1]
+        self.registers['DX'] = (self.vc.cursor_y << 8) | self.vc.cursor_x
+
+    def int10_select_page(self):
+        self.vc.active_page = self.registers['AX'] & 0xFF
+
+    def int10_read_char(self):
+        char, attr = self.vc.read_char_attr()
+        self.registers['AX'] = (attr << 8) | char
+
+    def int10_write_char(self):
+        # AL - символ, BL - атрибут, CX - сколько раз; курсор не двигается
+        self.vc.write_char_attr(self.registers['AX'] & 0xFF, self.registers['BX'] & 0xFF, self.registers['CX'])
+
+    def int10_teletype(self):
+        self.vc.put_char(chr(self.registers['AX'] & 0xFF), self.vc.attr)
+
+    def int10_palette(self):
+        subfunction = self.registers['AX'] & 0xFF
+        if subfunction == 0x00:  # Set DAC color
             index = self.registers['BX']
             r = (self.registers['CX'] >> 8) & 0xFF
             g = self.registers['CX'] & 0xFF
             b = self.registers['DX'] >> 8
             self.vc.set_dac_color(index, r, g, b)
-        elif function == 0x1001:
+        elif subfunction == 0x01:
             addr = (self.registers['ES'] << 4) + self.registers['BX']
             font_data = bytes(self.memory[addr:addr+2048])
-            self.vc.load_font(font_data)
-        elif function == 0x1002:
+            self.vc.load_font('user', font_data, 8, 8) # 256 символов 8x8
+        elif subfunction == 0x02:
             width = self.registers['CX']
             height = self.registers['DX']
             colors = [
                 (self.registers['SI'] >> 8, self.registers['SI'] & 0xFF, self.registers['DI'] >> 8),
                 (self.registers['DI'] & 0xFF, self.registers['BX'] >> 8, self.registers['BX'] & 0xFF)
             ]
-            gradient = self.vc.create_gradient(width, height, colors)
-        elif function == 0x1003:
+            self.vc.create_gradient(width, height, colors)
+        elif subfunction == 0x03:
             self.gpu_accelerated = True
-        elif function == 0x0E00:  # Вывод символа (AH=0x0E)
-            char = self.registers['AX'] & 0xFF
-            self.put_char(char, 0x07)
-            self.dirty_rects = True
 
-    def handle_interrupt(self, int_num):
-        if int_num >= IVT_SIZE:
-            self.handle_memory_fault(0)
-            return 
-        
-        # чета типа обработчика прерываний
-        if int_num == 0x10:
-            self.handle_video_interrupt()
-        elif int_num == 0x13:
-            # диски типо ну это для ос для этого проца это уже в будущем
-            # продумал круто типо да?
-            self.handle_disk_interrupt()
-        elif int_num == 0x16:
-            self.keyboard_interrupt() # клава типо
-        elif int_num == 0x21:
-            # дос
-            self.handle_dos_interrupt()
-        if int_num == 0x21 and (self.registers['AX'] >> 8) == 0x48:
-            # DOS ALLOCATE MEMORY
-            size = self.registers['BX']
-            addr = self.allocate_memory(size)
-            self.registers['AX'] = addr
-        elif int_num == 0x21 and (self.registers['AX'] >> 8) == 0x49:
-            # DOS FREE MEMORY
-            ptr = self.registers['ES']
-            self.free_memory(ptr)
-        elif int_num == 0x1A:
-            # RTC
-            self.handle_rtc_interrupt()
-
-        # сохранения состояний
-        self.push(self.registers['IP'])
-        self.push(self.registers['FLAGS'])
+    # INT 13h, 16h, 1Ah
+    def int13_reset(self):
+        self.registers['AX'] = 0x0000
 
-        # переход к обработчику
-        self.registers['IP'] = self.ivt[int_num]
+    def keyboard_interrupt(self):
+        keys = self.keyboard.keys
+        if not keys and (self.keyboard.incoming or self.replaying):
+            self.drain_keyboard('int')
+        if not keys:
+            self.keyboard.refill()
+        if keys:
+            self.registers['AX'] = keys.popleft()
+        else:
+            self.registers['AX'] = 0x0000 # двери не открываются без ключа
+            self.key_wait = True
 
-    def handle_dos_interrupt(self):
-        function = self.registers['AX'] >> 8
-        if function == 0x4C:
-            self.os_loaded = False
-        if function == 0x4B:
-            filename_addr = (self.registers['DS'] << 4) + self.registers['DX']
-            filename = ""
-            while self.memory[filename_addr] != 0:
-                filename += chr(self.memory[filename_addr])
-                filename_addr += 1
+    def int16_check_key(self):
+        keys = self.keyboard.keys
+        if not keys and (self.keyboard.incoming or self.replaying):
+            self.drain_keyboard('int')
+        if not keys:
+            self.keyboard.refill()
+        if keys:
+            self.registers['AX'] = keys[0]
+            self.registers['FLAGS'] &= ~0b00000001
+            self.empty_polls = 0
+        else:
+            self.registers['FLAGS'] |= 0b00000001 # ZF - клавиш нет
+            # опросы пустого буфера в тесном цикле - то же ожидание, что INT 16h/00;
+            # повторить INT после события умеет только движок x86
+            cycles = self.scheduler.cycles
+            self.empty_polls = self.empty_polls + 1 if cycles - self.last_poll < IDLE_POLL_WINDOW else 1
+            self.last_poll = cycles
+            if self.empty_polls >= IDLE_POLLS and self.engine is not None:
+                self.empty_polls = 0
+                self.key_wait = True # INT повторится после события, AH не трогаем
+            else:
+                self.registers['AX'] = 0x0000
+
+    def add_key_input(self, text):
+        self.keyboard.queue_script(text)
+
+    def int1a_get_ticks(self):
+        self.registers['CX'] = (self.timer_ticks >> 16) & 0xFFFF
+        self.registers['DX'] = self.timer_ticks & 0xFFFF
+        self.registers['AX'] &= 0xFF00
+
+    # INT 21h
+    def dos_set_vector(self):
+        self.ivt[self.registers['AX'] & 0xFF] = self.registers['DX']
+
+    def dos_get_vector(self):
+        self.registers['ES'] = 0x0000
+        self.registers['BX'] = self.ivt[self.registers['AX'] & 0xFF]
+
+    def dos_allocate(self):
+        # DOS ALLOCATE MEMORY (BX - параграфы, AX - сегмент блока)
+        size = self.registers['BX']
+        segment = self.allocate_memory(size)
+        if segment == 0xFFFF:
+            self.registers['FLAGS'] |= 0b00000010 # CF
+            self.registers['BX'] = self.allocator.largest_free()
+        else:
+            self.registers['FLAGS'] &= ~0b00000010
+        self.registers['AX'] = segment
+
+    def dos_free(self):
+        # DOS FREE MEMORY
+        self.free_memory(self.registers['ES'])
+
+    def dos_exec(self):
+        filename_addr = (self.registers['DS'] << 4) + self.registers['DX']
+        filename = self.read_string(filename_addr)
+        if self.engine is None:
             self.load_and_run_program(filename)
+        else:
+            self.exec_com(filename)
+
+    def exec_com(self, filename):
+        """EXEC под x86: .COM в блок кучи с PSP, родитель продолжит после выхода ребёнка"""
+        registers = self.registers
+        try:
+            with open(f"{self.programs_dir}{filename}", "rb") as f:
+                image = f.read()
+        except OSError:
+            registers['FLAGS'] |= 0b00000010 # CF
+            registers['AX'] = DOS_FILE_NOT_FOUND
+            return
+        paragraphs = min(COM_PARAGRAPHS, self.allocator.largest_free())
+        top = paragraphs << 4
+        if PSP_SIZE + len(image) + 2 > top:
+            registers['FLAGS'] |= 0b00000010
+            registers['AX'] = DOS_NOT_ENOUGH_MEMORY
+            registers['BX'] = self.allocator.largest_free()
+            return
+        segment = self.allocator.allocate(paragraphs)
+        base = segment << 4
+        psp = bytearray(PSP_SIZE)
+        psp[0:2] = b'\xCD\x20' # RET из .COM попадает сюда - INT 20h
+        psp[2:4] = (segment + paragraphs).to_bytes(2, 'little') # конец блока
+        psp[0x81] = 0x0D # пустая командная строка
+        self.memory[base:base + PSP_SIZE] = psp
+        self.memory[base + PSP_SIZE:base + PSP_SIZE + len(image)] = image
+        self.memory[base + top - 2:base + top] = bytes(2) # адрес возврата PSP:0000
+        self.disk_written(base, base + top)
+        self.dos_processes.append((dict(registers), segment))
+        for name in ('CS', 'DS', 'ES', 'SS'):
+            registers[name] = segment
+        registers['IP'] = PSP_SIZE
+        registers['SP'] = (top - 2) & 0xFFFF
+        registers['AX'] = 0
+
+    def dos_terminate(self):
+        if self.dos_processes:
+            # ребёнок EXEC: освобождаем его блок, родитель продолжает после INT 21h/4Bh
+            parent, segment = self.dos_processes.pop()
+            self.allocator.free(segment)
+            self.registers.update(parent)
+            self.registers['FLAGS'] &= ~0b00000010
+            return
+        self.os_loaded = False
+
+    def int20_terminate(self, int_num):
+        self.dos_terminate()
+
+    # другой стафф
+    def push(self, value):
+        sp = self.registers['SP'] = (self.registers['SP'] - 2) & 0xFFFF
+        if self.watch_pages[sp >> WATCH_PAGE_SHIFT] | self.watch_pages[(sp + 1) >> WATCH_PAGE_SHIFT]:
+            self.watch_access(sp, WATCH_WRITE, 2)
+        self.memory[sp] = (value >> 8) & 0xFF
+        self.memory[sp + 1] = value & 0xFF
+
+    def pop(self):
+        sp = self.registers['SP']
+        if self.watch_pages[sp >> WATCH_PAGE_SHIFT] | self.watch_pages[(sp + 1) >> WATCH_PAGE_SHIFT]:
+            self.watch_access(sp, WATCH_READ, 2)
+        value = (self.memory[sp] << 8) | self.memory[sp + 1]
+        self.registers['SP'] = (sp + 2) & 0xFFFF
+        return value
 
     def run_os_command(self, command):
         if command.startswith("run "):
@@ -863,18 +5427,7 @@ class PetyshCore16:
 
     # кулл стафф
     def disassemble(self, address):
-        opcode = self.memory[address]
-        if opcode == 0xA4:
-            return "MOVSB"
-        elif opcode == 0xA6:
-            return "CMPSB"
-        elif opcode == 0xAE:
-            return "SCASB"
-        if opcode == 0x01:
-            return f"MOV {['AX','BX','CX','DX'][self.memory[address+1]]}, 0x{self.memory[address+2]:02X}{self.memory[address+3]:02X}"
-        elif opcode == 0xFF:
-            return "HLT"
-        return f"DB 0x{opcode:02X}"
+        return decode_instruction(self.memory, address, self.breakpoints)[1]
 
     def debug_info(self):
         print(f"AX: {self.registers['AX']:04X}  BX: {self.registers['BX']:04X}")
@@ -889,36 +5442,79 @@ class PetyshCore16:
             'STACK': {'base': 0xF000, 'limit': 0xFFFF, 'access': 0x96},
             'VIDEO': {'base': 0xB800, 'limit': 0x7FFF, 'access': 0x92}
         }
+        self.invalidate_segments()
 
-    def read_memory(self, segment, offset):
-        seg_info = self.segments.get(segment)
+    def invalidate_segments(self, seg_id=None):
+        """Сброс кэша трансляции (после правки self.segments или GDT)"""
+        if seg_id is None:
+            self.segment_tlb = [None] * len(SEGMENT_NAMES)
+        else:
+            self.segment_tlb[seg_id] = None
+
+    def fill_segment_tlb(self, seg_id):
+        selector = self.registers.get(SEGMENT_OF_ID.get(seg_id), 0)
+        if self.gdtr['limit'] and selector >= 8:
+            # таблица дескрипторов загружена: сегмент задаёт селектор в регистре
+            descriptor = self.descriptor(selector)
+            if descriptor is None:
+                return None
+            base, limit, access = descriptor
+            entry = (base, limit, bool(access & 0x02))
+            self.segment_tlb[seg_id] = entry
+            return entry
+        seg_info = self.segments.get(SEGMENT_NAMES[seg_id])
         if not seg_info:
+            return None
+        entry = (seg_info['base'], seg_info['limit'], bool(seg_info['access'] & 0x02))
+        self.segment_tlb[seg_id] = entry
+        return entry
+
+    def load_segment(self, reg, value):
+        """Загрузка сегментного регистра"""
+        self.registers[reg] = value
+        seg_id = SEGMENT_REGISTERS.get(reg)
+        if seg_id is not None:
+            self.segment_tlb[seg_id] = None
+
+    def read_memory(self, segment, offset):
+        # segment - имя ('DATA') или номер (SEG_DATA); номер идёт без поиска по словарям
+        seg_id = SEGMENT_IDS.get(segment) if segment.__class__ is str else segment
+        if seg_id is None:
             self.handle_memory_fault(0)
             return 0
-            
-        if offset > seg_info['limit']:
+        entry = self.segment_tlb[seg_id] or self.fill_segment_tlb(seg_id)
+        if entry is None:
+            self.handle_memory_fault(0)
+            return 0
+
+        base, limit, _ = entry
+        if offset > limit:
             self.handle_memory_fault(offset)
             return 0
-            
-        physical_addr = seg_info['base'] + offset
-        return self.memory[physical_addr]
+        if self.watch_pages[(base + offset) >> WATCH_PAGE_SHIFT] & WATCH_READ:
+            self.watch_access(base + offset, WATCH_READ)
+        return self.memory[base + offset]
         
     def write_memory(self, segment, offset, value):
-        seg_info = self.segments.get(segment)
-        if not seg_info:
+        seg_id = SEGMENT_IDS.get(segment) if segment.__class__ is str else segment
+        if seg_id is None:
             self.handle_memory_fault(0)
             return
-            
-        if seg_info['access'] & 0x02 == 0:
-            self.handle_memory_fault(offset)
-            return 
-            
-        if offset > seg_info['limit']:
-            self.handle_memory_fault(offset)
+        entry = self.segment_tlb[seg_id] or self.fill_segment_tlb(seg_id)
+        if entry is None:
+            self.handle_memory_fault(0)
             return
 
-        physical_addr = seg_info['base'] + offset
-        self.memory[physical_addr] = value
+        base, limit, writable = entry
+        if not writable or offset > limit:
+            self.handle_memory_fault(offset)
+            return
+        physical_addr = base + offset
+        if self.watch_pages[physical_addr >> WATCH_PAGE_SHIFT] & WATCH_WRITE:
+            self.watch_access(physical_addr, WATCH_WRITE)
+        self.memory[physical_addr] = value & 0xFF
+        if self.descriptor_lo <= physical_addr < self.descriptor_hi:
+            self.descriptor_tables_written()
         
     def handle_memory_fault(self, address):
         self.push(self.registers['FLAGS'])
@@ -927,51 +5523,59 @@ class PetyshCore16:
         self.registers['IP'] = self.ivt[0x0D]
         
     def allocate_memory(self, size):
-        mcb_addr = self.current_mcb
-        while mcb_addr < len(self.memory_map):
-            if not self.memory_map[mcb_addr]:
-                if self.check_free_block(mcb_addr, size):
-                    self.set_mcb(mcb_addr, size)
-                    return mcb_addr + 16
-            mcb_addr += 16 + (self.memory[mcb_addr+1] << 8 | self.memory[mcb_addr])
-        return 0xFFFF
-        
-    def check_free_block(self, addr, size):
-        for i in range(addr, addr + size + 16):
-            if self.memory_map[i]:
-                return False
-            return True
-            
-    def set_mcb(self, addr, size):
-        self.memory[addr] = size & 0xFF
-        self.memory[addr+1] = (size >> 8) & 0xFF
-        self.memory[addr+2] = 0x4D
-        for i in range(addr, addr + size + 16):
-            self.memory_map[i] = True
+        segment = self.allocator.allocate(size)
+        return 0xFFFF if segment is None else segment
             
-    def free_memory(self, ptr):
-        mcb_addr = ptr - 16
-        if self.memory[mcb_addr+2] != 0x4D:
+    def free_memory(self, segment):
+        mcb_addr = (segment - 1) << 4
+        if mcb_addr < 0 or self.memory[mcb_addr+2] != MCB_SIGNATURE or not self.allocator.free(segment):
             self.handle_memory_fault(mcb_addr)
-            return
-            
-        size = self.memory[mcb_addr] | (self.memory[mcb_addr+1] << 8)
-        for i in range(mcb_addr, mcb_addr + size + 16):
-            self.memory_map[i] = False
             
+    def read_descriptor_table(self, base, limit):
+        """Разбор таблицы дескрипторов одним проходом struct по памяти гостя"""
+        size = min(limit + 1, len(self.memory) - base) & ~7
+        return list(DESCRIPTOR.iter_unpack(memoryview(self.memory)[base:base+size]))
+
     def load_gdt(self, base, limit):
         self.gdtr['base'] = base
         self.gdtr['limit'] = limit
-        for i in range(0, limit+1, 8):
-            entry = {
-                'base': self.memory[i+2] | (self.memory[i+3] << 8) | (self.memory[i+4] << 16),
-                'limit': self.memory[i] | (self.memory[i+1] << 8),
-                'access': self.memory[i+5]
-            }
-            if i//8 >= len(self.gdt):
-                self.gdt.append(entry)
-            else:
-                self.gdt[i//8] = entry
+        self.gdt = self.read_descriptor_table(base, limit)
+        self.update_descriptor_range()
+
+    def load_ldt(self, base, limit):
+        self.ldtr['base'] = base
+        self.ldtr['limit'] = limit
+        self.ldt = self.read_descriptor_table(base, limit)
+        self.update_descriptor_range()
+
+    def update_descriptor_range(self):
+        ranges = [(t['base'], t['base'] + t['limit'] + 1) for t in (self.gdtr, self.ldtr) if t['limit']]
+        self.descriptor_lo = min((lo for lo, _ in ranges), default=0)
+        self.descriptor_hi = max((hi for _, hi in ranges), default=0)
+        self.descriptor_cache.clear()
+        self.invalidate_segments()
+
+    def descriptor_tables_written(self):
+        # гость переписал GDT/LDT - перечитываем таблицы и сбрасываем кэши
+        if self.gdtr['limit']:
+            self.gdt = self.read_descriptor_table(self.gdtr['base'], self.gdtr['limit'])
+        if self.ldtr['limit']:
+            self.ldt = self.read_descriptor_table(self.ldtr['base'], self.ldtr['limit'])
+        self.descriptor_cache.clear()
+        self.invalidate_segments()
+
+    def descriptor(self, selector):
+        """(base, limit, access) по селектору; повторная загрузка - один поиск в словаре"""
+        cached = self.descriptor_cache.get(selector)
+        if cached is not None:
+            return cached
+        table = self.ldt if selector & 0x04 else self.gdt
+        index = selector >> 3
+        if index >= len(table):
+            return None
+        decoded = decode_descriptor(table[index])
+        self.descriptor_cache[selector] = decoded
+        return decoded
     
     def step_debug(self):
         print("\x1b[2J\x1b[H")
@@ -986,12 +5590,8 @@ class PetyshCore16:
         print(f"FLAGS: {bin(self.registers['FLAGS'])[2:].zfill(8)}")
 
     def debug_disassemble_text(self, num_instructions=5):
-        ip = self.registers['IP']
-        for i in range(num_instructions):
-            addr = ip + i
-            if addr >= len(self.memory):
-                break
-            print(f"{addr:04X}: {self.disassemble(addr)}")
+        for addr, _, text in islice(self.disassembler.sweep(self.registers['IP']), num_instructions):
+            print(f"{addr:04X}: {text}")
 
     def debug_show_memory(self, start, length):
         for i in range(start, start+length, 16):
@@ -1000,26 +5600,125 @@ class PetyshCore16:
             print(line)
 
     # оптимайзинг йоу
-    def enable_jit(self):
-        self.execute = numba.jit(self.execute, nopython=True)
+    def enable_jit(self, threshold=HOT_BLOCK_THRESHOLD):
+        """Горячие блоки x86 транслируются в Python-функции; threshold=None - выключить"""
+        if self.engine is None:
+            raise RuntimeError("JIT translates x86 blocks: boot an image first")
+        self.engine.set_translator(threshold)
 
     def cache_decoded_instructions(self):
-        self.instruction_cache = {}
-        for addr in range(len(self.memory)):
-            self.instruction_cache[addr] = self.disassemble(addr)
+        # только начала инструкций программы, а не каждый байт мегабайта
+        self.instruction_cache = {addr: text for addr, _, text in self.disassembler.sweep(0, 0x10000)}
 
     ##########
 
-    def handle_mul_instruction(self):
-        reg_code = self.fetch_instruction()
-        reg = self.reg_names[reg_code]
+    def dispatch(self, opcode):
+        """Операнды по таблице опкодов и обработчик op_*; True - HLT, цикл останавливается"""
+        entry = OPCODE_TABLE[opcode]
+        if entry is None:
+            return False # неизвестный опкод - пустая инструкция, как DB в дизассемблере
+        operands = []
+        for kind in entry[1]:
+            size = OPERAND_SIZES.get(kind, 0)
+            if not size:
+                operands.append(kind) # фиксированный операнд: имя регистра или [BX]
+                continue
+            value = self.fetch_instruction()
+            if size == 2:
+                second = self.fetch_instruction()
+                value = (second << 8) | value if kind == 'word' else (value << 8) | second
+            elif kind == 'reg':
+                value = self.reg_names[value]
+            operands.append(value)
+        return self.opcode_handlers[opcode](*operands)
+
+    def op_mov(self, reg, value):
+        self.registers[reg] = value
+
+    def op_store(self, target, source):
+        # MOV [BX], AX: слово старшим байтом вперёд
+        address = self.registers[target[1:-1]]
+        watch = self.watch_pages
+        if watch[address >> WATCH_PAGE_SHIFT] | watch[(address + 1) >> WATCH_PAGE_SHIFT]:
+            self.watch_access(address, WATCH_WRITE, 2)
+        self.memory[address] = (self.registers[source] >> 8) & 0xFF
+        self.memory[address + 1] = self.registers[source] & 0xFF
+        if self.descriptor_lo <= address + 1 and address < self.descriptor_hi:
+            self.descriptor_tables_written()
+
+    def op_load(self, target, source):
+        address = self.registers[source[1:-1]]
+        watch = self.watch_pages
+        if watch[address >> WATCH_PAGE_SHIFT] | watch[(address + 1) >> WATCH_PAGE_SHIFT]:
+            self.watch_access(address, WATCH_READ, 2)
+        self.registers[target] = (self.memory[address] << 8) | self.memory[address + 1]
+
+    def op_add(self, reg1, reg2):
+        result = self.registers[reg1] + self.registers[reg2]
+        self.registers[reg1] = result & 0xFFFF
+
+        # обнова флагов
+        self.registers['FLAGS'] = 0b00000000
+        if result > 0xFFFF:
+            self.registers['FLAGS'] |= 0b00000010 # флаг переноса
+        if self.registers[reg1] == 0:
+            self.registers['FLAGS'] |= 0b00000001 # нулевой результат
+
+    def op_sub(self, reg1, reg2):
+        result = self.registers[reg1] - self.registers[reg2]
+        self.registers[reg1] = result & 0xFFFF
+        self.update_arithmetic_flags(result)
+
+    def op_adc(self, reg1, reg2):
+        carry = (self.registers['FLAGS'] & 0b00000010) >> 1
+        result = self.registers[reg1] + self.registers[reg2] + carry
+        self.registers[reg1] = result & 0xFFFF
+        self.update_arithmetic_flags(result)
+
+    def op_sbb(self, reg1, reg2):
+        borrow = (self.registers['FLAGS'] & 0b00000010) >> 1
+        result = self.registers[reg1] - self.registers[reg2] - borrow
+        self.registers[reg1] = result & 0xFFFF
+        self.update_arithmetic_flags(result)
+
+    def op_cmp(self, reg1, reg2):
+        self.update_arithmetic_flags(self.registers[reg1] - self.registers[reg2])
+
+    def op_and(self, reg1, reg2):
+        self.registers[reg1] &= self.registers[reg2]
+        self.update_logic_flags()
+
+    def op_or(self, reg1, reg2):
+        self.registers[reg1] |= self.registers[reg2]
+        self.update_logic_flags()
+
+    def op_xor(self, reg1, reg2):
+        self.registers[reg1] ^= self.registers[reg2]
+        self.update_logic_flags()
+
+    def op_test(self, reg1, reg2):
+        self.update_logic_flags(self.registers[reg1] & self.registers[reg2])
+
+    def op_not(self, reg):
+        self.registers[reg] = ~self.registers[reg] & 0xFFFF
+        self.update_logic_flags()
+
+    def op_inc(self, reg):
+        self.registers[reg] = (self.registers[reg] + 1) & 0xFFFF
+        self.update_arithmetic_flags(self.registers[reg])
+
+    def op_dec(self, reg):
+        self.registers[reg] = (self.registers[reg] - 1) & 0xFFFF
+        self.update_arithmetic_flags(self.registers[reg])
+
+    def op_mul(self, reg):
         result = self.registers['AX'] * self.registers[reg]
         self.registers['DX'] = (result >> 16) & 0xFFFF
         self.registers['AX'] = result & 0xFFFF
         self.update_arithmetic_flags(result)
 
-    def handle_div_instruction(self):
-        divisor = self.registers[self.reg_names[self.fetch_instruction()]]
+    def op_div(self, reg):
+        divisor = self.registers[reg]
         if divisor == 0:
             self.handle_interrupt(0x00)
             return
@@ -1027,19 +5726,248 @@ class PetyshCore16:
         self.registers['AX'] = dividend // divisor
         var = self.registers['DX'] - dividend % divisor
 
-    def handle_loop_instruction(self):
-        count_reg = self.reg_names[self.fetch_instruction()]
-        offset = self.fetch_instruction()
-        self.registers[count_reg] -= 1
-        if self.registers[count_reg] != 0:
+    def op_shl(self, reg, count):
+        self.registers[reg] = (self.registers[reg] << count) & 0xFF
+        self.update_shift_flags(count)
+
+    def op_rol(self, reg, count):
+        value = self.registers[reg]
+        for _ in range(count):
+            bit = (value >> 15) & 1
+            value = ((value << 1) | bit) & 0xFFFF
+        self.registers[reg] = value
+        self.update_shift_flags(count)
+
+    def op_ror(self, reg, count):
+        value = self.registers[reg]
+        for _ in range(count):
+            bit = value & 1
+            value = (value >> 1) | (bit << 15)
+        self.registers[reg] = value
+        self.update_shift_flags(count)
+
+    def op_jmp(self, address):
+        self.registers['IP'] = address
+
+    def op_jmp_short(self, offset):
+        self.registers['IP'] += offset - 2
+
+    def op_je(self, address):
+        if self.registers['FLAGS'] & 0b0000001:
+            self.registers['IP'] = address
+
+    def op_jne(self, address):
+        if not (self.registers['FLAGS'] & 0b00000001):
+            self.registers['IP'] = address
+
+    def op_jg(self, address):
+        sf = (self.registers['FLAGS'] & 0b00000010) >> 1
+        of = (self.registers['FLAGS'] & 0b00001000) >> 3
+        zf = self.registers['FLAGS'] & 0b00000001
+        if not zf and (zf == of):
+            self.registers['IP'] = address
+
+    def op_jc(self, address):
+        if self.registers['FLAGS'] & 0b00000010:
+            self.registers['IP'] = address
+
+    def op_jnc(self, address):
+        if not (self.registers['FLAGS'] & 0b00000010):
+            self.registers['IP'] = address
+
+    def op_loop(self, reg, offset):
+        self.registers[reg] -= 1
+        if self.registers[reg] != 0:
             self.registers['IP'] += offset - 2
 
-    def handle_interrupt_flag_instruction(self):
-        flag = self.fetch_instruction()
+    def op_call(self, address):
+        self.push(self.registers['IP'])
+        if self.sampler is not None:
+            self.sampler.call((self.registers['CS'] << 4) + self.registers['IP'])
+        self.registers['IP'] = address
+
+    def op_ret(self):
+        self.registers['IP'] = self.pop()
+        if self.sampler is not None:
+            self.sampler.ret()
+
+    def op_push(self, reg):
+        self.push(self.registers[reg])
+
+    def op_pop(self, reg):
+        self.registers[reg] = self.pop()
+
+    def op_pusha(self):
+        sp = self.registers['SP']
+        self.push(self.registers['AX'])
+        self.push(self.registers['CX'])
+        self.push(self.registers['DX'])
+        self.push(self.registers['BX'])
+        self.push(sp)
+        self.push(self.registers['BP'])
+        self.push(self.registers['SI'])
+        self.push(self.registers['DI'])
+
+    def op_popa(self):
+        self.registers['DI'] = self.pop()
+        self.registers['SI'] = self.pop()
+        self.registers['BP'] = self.pop()
+        self.pop()  # Skip SP
+        self.registers['BX'] = self.pop()
+        self.registers['DX'] = self.pop()
+        self.registers['CX'] = self.pop()
+        self.registers['AX'] = self.pop()
+
+    def op_pushf(self):
+        self.push(self.registers['FLAGS'])
+
+    def op_popf(self):
+        self.registers['FLAGS'] = self.pop() & 0xFF
+
+    def op_clc(self):
+        self.registers['FLAGS'] &= ~0b00000010
+
+    def op_stc(self):
+        self.registers['FLAGS'] |= 0b00000010
+
+    def op_cld(self):
+        self.direction_flag = False
+
+    def op_std(self):
+        self.direction_flag = True
+
+    def op_interrupt_flag(self, flag):
         self.interrupt_enabled = (flag == 0x01)
+        if self.interrupt_enabled and self.pic.pending:
+            self.request_service()
+
+    def op_in(self, target, port):
+        # IN AL, port / IN AL, DX: номер порта - байт команды или регистр
+        self.registers['AX'] = self.io.read(self.registers[port] if port.__class__ is str else port)
+
+    def op_out(self, port, source):
+        self.io.write(self.registers[port] if port.__class__ is str else port, self.registers['AX'] & 0xFF)
+
+    def op_lodsb(self):
+        address = (self.registers['DS'] << 4) + self.registers['SI']
+        if self.watch_pages[address >> WATCH_PAGE_SHIFT]:
+            self.watch_access(address, WATCH_READ)
+        self.registers['AX'] = self.memory[address]
+        self.registers['SI'] += 1 if not self.direction_flag else -1
+
+    def op_stosb(self):
+        address = (self.registers['ES'] << 4) + self.registers['DI']
+        if self.watch_pages[address >> WATCH_PAGE_SHIFT]:
+            self.watch_access(address, WATCH_WRITE)
+        self.memory[address] = self.registers['AX'] & 0xFF
+        if self.descriptor_lo <= address < self.descriptor_hi:
+            self.descriptor_tables_written()
+        self.registers['DI'] += 1 if not self.direction_flag else -1
+
+    def op_rep(self):
+        # префикс: следующая инструкция выполняется в этом же такте
+        self.rep_prefix = True
+        return self.dispatch(self.fetch_instruction())
+
+    def op_movsb(self):
+        watch = self.watch_pages
+        count = self.registers['CX'] if self.rep_prefix else 1
+        for _ in range(count):
+            src = (self.registers['DS'] << 4) + self.registers['SI']
+            dest = (self.registers['ES'] << 4) + self.registers['DI']
+            if watch[src >> WATCH_PAGE_SHIFT] | watch[dest >> WATCH_PAGE_SHIFT]:
+                self.watch_access(src, WATCH_READ)
+                self.watch_access(dest, WATCH_WRITE)
+            self.memory[dest] = self.memory[src]
+            if self.descriptor_lo <= dest < self.descriptor_hi:
+                self.descriptor_tables_written()
+            self.registers['SI'] += -1 if self.direction_flag else 1
+            self.registers['DI'] += -1 if self.direction_flag else 1
+            if self.rep_prefix:
+                self.registers['CX'] -= 1
+                if self.registers['CX'] == 0: break
+        self.rep_prefix = False
+
+    def op_cmpsb(self):
+        watch = self.watch_pages
+        count = self.registers['CX'] if self.rep_prefix else 1
+        for _ in range(count):
+            src = (self.registers['DS'] << 4) + self.registers['SI']
+            dest = (self.registers['ES'] << 4) + self.registers['DI']
+            if watch[src >> WATCH_PAGE_SHIFT] | watch[dest >> WATCH_PAGE_SHIFT]:
+                self.watch_access(src, WATCH_READ)
+                self.watch_access(dest, WATCH_READ)
+            res = self.memory[src] - self.memory[dest]
+            self.update_arithmetic_flags(res)
+            self.registers['SI'] += -1 if self.direction_flag else 1
+            self.registers['DI'] += -1 if self.direction_flag else 1
+            if self.rep_prefix:
+                self.registers['CX'] -= 1
+                if self.registers['CX'] == 0 or res != 0: break
+        self.rep_prefix = False
+
+    def op_scasb(self):
+        watch = self.watch_pages
+        count = self.registers['CX'] if self.rep_prefix else 1
+        for _ in range(count):
+            addr = (self.registers['ES'] << 4) + self.registers['DI']
+            if watch[addr >> WATCH_PAGE_SHIFT]:
+                self.watch_access(addr, WATCH_READ)
+            res = (self.registers['AX'] & 0xFF) - self.memory[addr]
+            self.update_arithmetic_flags(res)
+            self.registers['DI'] += -1 if self.direction_flag else 1
+            if self.rep_prefix:
+                self.registers['CX'] -= 1
+                if self.registers['CX'] == 0 or res == 0: break
+        self.rep_prefix = False
+
+    def op_gfx(self, cmd):
+        if cmd == 0x01:
+            # BLIT
+            src_addr = (self.registers['DS'] << 4) + self.registers['SI']
+            dest_x = self.registers['DX'] & 0xFF
+            dest_y = (self.registers['DX'] >> 8) & 0xFF
+            width = self.registers['CX'] & 0xFF
+            height = (self.registers['CX'] >> 8) & 0xFF
+            self.vc.blit(src_addr, dest_x, dest_y, width, height)
+
+    def op_vector(self, op_type):
+        watch = self.watch_pages
+        vector_len = self.registers['CX']
+        src = (self.registers['DS'] << 4) + self.registers['SI']
+        dest = (self.registers['ES'] << 4) + self.registers['DI']
+        if vector_len and (any(watch[src >> WATCH_PAGE_SHIFT:((src + vector_len - 1) >> WATCH_PAGE_SHIFT) + 1])
+                           or any(watch[dest >> WATCH_PAGE_SHIFT:((dest + vector_len - 1) >> WATCH_PAGE_SHIFT) + 1])):
+            self.watch_access(src, WATCH_READ, vector_len)
+            self.watch_access(dest, WATCH_READ | WATCH_WRITE, vector_len)
+
+        for i in range(vector_len):
+            val = self.memory[src + i]
+            if op_type == 0x01:
+                val += self.memory[dest + i]
+            elif op_type == 0x02:
+                val *= self.memory[dest + i]
+            self.memory[dest + i] = val & 0xFF
+        if dest < self.descriptor_hi and dest + vector_len > self.descriptor_lo:
+            self.descriptor_tables_written()
+
+    def op_int3(self):
+        address = self.registers['IP'] - 1
+        if address not in self.breakpoints:
+            self.handle_interrupt(0x03) # настоящий 0xCC гостя
+            return
+        self.registers['IP'] = address
+        self.hit_breakpoint(address)
+
+    def op_int(self, int_num):
+        self.handle_interrupt(int_num)
+
+    def op_hlt(self):
+        self.idle()
+        return True
 
     def execute_instruction(self):
-        pass
+        return self.dispatch(self.fetch_instruction())
 
     def execute_int(self):
         int_num = self.fetch_instruction()
@@ -1054,9 +5982,10 @@ class PetyshCore16:
     def show_video_output(self):
         print("\x1b[H" + self.vc.get_display_output())
 
-    def update_logic_flags(self):
+    def update_logic_flags(self, value=None):
         self.registers['FLAGS'] = 0b00000000
-        value = self.registers['AX']
+        if value is None:
+            value = self.registers['AX']
 
         if value == 0:
             self.registers['FLAGS'] |= 0b00000001 # нуль
@@ -1078,452 +6007,87 @@ class PetyshCore16:
                 self.registers['FLAGS'] |= 0b00000100
 
     def poll_keyboard(self):
-        import sys
-        from select import select
-        if select([sys.stdin], [], [], 0)[0]:
-            self.add_key_input(sys.stdin.read(1))
+        # ввод читает поток клавиатуры, здесь только разбор накопленного
+        if self.keyboard.incoming:
+            self.drain_keyboard('int')
 
     def shutdown(self):
         print("\x1b[0m\x1b[?25h", end='')
         raise SystemExit
 
     def execute(self):
+        if self.recorder is not None and not self.replaying:
+            self.recorder.resume()
+        if self.engine is not None:
+            self.engine.run()
+            return
+        scheduler = self.scheduler
+        profiler = self.profiler
+        perf_counter_ns = time.perf_counter_ns
+        log = None
+        if self.debug_mode:
+            # трасса только под отладчиком: файл открывается один раз на вызов
+            try:
+                log = open("cpu.log", "a")
+            except OSError as log_error:
+                print(f"\x1b[31mLog error: {log_error}\x1b[0m")
         try:
             while True:
-                if self.registers['IP'] in self.breakpoints and self.debug_mode:
-                    self.step_debug()
-
-                self.vc.show_video_output()
+                # устройства и IRQ обслуживаются только к дедлайну
+                scheduler.cycles += 1
+                if scheduler.cycles >= scheduler.deadline and self.service_devices():
+                    scheduler.cycles -= 1 # этот такт ещё не начат
+                    break
 
                 if self.registers['IP'] >= len(self.memory):
                     self.handle_interrupt(0x00)
                     continue
             
+                if profiler is not None:
+                    start_ip = self.registers['IP']
+                    start = perf_counter_ns()
                 opcode = self.fetch_instruction()
+                if log is not None:
+                    log.write(f"IP: {self.registers['IP']:04X} OP: {opcode:02X} AX={self.registers['AX']:04X}\n")
 
-                try:
-                    with open("cpu.log", "a") as log:
-                        log.write(f"IP: {self.registers['IP']:04X} OP: {opcode:02X} AX={self.registers['AX']:04X}\n")
-                except Exception as log_error:
-                    print(f"\x1b[31mLog error: {log_error}\x1b[0m")
-                
-                if opcode == 0x01:
-                    reg_code = self.fetch_instruction()
-                    value_high = self.fetch_instruction()
-                    value_low = self.fetch_instruction()
-                    value = (value_high << 8) | value_low
-                    reg_name = ['AX', 'BX', 'CX', 'DX'][reg_code]
-                    self.registers[reg_name] = value
-                elif opcode == 0x02:
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = ['AX', 'BX', 'CX', 'DX'][reg1_code]
-                    reg2 = ['AX', 'BX', 'CX', 'DX'][reg2_code]
-
-                    result = self.registers[reg1] + self.registers[reg2]
-                    self.registers[reg1] = result & 0xFFFF
-
-                    # обнова флагов
-                    self.registers['FLAGS'] = 0b00000000
-                    if result > 0xFFFF:
-                        self.registers['FLAGS'] |= 0b00000010 # флаг переноса
-                    if self.registers[reg1] == 0:
-                        self.registers['FLAGS'] |= 0b00000001 # нулевой результат
-                elif opcode == 0x03:
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x04:
-                    # sub
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    result = self.registers[reg1] - self.registers[reg2]
-                    self.registers[reg1] = result & 0xFFFF
-                    self.update_arithmetic_flags(result)
-                elif opcode == 0x05:
-                    # and
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    self.registers[reg1] &= self.registers[reg2]
-                    self.update_logic_flags()
-                elif opcode == 0x06:
-                    # shl
-                    reg_code = self.fetch_instruction()
-                    count = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    self.registers[reg] = (self.registers[reg] << count) & 0xFF
-                    self.update_shift_flags(count)
-                elif opcode == 0x07:
-                    # OR
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    self.registers[reg1] |= self.registers[reg2]
-                    self.update_logic_flags()
-                elif opcode == 0x08:
-                    # XOR
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    self.registers[reg1] ^= self.registers[reg2]
-                    self.update_logic_flags()
-                elif opcode == 0x09:
-                    # NOT
-                    reg_code = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    self.registers[reg] = ~self.registers[reg] & 0xFFFF
-                    self.update_logic_flags()
-                elif opcode == 0x10:
-                    # MUL
-                    self.handle_mul_instruction()
-                elif opcode == 0x11:
-                    # DIV
-                    self.handle_div_instruction()
-                elif opcode == 0x12:
-                    # LOOP
-                    self.handle_loop_instruction()
-                elif opcode == 0x13:
-                    # STI/CLI
-                    self.handle_interrupt_flag_instruction()
-                elif opcode == 0x0A:
-                    # CMP
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    result = self.registers[reg1] - self.registers[reg2]
-                    self.update_arithmetic_flags(result)
-                elif opcode == 0x0B:
-                    # JE (jump если есть =)
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    if self.registers['FLAGS'] & 0b0000001:
-                        self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x0C:
-                    # CALL
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    self.push(self.registers['IP'])
-                    self.registers['IP'] = (addr_high >> 8) | addr_low
-                elif opcode == 0x0D:
-                    # RET
-                    self.registers['IP'] = self.pop()
-                elif opcode == 0x0E:
-                    # INC
-                    reg_code = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    self.registers[reg] = (self.registers[reg] + 1) & 0xFFFF
-                    self.update_arithmetic_flags(self.registers[reg])
-                elif opcode == 0x0F:
-                    # DEC
-                    reg_code = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    self.registers[reg] = (self.registers[reg] - 1) & 0xFFFF
-                    self.update_arithmetic_flags(self.registers[reg])
-                elif opcode == 0x50:  # PUSH AX
-                    self.push(self.registers['AX'])
-                elif opcode == 0x58:  # POP AX
-                    self.registers['AX'] = self.pop()
-                elif opcode == 0xE4:  # IN AL, port
-                    port = self.fetch_instruction()
-                    self.registers['AX'] = self.ports[port]
-                elif opcode == 0xE6:  # OUT port, AL
-                    port = self.fetch_instruction()
-                    self.ports[port] = self.registers['AX'] & 0xFF
-                elif opcode == 0xA4:  # MOVSB
-                    src = (self.registers['DS'] << 4) + self.registers['SI']
-                    dest = (self.registers['ES'] << 4) + self.registers['DI']
-                    self.memory[dest] = self.memory[src]
-                    self.registers['SI'] += -1 if self.direction_flag else 1
-                    self.registers['DI'] += -1 if self.direction_flag else 1
-                elif opcode == 0xFC:  # CLD (Clear Direction Flag)
-                    self.direction_flag = False
-                elif opcode == 0xFD:  # STD (Set Direction Flag)
-                    self.direction_flag = True
-                elif opcode == 0x14:
-                    # JNE
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    if not (self.registers['FLAGS'] & 0b00000001):
-                        self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x15:
-                    # JG
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    sf = (self.registers['FLAGS'] & 0b00000010) >> 1
-                    of = (self.registers['FLAGS'] & 0b00001000) >> 3
-                    zf = self.registers['FLAGS'] & 0b00000001
-                    if not zf and (zf == of):
-                        self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x17:
-                    # TEST reg1, reg2
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    result = self.registers[reg1] & self.registers[reg2]
-                    self.update_logic_flags(result)
-                elif opcode == 0x9C:
-                    # PUSHF
-                    self.push(self.registers['FLAGS'])
-                elif opcode == 0x9D:
-                    # POPF
-                    self.registers['FLAGS'] = self.pop() & 0xFF
-                elif opcode == 0x8D:
-                    # LEA reg, [offset]
-                    reg_code = self.fetch_instruction()
-                    offset_high = self.fetch_instruction()
-                    offset_low = self.fetch_instruction()
-                    self.registers[self.reg_names[reg_code]] = (offset_high << 8) | offset_low
-                elif opcode in {0x53, 0x51, 0x52}:
-                    # PUSH BX/CX/DX
-                    reg_map = {0x53: 'BX', 0x51: 'CX', 0x52: 'DX'}
-                    self.push(self.registers[reg_map[opcode]])
-                    
-                elif opcode in {0x5B, 0x59, 0x5A}:
-                    # POP BX/CX/DX
-                    reg_map = {0x5B: 'BX', 0x59: 'CX', 0x5A: 'DX'}
-                    self.registers[reg_map[opcode]] = self.pop()
-                elif opcode == 0x1B:
-                    # JMP short
-                    offset = self.fetch_instruction()
-                    self.registers['IP'] += offset - 2
-                elif opcode == 0x1C:
-                    # JC (Jump if Carry)                
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    if self.registers['FLAGS'] & 0b00000010:
-                        self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x1D:
-                    # JNC (Jump if Not Carry)
-                    addr_high = self.fetch_instruction()
-                    addr_low = self.fetch_instruction()
-                    if not (self.registers['FLAGS'] & 0b00000010):
-                        self.registers['IP'] = (addr_high << 8) | addr_low
-                elif opcode == 0x1E:
-                    # MOV [BX], AX
-                    address = self.registers['BX']
-                    self.memory[address] = (self.registers['AX'] >> 8) & 0xFF
-                    self.memory[address + 1] = self.registers['AX'] & 0xFF
-                elif opcode == 0x1F:
-                    # MOV AX, [BX]
-                    address = self.registers['BX']
-                    self.registers['AX'] = (self.memory[address] << 8) | self.memory[address + 1]
-                elif opcode == 0x20:
-                    # ADC (Add with Carry)                
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    carry = (self.registers['FLAGS'] & 0b00000010) >> 1
-                    result = self.registers[reg1] + self.registers[reg2] + carry
-                    self.registers[reg1] = result & 0xFFFF
-                    self.update_arithmetic_flags(result)
-                elif opcode == 0x21:
-                    # SBB (Subtract with Borrow)
-                    reg1_code = self.fetch_instruction()
-                    reg2_code = self.fetch_instruction()
-                    reg1 = self.reg_names[reg1_code]
-                    reg2 = self.reg_names[reg2_code]
-                    borrow = (self.registers['FLAGS'] & 0b00000010) >> 1
-                    result = self.registers[reg1] - self.registers[reg2] - borrow
-                    self.registers[reg1] = result & 0xFFFF
-                    self.update_arithmetic_flags(result)
-                elif opcode == 0x22:
-                    # CLC (Clear Carry Flag)
-                    self.registers['FLAGS'] &= ~0b00000010
-                elif opcode == 0x23:
-                    # STC (Set Carry Flag)
-                    self.registers['FLAGS'] |= 0b00000010
-                elif opcode == 0x24:
-                    # LODSB (Load String Byte)
-                    self.registers['AX'] = self.memory[(self.registers['DS'] << 4) + self.registers['SI']]
-                    self.registers['SI'] += 1 if not self.direction_flag else -1
-                elif opcode == 0x25:
-                    # STOSB (Store String Byte)
-                    self.memory[(self.registers['ES'] << 4) + self.registers['DI']] = self.registers['AX'] & 0xFF
-                    self.registers['DI'] += 1 if not self.direction_flag else -1
-                elif opcode == 0x26:
-                    # PUSHA (Push All Registers)
-                    sp = self.registers['SP']
-                    self.push(self.registers['AX'])
-                    self.push(self.registers['CX'])
-                    self.push(self.registers['DX'])
-                    self.push(self.registers['BX'])
-                    self.push(sp)
-                    self.push(self.registers['BP'])
-                    self.push(self.registers['SI'])
-                    self.push(self.registers['DI'])
-                elif opcode == 0x27:
-                    # POPA (Pop All Registers)
-                    self.registers['DI'] = self.pop()
-                    self.registers['SI'] = self.pop()
-                    self.registers['BP'] = self.pop()
-                    self.pop()  # Skip SP
-                    self.registers['BX'] = self.pop()
-                    self.registers['DX'] = self.pop()
-                    self.registers['CX'] = self.pop()
-                    self.registers['AX'] = self.pop()
-                elif opcode == 0x28:
-                    # ROL (Rotate Left)
-                    reg_code = self.fetch_instruction()
-                    count = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    value = self.registers[reg]
-                    for _ in range(count):
-                        bit = (value >> 15) & 1
-                        value = ((value << 1) | bit) & 0xFFFF
-                    self.registers[reg] = value
-                    self.update_shift_flags(count)
-                elif opcode == 0x29:
-                    # ROR (Rotate Right)
-                    reg_code = self.fetch_instruction()
-                    count = self.fetch_instruction()
-                    reg = self.reg_names[reg_code]
-                    value = self.registers[reg]
-                    for _ in range(count):
-                        bit = value & 1
-                        value = (value >> 1) | (bit << 15)
-                    self.registers[reg] = value
-                    self.update_shift_flags(count)
-                # Обработка префиксов
-                if opcode == 0xF3:  # REP префикс
-                    self.rep_prefix = True
-                    opcode = self.fetch_instruction()
-                
-                if opcode == 0xA4:  # MOVSB
-                    count = self.registers['CX'] if self.rep_prefix else 1
-                    for _ in range(count):
-                        src = (self.registers['DS'] << 4) + self.registers['SI']
-                        dest = (self.registers['ES'] << 4) + self.registers['DI']
-                        self.memory[dest] = self.memory[src]
-                        self.registers['SI'] += -1 if self.direction_flag else 1
-                        self.registers['DI'] += -1 if self.direction_flag else 1
-                        if self.rep_prefix: 
-                            self.registers['CX'] -= 1
-                            if self.registers['CX'] == 0: break
-                    self.rep_prefix = False
-
-                elif opcode == 0xA6:  # CMPSB
-                    count = self.registers['CX'] if self.rep_prefix else 1
-                    for _ in range(count):
-                        src = (self.registers['DS'] << 4) + self.registers['SI']
-                        dest = (self.registers['ES'] << 4) + self.registers['DI']
-                        res = self.memory[src] - self.memory[dest]
-                        self.update_arithmetic_flags(res)
-                        self.registers['SI'] += -1 if self.direction_flag else 1
-                        self.registers['DI'] += -1 if self.direction_flag else 1
-                        if self.rep_prefix: 
-                            self.registers['CX'] -= 1
-                            if self.registers['CX'] == 0 or res != 0: break
-                    self.rep_prefix = False
-
-                elif opcode == 0xAE:  # SCASB
-                    count = self.registers['CX'] if self.rep_prefix else 1
-                    for _ in range(count):
-                        addr = (self.registers['ES'] << 4) + self.registers['DI']
-                        res = (self.registers['AX'] & 0xFF) - self.memory[addr]
-                        self.update_arithmetic_flags(res)
-                        self.registers['DI'] += -1 if self.direction_flag else 1
-                        if self.rep_prefix: 
-                            self.registers['CX'] -= 1
-                            if self.registers['CX'] == 0 or res == 0: break
-                    self.rep_prefix = False
-                elif opcode == 0x54:  # PUSH SP
-                    self.push(self.registers['SP'])
-                elif opcode == 0x55:  # PUSH BP
-                    self.push(self.registers['BP'])
-                elif opcode == 0x56:  # PUSH SI
-                    self.push(self.registers['SI'])
-                elif opcode == 0x57:  # PUSH DI
-                    self.push(self.registers['DI'])
-                elif opcode == 0x06:  # PUSH ES
-                    self.push(self.registers['ES'])
-                elif opcode == 0x0E:  # PUSH CS
-                    self.push(self.registers['CS'])
-                elif opcode == 0x16:  # PUSH SS
-                    self.push(self.registers['SS'])
-                elif opcode == 0x1E:  # PUSH DS
-                    self.push(self.registers['DS'])
-                    
-                elif opcode == 0x5C:  # POP SP
-                    self.registers['SP'] = self.pop()
-                elif opcode == 0x5D:  # POP BP
-                    self.registers['BP'] = self.pop()
-                elif opcode == 0x5E:  # POP SI
-                    self.registers['SI'] = self.pop()
-                elif opcode == 0x5F:  # POP DI
-                    self.registers['DI'] = self.pop()
-                elif opcode == 0x07:  # POP ES
-                    self.registers['ES'] = self.pop()
-                elif opcode == 0x0F:  # POP CS
-                    self.registers['CS'] = self.pop()
-                elif opcode == 0x17:  # POP SS
-                    self.registers['SS'] = self.pop()
-                elif opcode == 0x1F:  # POP DS
-                    self.registers['DS'] = self.pop()
-
-                # Special case for flags
-                elif opcode == 0x9C:  # PUSHF
-                    self.push(self.registers['FLAGS'])
-                elif opcode == 0x9D:  # POPF
-                    self.registers['FLAGS'] = self.pop() & 0xFF
-                elif opcode == 0x70:
-                    cmd = self.fetch_instruction()
-                    if cmd == 0x01:
-                        # BLIT
-                        src_addr = (self.registers['DS'] << 4) + self.registers['SI']
-                        dest_x = self.registers['DX'] & 0xFF
-                        dest_y = (self.registers['DX'] >> 8) & 0xFF
-                        width = self.registers['CX'] & 0xFF
-                        height = (self.registers['CX'] >> 8) & 0xFF
-                        self.vc.blit(src_addr, dest_x, dest_y, width, height)
-                elif opcode == 0x71:
-                    # VECTOR_OP 
-                    op_type = self.fetch_instruction()
-                    vector_len = self.registers['CX']
-                    src = (self.registers['DS'] << 4) + self.registers['SI']
-                    dest = (self.registers['ES'] << 4) + self.registers['DI']
-                    
-                    for i in range(vector_len):
-                        val = self.memory[src + i]
-                        if op_type == 0x01:
-                            val += self.memory[dest + i]
-                        elif op_type == 0x02:
-                            val *= self.memory[dest + i]
-                        self.memory[dest + i] = val & 0xFF
-                elif opcode == 0xB8:
-                    low = self.fetch_instruction()
-                    high = self.fetch_instruction()
-                    self.registers['AX'] = (high << 8) | low
-                elif opcode == 0xCD:
-                    # INT (обработчик)
-                    int_num = self.fetch_instruction()
-                    log.write(f"INT {int_num:02X} called\n")
-                    self.handle_interrupt(int_num)
-                elif opcode == 0xFF:
+                if self.dispatch(opcode):
                     break
 
+                if profiler is not None:
+                    profiler.record(opcode, start_ip, perf_counter_ns() - start)
+
         except Exception as e:
             print(f"\x1b[1;31mExecution halted: {str(e)}\x1b[0m")
             self.registers['IP'] = 0
             self.update_flags()
+        finally:
+            if log is not None:
+                log.close()
                           
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Petysh Terminal Emulator')
     parser.add_argument('--disk', help="Файл образа диска")
     parser.add_argument('--programs', default="programs/", help="Директория с программами")
+    parser.add_argument('--capture', help="Директория для записи кадров")
+    parser.add_argument('--capture-format', default="ppm", choices=["ppm", "png"], help="Формат графических кадров")
+    parser.add_argument('--headless', action='store_true', help="Не выводить экран в терминал")
+    parser.add_argument('--keys', help="Сценарий ввода, строки через \\n (@after N, @at N, @until TEXT, @type TEXT)")
+    parser.add_argument('--keys-file', help="Файл сценария ввода")
+    parser.add_argument('--engine', default="petysh", choices=["petysh", "x86", "numba"], help="Система команд гостя")
+    parser.add_argument('--boot', help="x86-образ: загрузочный сектор или ядро PetyshkOS")
     args = parser.parse_args()
 
     cpu = PetyshCore16()
     cpu.programs_dir = args.programs
+    cpu.vc.headless = args.headless
+    if args.capture:
+        cpu.vc.start_capture(args.capture, args.capture_format)
+    if args.keys_file:
+        with open(args.keys_file, encoding='utf-8') as f:
+            cpu.load_input_script(f.read())
+    elif args.keys:
+        cpu.load_input_script(args.keys.replace('\\n', '\n'))
     
     # Создаем директорию программ если ее нет
     os.makedirs(args.programs, exist_ok=True)
@@ -1540,10 +6104,25 @@ if __name__ == "__main__":
             print(f"\x1b[31mError: Disk image '{args.disk}' not found\x1b[0m")
             sys.exit(1)
         
+    if args.boot:
+        if args.engine != "petysh":
+            cpu.set_engine(cpu.create_engine(args.engine))
+        cpu.boot_image(args.boot)
+        cpu.execute_program()
+    elif args.disk and args.engine != "petysh":
+        # настоящий BIOS: сектор 0 в 0:7C00, дальше загрузчик читает сам
+        cpu.set_engine(cpu.create_engine(args.engine))
+        cpu.engine.boot(cpu.disk_data[0])
+        cpu.execute_program()
+    elif args.disk:
         # Эмулируем загрузку через BIOS
         cpu.registers['DL'] = 0x80  # Номер диска
+        cpu.registers['AX'] = 0x0201  # AH=02h: чтение сектора
         cpu.handle_interrupt(0x13)  # Чтение диска
         cpu.registers['CS'] = 0x0000
         cpu.registers['IP'] = 0x8000
 
-    cpu.terminal_loop()
+    try:
+        cpu.terminal_loop()
+    finally:
+        cpu.vc.stop_capture()